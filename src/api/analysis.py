@@ -0,0 +1,341 @@
+"""
+Eventos del análisis de una selfie (motor síncrono).
+
+analyze_face_events produce, como diccionarios, la secuencia de eventos que
+recibe el cliente (progress, selfie, degraded, analysis, image, image_full,
+usage, complete). La usan el endpoint /api/analyze-face en modo directo y los
+workers de la cola de trabajos (services/job_queue). La versión asíncrona
+(api/asgi_routes.py) comparte con ella la secuencia de eventos
+(AnalysisEvents) y solo cambia cómo espera cada etapa.
+
+Dos requests con la misma selfie y los mismos datos (doble envío, reintento
+del frontend) comparten un solo análisis: analysis_flight_key identifica el
+análisis y la cola o el buffer de reenvío une el segundo request al primero.
+
+Si el circuit breaker de un modelo está abierto (services/circuit_breaker),
+el análisis sigue en modo degradado: la etapa de ese modelo falla al
+instante y el evento "degraded" le dice al cliente qué parte no llegará.
+"""
+import hashlib
+import json
+import threading
+import time
+from queue import Queue
+
+from api.services.blob_store import open_blob, put_blob, put_blob_file
+from api.services.cloudinary_service import upload_selfie
+from api.services.circuit_breaker import get_breaker
+from api.services.gemini_service import (
+    IMAGE_MODEL,
+    TEXT_MODEL,
+    add_usage,
+    generate_text_analysis,
+    generate_glasses_images
+)
+from api.services.job_queue import get_job_queue
+from api.services.model_files import selfie_session
+from api.services.selfie_blob import decode_image_data
+from api.sse import new_usage_totals
+
+
+class AnalysisEvents:
+    """
+    Secuencia de eventos de un análisis, compartida por los dos motores: el
+    síncrono (analyze_face_events, con hilos) y el asíncrono
+    (api/asgi_routes.py, con tareas). Cada motor solo decide cómo espera la
+    subida y las etapas; lo que se envía al cliente sale de aquí.
+
+    Cada método recibe un hecho del análisis y retorna la lista de eventos a
+    enviar.
+    """
+
+    def __init__(self, log_prefix="[API]"):
+        self.log_prefix = log_prefix
+        self.total_usage = new_usage_totals()
+        self.start_time = time.time()
+        self.degraded = None
+        self.text_result = None
+        self.images_result = None
+        self.images_sent = 0
+
+    @property
+    def finished(self):
+        """True cuando terminaron el análisis de texto y la generación de imágenes"""
+        return self.text_result is not None and self.images_result is not None
+
+    def _elapsed(self):
+        return time.time() - self.start_time
+
+    def started(self):
+        return [{"type": "progress", "status": "Subiendo imagen...", "progress": 5}]
+
+    def uploaded(self, upload_result):
+        """Eventos tras la subida a Cloudinary (un "error" final si falló)"""
+        if not upload_result["success"]:
+            err_msg = upload_result.get("error", "Error desconocido")
+            return [{"type": "error", "error": f"Error subiendo imagen: {err_msg}"}]
+
+        print(f"{self.log_prefix} Imagen subida: {upload_result['url']}")
+        events = [
+            {"type": "selfie", "selfie_url": upload_result["url"]},
+            {"type": "progress", "status": "Analizando tu rostro y generando monturas...", "progress": 15}
+        ]
+        self.degraded = degraded_mode_event()
+        if self.degraded:
+            print(f"{self.log_prefix} Modo degradado ({self.degraded['mode']}): "
+                  f"circuito abierto en {', '.join(self.degraded['models'])}")
+            events.append(self.degraded)
+        return events
+
+    def _degraded_update(self):
+        update = degraded_mode_event(self.degraded)
+        if not update:
+            return []
+        self.degraded = update
+        return [update]
+
+    def _progress(self, status):
+        progress = min(95, 15 + (20 if self.text_result is not None else 0) + self.images_sent * 15)
+        return {"type": "progress", "status": status, "progress": progress}
+
+    def text_done(self, result):
+        self.text_result = result or {"success": False, "error": "Error en análisis de texto"}
+        print(f"{self.log_prefix} Texto completado en {self._elapsed():.2f}s")
+        if self.text_result.get("success"):
+            events = [{"type": "analysis", "analysis": self.text_result.get("analysis", "")}]
+        else:
+            events = self._degraded_update() + [{"type": "analysis_error", "error": self.text_result.get("error")}]
+        return events + [self._progress("Análisis facial completado ✓")]
+
+    def image(self, image, index):
+        self.images_sent += 1
+        print(f"{self.log_prefix} ✓ Imagen {self.images_sent}/4 enviada al cliente")
+        return [
+            {"type": "image", "image": image, "index": index},
+            self._progress(f"Imagen {self.images_sent}/4 enviada")
+        ]
+
+    def image_full(self, image, index):
+        """Versión completa de una imagen ya enviada como preview"""
+        return [{"type": "image_full", "image": image, "index": index}]
+
+    def images_done(self, result):
+        self.images_result = result or {"success": False, "error": "Error generando imágenes"}
+        print(f"{self.log_prefix} Imágenes completadas en {self._elapsed():.2f}s "
+              f"({self.images_sent} enviadas progresivamente)")
+        events = []
+        if not self.images_result.get("success"):
+            events = self._degraded_update() + [{"type": "images_error", "error": self.images_result.get("error")}]
+        return events + [self._progress("Preparando resultados...")]
+
+    def handle(self, event_type, data, index=None):
+        """Despacha un evento de las etapas ("text_done", "image", "image_full", "images_done")"""
+        if event_type == "text_done":
+            return self.text_done(data)
+        if event_type == "image":
+            return self.image(data, index)
+        if event_type == "image_full":
+            return self.image_full(data, index)
+        return self.images_done(data)
+
+    def summary(self):
+        """Uso de tokens de ambas etapas y el evento final"""
+        total_usage = self.total_usage
+        if self.text_result.get("success") and self.text_result.get("usage"):
+            add_usage(total_usage, self.text_result["usage"])
+            total_usage["text_generations"] = 1
+        if self.images_result.get("usage"):
+            add_usage(total_usage, self.images_result["usage"])
+            total_usage["image_generations"] = self.images_result["usage"].get("image_generations", 0)
+        total_usage["processing_time_seconds"] = round(self._elapsed(), 2)
+        print(f"{self.log_prefix} Streaming completado en {total_usage['processing_time_seconds']}s")
+        return [
+            {"type": "usage", "usage": total_usage},
+            {"type": "complete", "success": True, "progress": 100}
+        ]
+
+
+def analyze_face_events(image_data, user_data):
+    """
+    Ejecuta el análisis completo y genera sus eventos a medida que ocurren.
+
+    Args:
+        image_data: Selfie (data URI, bytes o archivo binario)
+        user_data: Diccionario con datos del usuario
+    """
+    sequence = AnalysisEvents()
+
+    # === PASO 1: Subir imagen a Cloudinary ===
+    yield from sequence.started()
+
+    upload_result = upload_selfie(image_data)
+    if hasattr(image_data, 'close'):
+        image_data.close()  # Libera el archivo temporal de la subida binaria
+
+    yield from sequence.uploaded(upload_result)
+    if not upload_result["success"]:
+        return
+
+    selfie = upload_result["selfie"]  # Bytes ya decodificados, compartidos por todas las etapas
+
+    # La selfie se sube una vez al modelo para las dos etapas y se libera al
+    # terminar el análisis (ver model_files)
+    with selfie_session(selfie):
+        yield from _run_stages(sequence, selfie, user_data)
+
+    # === PASO 3: Enviar resumen final ===
+    yield from sequence.summary()
+
+
+def _run_stages(sequence, selfie, user_data):
+    """
+    PASO 2: Análisis de texto e imágenes EN PARALELO. Las dos etapas solo
+    necesitan la selfie: se lanzan a la vez y sus eventos se envían
+    intercalados conforme llegan a la queue.
+    """
+    print("[API] Generando análisis de texto e imágenes en paralelo...")
+
+    event_queue = Queue()
+
+    def run_text():
+        """Thread del análisis de texto"""
+        result = None
+        try:
+            result = generate_text_analysis(selfie, user_data)
+        finally:
+            event_queue.put(("text_done", result, None))
+
+    def run_images():
+        """Thread que genera imágenes y las pone en la queue"""
+        result = None
+        try:
+            result = generate_glasses_images(
+                selfie, user_data,
+                on_image_generated=lambda image, index: event_queue.put(("image", image, index)),
+                on_image_upgraded=lambda upgrade_data, index: event_queue.put(("image_full", upgrade_data, index))
+            )
+        finally:
+            event_queue.put(("images_done", result, None))  # Señal de finalización
+
+    threads = [threading.Thread(target=run_text), threading.Thread(target=run_images)]
+    for thread in threads:
+        thread.start()
+
+    # Consumir eventos de ambas etapas y enviarlos vía SSE
+    while not sequence.finished:
+        yield from sequence.handle(*event_queue.get())
+
+    for thread in threads:
+        thread.join(timeout=5.0)
+
+
+_DEGRADED_MESSAGES = {
+    "text_only": "La generación de imágenes no está disponible en este momento: recibirás solo el análisis de texto.",
+    "images_only": "El análisis de texto no está disponible en este momento: recibirás solo las monturas.",
+    "unavailable": "El servicio de IA no está disponible en este momento. Intenta de nuevo en unos minutos."
+}
+
+
+def degraded_mode_event(previous=None):
+    """
+    Evento "degraded" según los circuit breakers de los modelos.
+
+    Args:
+        previous: Último evento "degraded" enviado en este análisis
+
+    Returns:
+        dict | None: el evento, o None si ambos modelos responden o el modo
+        no cambió respecto de `previous`
+    """
+    down = [model for model in (IMAGE_MODEL, TEXT_MODEL) if not get_breaker(model).available()]
+    if not down:
+        return None
+    if len(down) == 2:
+        mode = "unavailable"
+    else:
+        mode = "text_only" if down[0] == IMAGE_MODEL else "images_only"
+    if previous and previous["mode"] == mode:
+        return None
+    return {
+        "type": "degraded",
+        "mode": mode,
+        "models": down,
+        "message": _DEGRADED_MESSAGES[mode],
+        "retry_after": max(get_breaker(model).retry_after() for model in down)
+    }
+
+
+def selfie_digest(image_data):
+    """
+    sha256 del contenido de la selfie (el mismo digest que en el almacén de
+    blobs). Un archivo se lee por partes y queda posicionado al inicio.
+    """
+    if isinstance(image_data, str):
+        return hashlib.sha256(decode_image_data(image_data)[0]).hexdigest()
+    if not hasattr(image_data, 'read'):
+        return hashlib.sha256(image_data).hexdigest()
+    sha = hashlib.sha256()
+    image_data.seek(0)
+    for chunk in iter(lambda: image_data.read(64 * 1024), b""):
+        sha.update(chunk)
+    image_data.seek(0)
+    return sha.hexdigest()
+
+
+def analysis_flight_key(digest, user_data):
+    """Clave de un análisis: digest de la selfie + datos del usuario (JSON canónico)"""
+    canonical = json.dumps(user_data or {}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(f"{digest}\0{canonical}".encode('utf-8')).hexdigest()
+
+
+def enqueue_analysis(image_data, user_data):
+    """
+    Encola el análisis de una selfie. La imagen se guarda en el almacén de
+    blobs (el trabajo solo lleva su digest) para que cualquier worker del host
+    pueda procesarlo. Si el mismo análisis ya está en cola o en curso, se
+    retorna ese trabajo.
+
+    Args:
+        image_data: Selfie (data URI, bytes o archivo binario)
+        user_data: Diccionario con datos del usuario
+
+    Returns:
+        str: id del trabajo (el existente si se reutilizó)
+    """
+    if hasattr(image_data, 'read'):
+        digest = put_blob_file(image_data)
+        image_data.close()
+    elif isinstance(image_data, str):
+        digest = put_blob(decode_image_data(image_data)[0])
+    else:
+        digest = put_blob(image_data)
+
+    job_id = get_job_queue().enqueue(
+        {"selfie": digest, "user_data": user_data or {}},
+        flight_key=analysis_flight_key(digest, user_data)
+    )
+    print(f"[JOBS] Análisis encolado: {job_id}")
+    return job_id
+
+
+def run_analysis_job(queue, job_id, payload, attempt):
+    """
+    Handler de los workers de la cola: ejecuta el análisis y agrega cada
+    evento al log del trabajo.
+
+    Returns:
+        str: estado final ('done' o 'failed')
+    """
+    if attempt > 1:
+        # Reintento tras un worker caído: el cliente descarta lo recibido
+        queue.append_event(job_id, {"type": "reset", "attempt": attempt})
+
+    with open_blob(payload["selfie"]) as mapped:
+        selfie_bytes = bytes(mapped)
+
+    status = 'done'
+    for event in analyze_face_events(selfie_bytes, payload.get("user_data", {})):
+        queue.append_event(job_id, event)
+        if event["type"] == "error":
+            status = 'failed'
+    return status
@@ -0,0 +1,572 @@
+"""
+Endpoints asíncronos (ASGI) para el streaming del análisis y las imágenes.
+
+Se montan delante de la app Flask en src/asgi.py: /api/analyze-face,
+/api/analyze-progress/<id> y /api/images/<digest> se atienden aquí y el resto
+de rutas pasa a Flask. Con la cola de trabajos (por defecto) el endpoint
+solo encola y el progreso del trabajo se sigue desde aquí, consultando su
+log en un hilo; sin ella (JOB_QUEUE_ENABLED=false) el análisis corre en el
+motor asíncrono y, mientras Gemini responde, solo ocupa una corrutina, no un
+worker. Las imágenes se leen del almacén de blobs en un hilo
+(asyncio.to_thread) y no pasan por el pool de Flask.
+"""
+import asyncio
+import json
+import os
+import time
+from contextlib import aclosing
+
+from api.services.gemini_async import (
+    upload_selfie_async,
+    generate_text_analysis_async,
+    generate_glasses_images_async
+)
+from api.analysis import AnalysisEvents, analysis_flight_key, enqueue_analysis, selfie_digest
+from api.services.blob_store import BlobMissing, is_valid_digest, open_blob_file, sniff_mime_type
+from api.services.job_queue import FINISHED_STATUSES, JOB_QUEUE_ENABLED, get_job_queue
+from api.services.model_files import selfie_session_async
+from api.services.progress_tracker import TRACKER_POLL_MAX_SECONDS, TRACKER_POLL_SECONDS
+from api.services.selfie_intake import is_binary_upload, read_selfie_upload_async, UploadError
+from api.services.event_buffer import (
+    SSE_HEARTBEAT_SECONDS,
+    get_event_buffer,
+    join_or_create_event_buffer,
+    parse_last_event_id
+)
+from api.sse import format_sse, SSE_HEADERS, SSE_KEEPALIVE
+
+# Tras una desconexión, el análisis sigue este tiempo esperando una reconexión
+SSE_RESUME_GRACE_SECONDS = float(os.getenv('SSE_RESUME_GRACE_SECONDS', 30))
+
+# Las imágenes son direccionadas por contenido: nunca cambian
+IMAGE_CACHE_CONTROL = b"public, max-age=31536000, immutable"
+# Tamaño de cada trozo del cuerpo de una imagen
+IMAGE_CHUNK_BYTES = 64 * 1024
+
+_background_tasks = set()
+
+
+async def analyze_face_events(image_data, user_data):
+    """
+    Genera, como diccionarios, los mismos eventos que el endpoint síncrono
+    /api/analyze-face (misma AnalysisEvents), usando el motor asíncrono.
+    """
+    sequence = AnalysisEvents(log_prefix="[ASGI]")
+
+    # === PASO 1: Subir imagen a Cloudinary ===
+    for event in sequence.started():
+        yield event
+
+    upload_result = await upload_selfie_async(image_data)
+    if hasattr(image_data, 'close'):
+        image_data.close()  # Libera el archivo temporal de la subida binaria
+    for event in sequence.uploaded(upload_result):
+        yield event
+    if not upload_result["success"]:
+        return
+
+    selfie = upload_result["selfie"]
+
+    # La selfie se sube una vez al modelo para las dos etapas (ver model_files)
+    async with selfie_session_async(selfie), aclosing(_run_stages(sequence, selfie, user_data)) as stages:
+        async for event in stages:
+            yield event
+
+    # === PASO 3: Resumen final ===
+    for event in sequence.summary():
+        yield event
+
+
+async def _run_stages(sequence, selfie, user_data):
+    """PASO 2: Texto e imágenes en paralelo, eventos intercalados"""
+    event_queue = asyncio.Queue()
+
+    text_task = asyncio.create_task(generate_text_analysis_async(selfie, user_data))
+    text_task.add_done_callback(lambda _: event_queue.put_nowait(("text_done", None, None)))
+
+    images_task = asyncio.create_task(generate_glasses_images_async(
+        selfie, user_data,
+        on_image_generated=lambda image, index: event_queue.put_nowait(("image", image, index)),
+        on_image_upgraded=lambda image, index: event_queue.put_nowait(("image_full", image, index))
+    ))
+    images_task.add_done_callback(lambda _: event_queue.put_nowait(("images_done", None, None)))
+
+    try:
+        while not sequence.finished:
+            event_type, data, index = await event_queue.get()
+            if event_type == "text_done":
+                data = text_task.result()
+            elif event_type == "images_done":
+                data = images_task.result()
+            for event in sequence.handle(event_type, data, index):
+                yield event
+    finally:
+        # Si el cliente se desconecta, no seguir pagando llamadas a Gemini
+        for task in (text_task, images_task):
+            if not task.done():
+                task.cancel()
+
+
+class _ClientDisconnected(Exception):
+    pass
+
+
+async def _body_chunks(receive):
+    """Itera el cuerpo del request por partes, sin acumularlo"""
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise _ClientDisconnected()
+        yield message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+
+async def _read_body(receive):
+    try:
+        return b"".join([chunk async for chunk in _body_chunks(receive)])
+    except _ClientDisconnected:
+        return None
+
+
+def _header(scope, name):
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def _start_analysis(image_data, user_data, receive, send):
+    """Encola el análisis (cola de trabajos) o lo transmite directamente"""
+    if JOB_QUEUE_ENABLED:
+        job_id = await asyncio.to_thread(enqueue_analysis, image_data, user_data)
+        await _send_json(send, 202, {
+            "job_id": job_id,
+            "progress_url": f"/api/analyze-progress/{job_id}"
+        })
+        return
+    digest = await asyncio.to_thread(selfie_digest, image_data)
+    buffer, created = join_or_create_event_buffer(analysis_flight_key(digest, user_data))
+    if not created:
+        print(f"[ASGI] Análisis idéntico en curso, se comparte la sesión {buffer.session_id}")
+        if hasattr(image_data, 'close'):
+            image_data.close()
+        await _stream_events(None, buffer, receive, send)
+        return
+    await _stream_events(analyze_face_events(image_data, user_data), buffer, receive, send)
+
+
+async def _send_json(send, status, payload):
+    body = json.dumps(payload).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"access-control-allow-origin", b"*")
+        ]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _produce(events, buffer):
+    """Vuelca el generador de eventos del análisis en el buffer de reenvío"""
+    try:
+        async for event in events:
+            buffer.append(event)
+    except Exception as e:
+        print(f"[ASGI] Error en el análisis: {e}")
+        buffer.append({"type": "error", "error": f"Error interno: {e}"})
+    finally:
+        await events.aclose()
+        buffer.close()
+
+
+async def _cancel_if_abandoned(task, buffer):
+    """
+    Tras una desconexión, el análisis sigue mientras alguien pueda reconectar;
+    si pasa SSE_RESUME_GRACE_SECONDS sin nadie conectado, se cancela para no
+    seguir pagando llamadas a Gemini.
+    """
+    while not task.done():
+        try:
+            await asyncio.wait_for(asyncio.shield(task), SSE_RESUME_GRACE_SECONDS)
+        except asyncio.TimeoutError:
+            if buffer.subscribers == 0 and time.time() - buffer.detached_at >= SSE_RESUME_GRACE_SECONDS:
+                print("[ASGI] Nadie reconectó, cancelando análisis")
+                task.cancel()
+                return
+        except Exception:
+            return
+
+
+def _spawn(coro):
+    """Tarea en segundo plano con referencia fuerte (el loop solo guarda referencias débiles)"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _send_buffered(buffer, send, after_seq=0):
+    """Envía los eventos del buffer como SSE (con id) hasta que el productor cierra"""
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+
+    def listener():
+        loop.call_soon_threadsafe(wakeup.set)
+
+    buffer.add_listener(listener)
+    buffer.subscribe()
+    try:
+        while True:
+            wakeup.clear()
+            events, missed = buffer.events_after(after_seq)
+            if missed:
+                events = [(buffer.last_seq, {"type": "error", "error": "Se perdieron eventos del análisis"})]
+            for seq, event in events:
+                await send({"type": "http.response.body", "body": format_sse(event, seq).encode(), "more_body": True})
+                after_seq = seq
+            if missed or (not events and buffer.closed):
+                return
+            if not events:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    await send({"type": "http.response.body", "body": SSE_KEEPALIVE.encode(), "more_body": True})
+    finally:
+        buffer.remove_listener(listener)
+        buffer.unsubscribe()
+
+
+def _job_snapshot(queue, job_id, after_seq):
+    """
+    Eventos nuevos del log de un trabajo y, si no hay, el trabajo (corre en
+    un hilo).
+
+    Returns:
+        tuple: ([(seq, evento)], trabajo o None si hubo eventos)
+    """
+    events = queue.events_after(job_id, after_seq)
+    if events:
+        return events, None
+    job = queue.get_job(job_id)
+    if job is not None and job["status"] in FINISHED_STATUSES:
+        # Eventos escritos entre la lectura y el cambio de estado
+        events = queue.events_after(job_id, after_seq)
+    return events, job
+
+
+async def _send_job_events(queue, job_id, send, after_seq=0):
+    """
+    Envía como SSE el log de un trabajo desde after_seq y sigue los eventos
+    nuevos hasta que termina. Sin eventos, la consulta se espacia de
+    TRACKER_POLL_SECONDS a TRACKER_POLL_MAX_SECONDS, como los trackers.
+    """
+    poll = TRACKER_POLL_SECONDS
+    last_sent = time.time()
+    while True:
+        events, job = await asyncio.to_thread(_job_snapshot, queue, job_id, after_seq)
+        for seq, event in events:
+            await send({"type": "http.response.body", "body": format_sse(event, seq).encode(), "more_body": True})
+            after_seq = seq
+        if events:
+            poll = TRACKER_POLL_SECONDS
+            last_sent = time.time()
+            continue
+        if job is None or job["status"] in FINISHED_STATUSES:
+            return
+        if time.time() - last_sent >= SSE_HEARTBEAT_SECONDS:
+            await send({"type": "http.response.body", "body": SSE_KEEPALIVE.encode(), "more_body": True})
+            last_sent = time.time()
+        await asyncio.sleep(poll)
+        poll = min(poll * 2, TRACKER_POLL_MAX_SECONDS)
+
+
+async def _send_sse(sender, receive, send):
+    """
+    Responde con un stream SSE cuyo cuerpo envía la corrutina `sender`, hasta
+    que termina o el cliente se desconecta.
+
+    Returns:
+        bool: True si el cliente se desconectó antes del final
+    """
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream")] + [
+            (name.lower().encode(), value.encode()) for name, value in SSE_HEADERS.items()
+        ]
+    })
+
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    sender_task = asyncio.create_task(sender)
+    watch_task = asyncio.create_task(watch_disconnect())
+    done, _ = await asyncio.wait({sender_task, watch_task}, return_when=asyncio.FIRST_COMPLETED)
+
+    if watch_task in done:
+        sender_task.cancel()
+        await asyncio.gather(sender_task, return_exceptions=True)
+        return True
+
+    watch_task.cancel()
+    sender_task.result()
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+    return False
+
+
+async def _stream_events(events, buffer, receive, send, after_seq=0):
+    """
+    Envía un generador asíncrono de eventos como SSE. Los eventos pasan por el
+    buffer de reenvío: si el cliente se va, puede reconectar en
+    /api/analyze-progress/<session_id> con Last-Event-ID.
+
+    Con events=None solo se siguen los eventos de un buffer ya alimentado por
+    otro request (análisis compartido o reconexión), desde after_seq.
+    """
+    producer = None
+    if events is not None:
+        buffer.append({"type": "session", "session_id": buffer.session_id})
+        producer = _spawn(_produce(events, buffer))
+
+    if await _send_sse(_send_buffered(buffer, send, after_seq), receive, send):
+        print("[ASGI] Cliente desconectado, el análisis espera una reconexión")
+        if producer is not None:
+            _spawn(_cancel_if_abandoned(producer, buffer))
+
+
+async def analyze_face(scope, receive, send):
+    """
+    Endpoint asíncrono equivalente a POST /api/analyze-face (encola el
+    análisis, o lo transmite por SSE si la cola está desactivada).
+    """
+    content_type = _header(scope, b"content-type")
+    if is_binary_upload(content_type):
+        content_length = _header(scope, b"content-length")
+        try:
+            image_data, user_data = await read_selfie_upload_async(
+                _body_chunks(receive),
+                content_type,
+                content_length=int(content_length) if content_length and content_length.isdigit() else None,
+                user_data_header=_header(scope, b"x-user-data")
+            )
+        except _ClientDisconnected:
+            return
+        except UploadError as e:
+            await _send_json(send, e.status, {"error": str(e)})
+            return
+
+        print("[ASGI] Recibiendo request /analyze-face (subida binaria)")
+        await _start_analysis(image_data, user_data, receive, send)
+        return
+
+    body = await _read_body(receive)
+    if body is None:
+        return
+
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = None
+
+    if not data:
+        await _send_json(send, 400, {"error": "No se recibieron datos"})
+        return
+
+    image_data = data.get('image')
+    user_data = data.get('userData', {})
+    if not image_data:
+        await _send_json(send, 400, {"error": "No se recibió imagen"})
+        return
+
+    print("[ASGI] Recibiendo request /analyze-face")
+    await _start_analysis(image_data, user_data, receive, send)
+
+
+async def analyze_progress(scope, receive, send):
+    """
+    Endpoint asíncrono equivalente a GET /api/analyze-progress/<session_id>
+    para trabajos de la cola y sesiones de stream directo (con Last-Event-ID
+    solo se envían los eventos posteriores).
+
+    Returns:
+        False si session_id no es ninguno de los dos: el request pasa a Flask,
+        que sigue los trackers de progreso sueltos
+    """
+    session_id = scope["path"].rstrip("/").rsplit("/", 1)[-1]
+    after_seq = parse_last_event_id(_header(scope, b"last-event-id"))
+
+    if JOB_QUEUE_ENABLED:
+        queue = await asyncio.to_thread(get_job_queue)
+        if await asyncio.to_thread(queue.get_job, session_id) is not None:
+            await _send_sse(_send_job_events(queue, session_id, send, after_seq), receive, send)
+            return None
+
+    buffer = get_event_buffer(session_id)
+    if buffer is not None:
+        await _stream_events(None, buffer, receive, send, after_seq)
+        return None
+    return False
+
+
+def _etag_matches(if_none_match, etag):
+    """If-None-Match (lista de ETags, débiles o fuertes, o *) contiene el ETag"""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/").strip('"') == etag for tag in tags)
+
+
+def _parse_range(range_header, size):
+    """
+    Rango pedido como (inicio, fin) inclusivo.
+
+    Returns:
+        tuple | None: None sin Range (o con varios rangos: se envía todo)
+
+    Raises:
+        ValueError: si el rango no se puede satisfacer (416)
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start, _, end = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                raise ValueError(range_header)
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        raise ValueError(range_header)
+    if start >= size or start > end:
+        raise ValueError(range_header)
+    return start, end
+
+
+class _UnsatisfiableRange(Exception):
+    def __init__(self, size):
+        super().__init__(size)
+        self.size = size
+
+
+def _open_image(digest, range_header):
+    """
+    Abre la imagen del almacén y resuelve el rango pedido, sin leer el
+    contenido (se envía después por partes). Corre en un hilo.
+
+    Returns:
+        tuple: (archivo abierto, mime_type, tamaño total, (inicio, fin) o None)
+
+    Raises:
+        BlobMissing: si el blob no existe
+        _UnsatisfiableRange: si el rango no cabe en la imagen
+    """
+    f = open_blob_file(digest)
+    try:
+        size = os.fstat(f.fileno()).st_size
+        mime_type = sniff_mime_type(os.pread(f.fileno(), 16, 0))
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            raise _UnsatisfiableRange(size)
+    except BaseException:
+        f.close()
+        raise
+    return f, mime_type, size, byte_range
+
+
+async def get_image(scope, receive, send):
+    """
+    Endpoint asíncrono equivalente a GET /api/images/<digest>.
+
+    La URL es el SHA-256 del contenido, así que la respuesta nunca cambia:
+    ETag fuerte, Cache-Control immutable y soporte de Range/If-None-Match.
+    """
+    digest = scope["path"].rstrip("/").rsplit("/", 1)[-1]
+    if not is_valid_digest(digest):
+        await _send_json(send, 404, {"error": "Imagen no encontrada"})
+        return
+
+    headers = [
+        (b"etag", f'"{digest}"'.encode()),
+        (b"cache-control", IMAGE_CACHE_CONTROL),
+        (b"accept-ranges", b"bytes"),
+        (b"access-control-allow-origin", b"*")
+    ]
+    if _etag_matches(_header(scope, b"if-none-match"), digest):
+        await send({"type": "http.response.start", "status": 304, "headers": headers})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    range_header = _header(scope, b"range")
+    if_range = _header(scope, b"if-range")
+    if if_range is not None and if_range.strip('"') != digest:
+        range_header = None
+
+    try:
+        f, mime_type, size, byte_range = await asyncio.to_thread(_open_image, digest, range_header)
+    except BlobMissing:
+        await _send_json(send, 404, {"error": "Imagen no encontrada"})
+        return
+    except _UnsatisfiableRange as e:
+        await send({
+            "type": "http.response.start",
+            "status": 416,
+            "headers": headers + [(b"content-range", f"bytes */{e.size}".encode())]
+        })
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    with f:
+        status = 200
+        start, end = byte_range or (0, size - 1)
+        headers.append((b"content-type", mime_type.encode()))
+        headers.append((b"content-length", str(end + 1 - start).encode()))
+        if byte_range is not None:
+            status = 206
+            headers.append((b"content-range", f"bytes {start}-{end}/{size}".encode()))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+
+        # Por partes, leídas en un hilo: nunca la imagen entera en memoria
+        offset = start if scope["method"] != "HEAD" else end + 1
+        while offset <= end:
+            chunk = await asyncio.to_thread(os.pread, f.fileno(), min(IMAGE_CHUNK_BYTES, end + 1 - offset), offset)
+            if not chunk:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            offset += len(chunk)
+        await send({"type": "http.response.body", "body": b""})
+
+
+# Rutas atendidas por la capa ASGI: (método, path) -> handler
+ASYNC_ROUTES = {
+    ("POST", "/api/analyze-face"): analyze_face
+}
+
+# Rutas con un parámetro al final del path: (método, prefijo) -> handler.
+# Un handler que retorna False deja el request a Flask
+ASYNC_PREFIX_ROUTES = {
+    ("GET", "/api/analyze-progress/"): analyze_progress,
+    ("GET", "/api/images/"): get_image,
+    ("HEAD", "/api/images/"): get_image
+}
+
+
+def find_async_route(method, path):
+    """Handler ASGI de un request, o None si lo atiende Flask"""
+    path = path.rstrip("/")
+    handler = ASYNC_ROUTES.get((method, path))
+    if handler:
+        return handler
+    for (route_method, prefix), handler in ASYNC_PREFIX_ROUTES.items():
+        param = path[len(prefix):]
+        if method == route_method and path.startswith(prefix) and param and "/" not in param:
+            return handler
+    return None
@@ -1,15 +1,26 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
-from flask import Flask, request, jsonify, url_for, Blueprint, Response, stream_with_context
+from flask import Flask, request, jsonify, url_for, Blueprint, Response, stream_with_context, send_file
 from api.models import db, User
 from api.utils import generate_sitemap, APIException
-from api.services.cloudinary_service import upload_selfie
-from api.services.gemini_service import analyze_face_for_glasses
-from api.services.progress_tracker import create_tracker, get_tracker, cleanup_tracker
+from api.analysis import analysis_flight_key, analyze_face_events, degraded_mode_event, enqueue_analysis, selfie_digest
+from api.services.selfie_intake import is_binary_upload, read_selfie_upload, UploadError
+from api.services.job_queue import JOB_QUEUE_ENABLED, get_job_queue, stream_job_events
+from api.services.progress_tracker import get_tracker, cleanup_tracker
+from api.services.rate_limiter import get_bucket_levels
+from api.services.cache_sweeper import get_cache_stats
+from api.services.http_transport import get_transport_stats
+from api.services.hedging import get_hedge_stats
+from api.services.gemini_errors import get_error_stats
+from api.services.circuit_breaker import get_breaker_states
+from api.services.model_files import get_file_stats
+from api.services.blob_store import is_valid_digest, has_blob, blob_path, open_blob, sniff_mime_type
+from api.services.event_buffer import join_or_create_event_buffer, get_event_buffer, follow_events, parse_last_event_id
+from api.sse import format_sse, SSE_HEADERS, SSE_KEEPALIVE
 from flask_cors import CORS
-import json
-import time
+import os
+import threading
 
 api = Blueprint('api', __name__)
 
@@ -27,18 +38,153 @@ def handle_hello():
     return jsonify(response_body), 200
 
 
+@api.route('/rate-limits', methods=['GET'])
+def rate_limits():
+    """
+    Nivel actual de tokens de cada bucket de Gemini (compartido entre workers)
+    """
+    return jsonify(get_bucket_levels()), 200
+
+
+@api.route('/model-status', methods=['GET'])
+def model_status():
+    """
+    Estado del circuit breaker de cada modelo de Gemini (en este worker) y
+    el modo degradado con el que empezaría ahora un análisis
+    """
+    degraded = degraded_mode_event()
+    return jsonify({
+        "models": get_breaker_states(),
+        "mode": degraded["mode"] if degraded else "full"
+    }), 200
+
+
+@api.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """
+    Tamaño de la caché de checkpoints/resultados y métricas del barrido en segundo plano
+    """
+    return jsonify(get_cache_stats()), 200
+
+
+@api.route('/transport-stats', methods=['GET'])
+def transport_stats():
+    """
+    Requests, errores, timeouts y latencia por etapa, uso de los pools de
+    conexiones, métricas del hedging de imágenes, resultados por clase de
+    error de Gemini y selfies subidas al modelo (referenciadas frente a inline)
+    """
+    return jsonify({
+        **get_transport_stats(),
+        "hedging": get_hedge_stats(),
+        "gemini_errors": get_error_stats(),
+        "model_files": get_file_stats()
+    }), 200
+
+
+@api.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Estado de un análisis encolado (queued, running, done o failed)
+    """
+    job = get_job_queue().get_job(job_id) if JOB_QUEUE_ENABLED else None
+    if job is None:
+        return jsonify({"error": "Trabajo no encontrado"}), 404
+    return jsonify(job), 200
+
+
+@api.route('/images/<digest>', methods=['GET'])
+def get_image(digest):
+    """
+    Sirve una imagen generada desde el almacén de blobs.
+    
+    La URL es el SHA-256 del contenido, así que la respuesta nunca cambia:
+    ETag fuerte, Cache-Control immutable y soporte de Range/If-None-Match.
+    Detrás de src/asgi.py la atiende api/asgi_routes.get_image sin pasar por
+    el pool de Flask; esta versión queda para el servidor WSGI (flask run).
+    """
+    if not is_valid_digest(digest) or not has_blob(digest):
+        return jsonify({"error": "Imagen no encontrada"}), 404
+    
+    with open_blob(digest) as mapped:
+        mime_type = sniff_mime_type(mapped)
+    
+    response = send_file(
+        blob_path(digest),
+        mimetype=mime_type,
+        etag=digest,
+        conditional=True,
+        max_age=31536000
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# Intervalo máximo sin enviar nada a un stream de progreso
+PROGRESS_HEARTBEAT_SECONDS = float(os.getenv('PROGRESS_HEARTBEAT_SECONDS', 5))
+
+
+def _generate_buffered_events(buffer, after_seq=0):
+    """SSE de un buffer de reenvío, con keepalive mientras no hay eventos"""
+    for item in follow_events(buffer, after_seq):
+        if item is None:
+            yield SSE_KEEPALIVE
+        else:
+            seq, event = item
+            yield format_sse(event, seq)
+
+
 @api.route('/analyze-progress/<session_id>', methods=['GET'])
 def analyze_progress(session_id):
     """
-    Endpoint SSE para streaming de progreso del análisis
+    Endpoint SSE para streaming de progreso del análisis.
+    
+    Si session_id es un trabajo de la cola, transmite su log de eventos y
+    sigue los nuevos hasta que el trabajo termina; si es una sesión de stream
+    directo, hace lo mismo desde su buffer de reenvío. En ambos casos cada
+    evento lleva su "id:" y, con el header Last-Event-ID, solo se envían los
+    eventos posteriores (reconexión sin repetir el análisis).
+    
+    Detrás de src/asgi.py los trabajos y las sesiones de stream directo los
+    atiende api/asgi_routes.analyze_progress; aquí llegan solo los trackers
+    de progreso sueltos (y todo, con el servidor WSGI).
     """
+    after_seq = parse_last_event_id(request.headers.get('Last-Event-ID'))
+    
+    if JOB_QUEUE_ENABLED:
+        queue = get_job_queue()
+        if queue.get_job(session_id) is not None:
+            def generate_job_events():
+                for item in stream_job_events(queue, session_id, after_seq):
+                    if item is None:
+                        yield SSE_KEEPALIVE
+                    else:
+                        seq, event = item
+                        yield format_sse(event, seq)
+            
+            return Response(
+                generate_job_events(),
+                mimetype='text/event-stream',
+                headers=SSE_HEADERS
+            )
+    
+    buffer = get_event_buffer(session_id)
+    if buffer is not None:
+        return Response(
+            _generate_buffered_events(buffer, after_seq),
+            mimetype='text/event-stream',
+            headers=SSE_HEADERS
+        )
+    
     def generate():
         tracker = get_tracker(session_id)
         if not tracker:
-            yield f"data: {{\"error\": \"Session not found\"}}\n\n"
+            yield format_sse({"error": "Session not found"})
             return
         
         last_progress = -1
+        version = tracker.version
         
         while True:
             progress_data = tracker.get_progress()
@@ -46,14 +192,19 @@ def analyze_progress(session_id):
             
             # Solo enviar si hay cambio
             if current_progress != last_progress:
-                yield f"data: {json.dumps(progress_data)}\n\n"
+                yield format_sse(progress_data)
                 last_progress = current_progress
             
             # Terminar cuando llegue a 100%
             if current_progress >= 100:
                 break
             
-            time.sleep(0.5)  # Actualizar cada 500ms
+            # Esperar un cambio publicado. Al vencer el heartbeat se reenvía la
+            # estimación por tiempo si avanzó, o un keepalive si no
+            new_version = tracker.wait_for_change(version, PROGRESS_HEARTBEAT_SECONDS)
+            if new_version == version and tracker.get_progress()['progress'] == current_progress:
+                yield SSE_KEEPALIVE
+            version = new_version
         
         # Limpiar tracker después de completar
         cleanup_tracker(session_id)
@@ -61,193 +212,99 @@ def analyze_progress(session_id):
     return Response(
         stream_with_context(generate()),
         mimetype='text/event-stream',
-        headers={
-            'Cache-Control': 'no-cache',
-            'X-Accel-Buffering': 'no'
-        }
+        headers=SSE_HEADERS
     )
 
 
 @api.route('/analyze-face', methods=['POST'])
 def analyze_face():
     """
-    Endpoint SSE para analizar selfie y recomendar monturas.
-    Envía resultados PROGRESIVAMENTE a medida que llegan.
+    Endpoint para analizar selfie y recomendar monturas.
+    
+    Con la cola de trabajos activa (JOB_QUEUE_ENABLED, por defecto) encola el
+    análisis y responde 202 con {"job_id", "progress_url"}; los eventos se
+    reciben por SSE en progress_url. Si no, responde directamente con el
+    stream SSE y envía resultados PROGRESIVAMENTE a medida que llegan.
+    
+    Acepta la selfie como JSON ({"image": data URI, "userData": {...}}) o como
+    binario: multipart/form-data (campo "image") o cuerpo image/* (ver
+    selfie_intake). En modo binario la imagen no pasa por base64.
     
     Flujo:
     1. Sube imagen a Cloudinary
-    2. Envía análisis de texto (primero, más rápido)
-    3. Envía imágenes una a una
+    2. Lanza a la vez el análisis de texto y la generación de imágenes
+    3. Envía el análisis y cada imagen en cuanto están listos
+       (primero el preview, luego un evento image_full con la versión completa)
     4. Envía resumen final con costos
     """
     try:
         print("[API] Recibiendo request /analyze-face (streaming)")
-        data = request.get_json()
+        if is_binary_upload(request.content_type):
+            # Subida binaria: el cuerpo se vuelca por partes a un archivo temporal
+            try:
+                image_data, user_data = read_selfie_upload(
+                    request.stream,
+                    request.content_type,
+                    content_length=request.content_length,
+                    user_data_header=request.headers.get('X-User-Data')
+                )
+            except UploadError as e:
+                return jsonify({"error": str(e)}), e.status
+        else:
+            data = request.get_json()
+            
+            if not data:
+                return jsonify({"error": "No se recibieron datos"}), 400
+            
+            image_data = data.get('image')
+            user_data = data.get('userData', {})
+            
+            if not image_data:
+                return jsonify({"error": "No se recibió imagen"}), 400
         
-        if not data:
-            return jsonify({"error": "No se recibieron datos"}), 400
+        if JOB_QUEUE_ENABLED:
+            # El análisis corre en los workers de la cola; el cliente sigue
+            # sus eventos en /api/analyze-progress/<job_id>
+            job_id = enqueue_analysis(image_data, user_data)
+            return jsonify({
+                "job_id": job_id,
+                "progress_url": f"/api/analyze-progress/{job_id}"
+            }), 202
         
-        image_data = data.get('image')
-        user_data = data.get('userData', {})
+        # Stream directo: el análisis corre en su propio hilo y escribe en un
+        # buffer de reenvío; si la conexión se corta, el cliente reconecta en
+        # /api/analyze-progress/<session_id> con Last-Event-ID. Un request
+        # idéntico a uno en curso se une a su buffer
+        buffer, created = join_or_create_event_buffer(
+            analysis_flight_key(selfie_digest(image_data), user_data)
+        )
+        if not created:
+            print(f"[API] Análisis idéntico en curso, se comparte la sesión {buffer.session_id}")
+            if hasattr(image_data, 'close'):
+                image_data.close()
+            return Response(
+                _generate_buffered_events(buffer),
+                mimetype='text/event-stream',
+                headers=SSE_HEADERS
+            )
+        buffer.append({"type": "session", "session_id": buffer.session_id})
         
-        if not image_data:
-            return jsonify({"error": "No se recibió imagen"}), 400
+        def produce():
+            try:
+                for event in analyze_face_events(image_data, user_data):
+                    buffer.append(event)
+            except Exception as e:
+                print(f"[API ERROR] Error en el análisis: {e}")
+                buffer.append({"type": "error", "error": f"Error interno: {e}"})
+            finally:
+                buffer.close()
         
-        def generate():
-            from api.services.gemini_service import generate_text_analysis, generate_glasses_images
-            
-            # Capturar variables del scope exterior
-            img_data = image_data
-            usr_data = user_data
-            
-            total_usage = {
-                "prompt_tokens": 0,
-                "output_tokens": 0,
-                "total_tokens": 0,
-                "image_generations": 0,
-                "text_generations": 0,
-                "processing_time_seconds": 0
-            }
-            start_time = time.time()
-            
-            # === PASO 1: Subir imagen a Cloudinary ===
-            progress_data = {"type": "progress", "status": "Subiendo imagen...", "progress": 5}
-            yield f"data: {json.dumps(progress_data)}\n\n"
-            
-            upload_result = upload_selfie(img_data)
-            
-            if not upload_result["success"]:
-                err_msg = upload_result.get("error", "Error desconocido")
-                error_data = {"type": "error", "error": f"Error subiendo imagen: {err_msg}"}
-                yield f"data: {json.dumps(error_data)}\n\n"
-                return
-            
-            selfie_url = upload_result["url"]
-            print(f"[API] Imagen subida: {selfie_url}")
-            
-            selfie_data = {"type": "selfie", "selfie_url": selfie_url}
-            yield f"data: {json.dumps(selfie_data)}\n\n"
-            
-            progress_data = {"type": "progress", "status": "Analizando tu rostro...", "progress": 15}
-            yield f"data: {json.dumps(progress_data)}\n\n"
-            
-            # === PASO 2: Análisis de texto (más rápido) ===
-            print("[API] Generando análisis de texto...")
-            text_result = generate_text_analysis(selfie_url, usr_data)
-            
-            text_time = time.time() - start_time
-            print(f"[API] Texto completado en {text_time:.2f}s")
-            
-            if text_result.get("success"):
-                # Agregar tokens de texto
-                if text_result.get("usage"):
-                    total_usage["prompt_tokens"] += text_result["usage"].get("prompt_tokens", 0)
-                    total_usage["output_tokens"] += text_result["usage"].get("output_tokens", 0)
-                    total_usage["total_tokens"] += text_result["usage"].get("total_tokens", 0)
-                    total_usage["text_generations"] = 1
-                
-                analysis_data = {"type": "analysis", "analysis": text_result.get("analysis", "")}
-                yield f"data: {json.dumps(analysis_data)}\n\n"
-            else:
-                error_data = {"type": "analysis_error", "error": text_result.get("error")}
-                yield f"data: {json.dumps(error_data)}\n\n"
-            
-            progress_data = {"type": "progress", "status": "Generando monturas...", "progress": 50}
-            yield f"data: {json.dumps(progress_data)}\n\n"
-            
-            # === PASO 3: Generar imágenes con entrega progresiva REAL ===
-            # Usamos threading + queue para poder yield imágenes conforme se generan
-            print("[API] Generando imágenes (entrega progresiva)...")
-            
-            import threading
-            from queue import Queue, Empty
-            
-            image_queue = Queue()
-            result_holder = [None]  # Para capturar resultado final en el thread
-            
-            def run_generation():
-                """Thread que genera imágenes y las pone en la queue"""
-                def on_image_ready(image_data, index):
-                    print(f"[API] ✓ Imagen {index + 1}/4 generada, enviando al cliente...")
-                    image_queue.put(("image", image_data, index))
-                
-                result = generate_glasses_images(selfie_url, usr_data, on_image_generated=on_image_ready)
-                result_holder[0] = result
-                image_queue.put(("done", result, None))  # Señal de finalización
-            
-            # Iniciar generación en thread separado
-            gen_thread = threading.Thread(target=run_generation)
-            gen_thread.start()
-            
-            images_sent = 0
-            
-            # Consumir imágenes de la queue y enviarlas vía SSE
-            while True:
-                try:
-                    # Esperar hasta 1 segundo por cada item
-                    item = image_queue.get(timeout=1.0)
-                    event_type, data, index = item
-                    
-                    if event_type == "image":
-                        images_sent += 1
-                        progress = 50 + images_sent * 12
-                        
-                        # Enviar imagen inmediatamente
-                        img_event_data = {"type": "image", "image": data, "index": index}
-                        yield f"data: {json.dumps(img_event_data)}\n\n"
-                        
-                        progress_data = {"type": "progress", "status": f"Imagen {images_sent}/4 enviada", "progress": progress}
-                        yield f"data: {json.dumps(progress_data)}\n\n"
-                        
-                        print(f"[API] ✓ Imagen {images_sent}/4 enviada al cliente")
-                    
-                    elif event_type == "done":
-                        # Generación completada
-                        images_result = data
-                        break
-                        
-                except Empty:
-                    # Timeout, verificar si el thread sigue vivo
-                    if not gen_thread.is_alive():
-                        images_result = result_holder[0]
-                        break
-                    continue
-            
-            # Esperar a que el thread termine
-            gen_thread.join(timeout=5.0)
-            
-            images_time = time.time() - start_time
-            print(f"[API] Imágenes completadas en {images_time:.2f}s ({images_sent} enviadas progresivamente)")
-            
-            # Agregar tokens de imágenes al total
-            if images_result and images_result.get("success") and images_result.get("usage"):
-                total_usage["prompt_tokens"] += images_result["usage"].get("prompt_tokens", 0)
-                total_usage["output_tokens"] += images_result["usage"].get("output_tokens", 0)
-                total_usage["total_tokens"] += images_result["usage"].get("total_tokens", 0)
-                total_usage["image_generations"] = images_result["usage"].get("image_generations", 0)
-            elif images_result and not images_result.get("success"):
-                error_data = {"type": "images_error", "error": images_result.get("error")}
-                yield f"data: {json.dumps(error_data)}\n\n"
-            
-            # === PASO 4: Enviar resumen final ===
-            total_usage["processing_time_seconds"] = round(time.time() - start_time, 2)
-            
-            usage_data = {"type": "usage", "usage": total_usage}
-            yield f"data: {json.dumps(usage_data)}\n\n"
-            
-            complete_data = {"type": "complete", "success": True, "progress": 100}
-            yield f"data: {json.dumps(complete_data)}\n\n"
-            
-            print(f"[API] Streaming completado en {total_usage['processing_time_seconds']}s")
+        threading.Thread(target=produce, name=f"analysis-{buffer.session_id[:8]}", daemon=True).start()
         
         return Response(
-            stream_with_context(generate()),
+            _generate_buffered_events(buffer),
             mimetype='text/event-stream',
-            headers={
-                'Cache-Control': 'no-cache',
-                'X-Accel-Buffering': 'no',
-                'Access-Control-Allow-Origin': '*'
-            }
+            headers=SSE_HEADERS
         )
         
     except Exception as e:
@@ -0,0 +1,313 @@
+"""
+Almacén de imágenes binarias direccionado por contenido.
+
+Las imágenes generadas se guardan aquí en cuanto llegan de Gemini, sin base64,
+en BLOB_STORE_DIR/<2 primeros>/<sha256>. El resto del sistema (eventos SSE,
+checkpoints, caché de resultados) solo maneja un registro pequeño con la
+referencia ("blob": sha256, "url": /api/images/<sha256>); el navegador
+descarga los bytes por HTTP normal, cacheable. Las lecturas usan mmap.
+
+El almacén tiene su propio límite de tamaño (BLOB_STORE_MAX_BYTES, aparte
+de CACHE_MAX_BYTES): el barrido periódico borra los blobs usados hace más
+tiempo (mtime, que se renueva en cada lectura) hasta volver por debajo. Un
+registro cuyo blob se borró cuenta como entrada ausente (BlobMissing).
+
+Con CACHE_BACKEND=redis en varios hosts, BLOB_STORE_DIR debe ser un volumen
+compartido.
+"""
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from .selfie_blob import decode_image_data
+
+BLOB_STORE_DIR = os.getenv(
+    'BLOB_STORE_DIR',
+    os.path.join(tempfile.gettempdir(), 'visagista_blobs')
+)
+
+# Tamaño máximo del almacén; el barrido expulsa por LRU lo que exceda
+BLOB_STORE_MAX_BYTES = int(os.getenv('BLOB_STORE_MAX_BYTES', 4 * 1024 * 1024 * 1024))
+
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Firmas de los formatos de imagen que puede devolver Gemini
+_MAGIC_NUMBERS = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF8', 'image/gif'),
+)
+
+
+class BlobMissing(Exception):
+    """Un registro referencia un blob que ya no está en el almacén"""
+
+
+def is_valid_digest(digest):
+    return isinstance(digest, str) and bool(_DIGEST_RE.match(digest))
+
+
+def blob_path(digest):
+    """Ruta del blob (digest validado: nunca sale de BLOB_STORE_DIR)"""
+    if not is_valid_digest(digest):
+        raise ValueError(f"Digest inválido: {digest!r}")
+    return os.path.join(BLOB_STORE_DIR, digest[:2], digest)
+
+
+def put_blob(data):
+    """
+    Guarda bytes en el almacén (escritura atómica; si ya existen no se reescriben).
+
+    Returns:
+        str: SHA-256 del contenido
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    if os.path.exists(path):
+        _touch(path)
+        return digest
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return digest
+
+
+def put_blob_file(f, chunk_size=64 * 1024):
+    """
+    Igual que put_blob, pero copia por partes desde un archivo binario abierto
+    (no carga el contenido completo en memoria).
+
+    Returns:
+        str: SHA-256 del contenido
+    """
+    os.makedirs(BLOB_STORE_DIR, exist_ok=True)
+    sha = hashlib.sha256()
+    tmp_path = os.path.join(BLOB_STORE_DIR, f"upload.{os.getpid()}.{threading.get_ident()}.tmp")
+    f.seek(0)
+    with open(tmp_path, 'wb') as out:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+            out.write(chunk)
+
+    digest = sha.hexdigest()
+    path = blob_path(digest)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        _touch(path)
+        return digest
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    return digest
+
+
+def _touch(path):
+    """Renueva el mtime: el barrido borra solo blobs sin uso reciente"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def image_url(digest):
+    """Ruta del endpoint que sirve el blob (relativa al backend)"""
+    return f"/api/images/{digest}"
+
+
+def sniff_mime_type(head):
+    """Tipo MIME de una imagen a partir de sus primeros bytes"""
+    head = bytes(head[:16])
+    for magic, mime_type in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mime_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+def store_image(image_bytes, mime_type, **metadata):
+    """
+    Guarda una imagen generada y arma su registro de referencia.
+
+    Returns:
+        dict: {"blob", "url", "mime_type", ...metadata}
+    """
+    digest = put_blob(image_bytes)
+    record = {"blob": digest, "url": image_url(digest), "mime_type": mime_type}
+    record.update(metadata)
+    return record
+
+
+def has_blob(digest):
+    return is_valid_digest(digest) and os.path.exists(blob_path(digest))
+
+
+def open_blob_file(digest):
+    """
+    Abre un blob como archivo binario (para leerlo por partes) y renueva su uso.
+
+    Raises:
+        BlobMissing: si el blob no existe
+    """
+    try:
+        f = open(blob_path(digest), 'rb')
+    except FileNotFoundError:
+        raise BlobMissing(digest)
+    _touch(f.name)
+    return f
+
+
+@contextmanager
+def open_blob(digest):
+    """
+    Abre un blob como mmap de solo lectura (soporta slicing y el buffer protocol).
+
+    Raises:
+        BlobMissing: si el blob no existe
+    """
+    with open_blob_file(digest) as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def _is_data_uri_image(value):
+    if not isinstance(value, dict) or not isinstance(value.get('data'), str):
+        return False
+    return value['data'].startswith('data:')
+
+
+def pack_images(value):
+    """
+    Reemplaza, dentro de un valor JSON, cada imagen con data URI por un
+    registro de metadatos con referencia a su blob binario.
+    """
+    if _is_data_uri_image(value):
+        image_bytes, mime_type = decode_image_data(value['data'])
+        record = {k: v for k, v in value.items() if k != 'data'}
+        record['blob'] = put_blob(image_bytes)
+        record['url'] = image_url(record['blob'])
+        record.setdefault('mime_type', mime_type)
+        return record
+    if isinstance(value, dict):
+        return {k: pack_images(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [pack_images(v) for v in value]
+    return value
+
+
+def unpack_images(value):
+    """
+    Verifica que las imágenes referenciadas en un valor JSON sigan en el
+    almacén (no se leen: el cliente las descarga por su URL).
+
+    Raises:
+        BlobMissing: si alguna imagen referenciada ya no está
+    """
+    if isinstance(value, dict) and 'blob' in value and 'data' not in value:
+        if not has_blob(value['blob']):
+            raise BlobMissing(value['blob'])
+        _touch(blob_path(value['blob']))
+        image = dict(value)
+        image.setdefault('url', image_url(value['blob']))
+        return image
+    if isinstance(value, dict):
+        return {k: unpack_images(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [unpack_images(v) for v in value]
+    return value
+
+
+def sweep_blobs(max_age_seconds, shards):
+    """
+    Borra los blobs sin uso (ni escritos ni leídos) en los últimos max_age_seconds.
+
+    Un registro de caché nunca vive más que max_age_seconds, así que un blob
+    más viejo ya no está referenciado por ninguna entrada vigente.
+
+    Args:
+        max_age_seconds: Antigüedad mínima (por mtime) para borrar
+        shards: Subdirectorios a revisar ('00'..'ff'); permite barrer por partes
+
+    Returns:
+        tuple: (blobs borrados, bytes liberados)
+    """
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    freed = 0
+    for shard in shards:
+        shard_dir = os.path.join(BLOB_STORE_DIR, shard)
+        try:
+            entries = list(os.scandir(shard_dir))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            try:
+                stat = entry.stat()
+                if stat.st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+                    freed += stat.st_size
+            except OSError:
+                pass
+    return removed, freed
+
+
+def evict_blobs(max_bytes):
+    """
+    Expulsión LRU por tamaño: si el almacén supera max_bytes, borra los blobs
+    usados hace más tiempo (por mtime) hasta quedar dentro del límite.
+
+    Recorre todo el almacén (un stat por blob), así que el barrido lo llama
+    una vez por pasada, no en cada escritura.
+
+    Returns:
+        tuple: (blobs borrados, bytes liberados)
+    """
+    blobs = []
+    total = 0
+    try:
+        shards = [entry.path for entry in os.scandir(BLOB_STORE_DIR) if entry.is_dir()]
+    except FileNotFoundError:
+        return 0, 0
+    for shard_dir in shards:
+        try:
+            entries = list(os.scandir(shard_dir))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            # Los .tmp son escrituras en curso
+            if not is_valid_digest(entry.name):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+    removed = 0
+    freed = 0
+    if total <= max_bytes:
+        return removed, freed
+    blobs.sort()
+    for _, size, path in blobs:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+        freed += size
+    return removed, freed
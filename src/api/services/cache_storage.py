@@ -0,0 +1,513 @@
+"""
+Almacenamiento clave/valor para los checkpoints y la caché de resultados.
+
+Tres backends con la misma interfaz (get, has, set, update, delete,
+delete_many, delete_prefix, keys, purge_expired, stats):
+
+- MemoryLRUStorage: en memoria del proceso, LRU acotado por bytes.
+- SQLiteStorage: archivo SQLite en modo WAL compartido por todos los workers
+  del host; escrituras transaccionales y expulsión LRU acotada por bytes.
+- RedisStorage: cualquier servidor que hable el protocolo Redis, compartido
+  entre hosts. El TTL lo aplica el servidor (SET ... EX) y el límite de
+  tamaño su política `maxmemory` (allkeys-lru).
+
+Los valores son bytes; cada escritura es atómica (o se guarda entera o no se
+guarda), así una caída no deja entradas truncadas. update() es una
+lectura-modificación-escritura atómica también entre procesos y hosts
+(lock, BEGIN IMMEDIATE o WATCH/MULTI según el backend).
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'sqlite')
+CACHE_DB = os.getenv(
+    'CACHE_DB',
+    os.path.join(tempfile.gettempdir(), 'visagista_cache.sqlite3')
+)
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+# Tamaño máximo total de la caché (memoria y SQLite)
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+
+class MemoryLRUStorage:
+    """Entradas en memoria del proceso (compartidas solo entre hilos)"""
+
+    name = 'memory'
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._items = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= now:
+            self._remove(key)
+            return None
+        return item
+
+    def _remove(self, key):
+        value, _ = self._items.pop(key)
+        self.total_bytes -= len(value)
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key, time.time())
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def has(self, key):
+        with self._lock:
+            return self._live(key, time.time()) is not None
+
+    def _write(self, key, value, ttl, now):
+        if key in self._items:
+            self._remove(key)
+        if value is None or len(value) > self.max_bytes:
+            return
+        self._items[key] = (value, now + ttl if ttl else None)
+        self.total_bytes += len(value)
+        while self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self._items)))
+
+    def set(self, key, value, ttl=None):
+        # Un valor mayor que el límite no se guarda, pero borra el anterior
+        with self._lock:
+            self._write(key, value, ttl, time.time())
+
+    def update(self, key, fn, ttl=None):
+        """
+        Reemplaza el valor por fn(valor actual o None); si fn devuelve None
+        la entrada se borra. Devuelve el valor anterior.
+        """
+        now = time.time()
+        with self._lock:
+            item = self._live(key, now)
+            old = item[0] if item is not None else None
+            self._write(key, fn(old), ttl, now)
+            return old
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            matches = [key for key in self._items if key.startswith(prefix)]
+            for key in matches:
+                self._remove(key)
+            return len(matches)
+
+    def keys(self, prefix=''):
+        now = time.time()
+        with self._lock:
+            return [key for key in list(self._items)
+                    if key.startswith(prefix) and self._live(key, now) is not None]
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                if key in self._items:
+                    self._remove(key)
+
+    def purge_expired(self, limit=None):
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._items.items()
+                       if expires_at is not None and expires_at <= now]
+            for key in expired[:limit]:
+                self._remove(key)
+            return len(expired[:limit])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": self.name,
+                "entries": len(self._items),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+
+class SQLiteStorage:
+    """Entradas en un archivo SQLite (WAL) compartido por todos los workers del host"""
+
+    name = 'sqlite'
+
+    def __init__(self, path=CACHE_DB, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB, size INTEGER, "
+            "expires_at REAL, accessed_at REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires_at)")
+        # Total de bytes mantenido por triggers: comprobar el límite es O(1)
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+        conn.execute(
+            "INSERT OR IGNORE INTO meta (name, value) "
+            "SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM entries"
+        )
+        conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN "
+            "UPDATE meta SET value = value + NEW.size WHERE name = 'total_bytes'; END"
+        )
+        conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN "
+            "UPDATE meta SET value = value + NEW.size - OLD.size WHERE name = 'total_bytes'; END"
+        )
+        conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN "
+            "UPDATE meta SET value = value - OLD.size WHERE name = 'total_bytes'; END"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value FROM entries WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return bytes(row[0])
+
+    def has(self, key):
+        row = self._connection().execute(
+            "SELECT 1 FROM entries WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time())
+        ).fetchone()
+        return row is not None
+
+    def set(self, key, value, ttl=None):
+        if len(value) > self.max_bytes:
+            # No cabe: se descarta, pero sin dejar el valor anterior bajo la clave
+            self.delete(key)
+            return
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._write(conn, key, value, ttl, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def update(self, key, fn, ttl=None):
+        """
+        Reemplaza el valor por fn(valor actual o None); si fn devuelve None
+        la entrada se borra. Devuelve el valor anterior.
+        """
+        now = time.time()
+        conn = self._connection()
+        # BEGIN IMMEDIATE toma el lock de escritura antes de leer: ningún
+        # otro proceso puede intercalar su actualización
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM entries WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, now)
+            ).fetchone()
+            old = bytes(row[0]) if row is not None else None
+            value = fn(old)
+            if value is None or len(value) > self.max_bytes:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            else:
+                self._write(conn, key, value, ttl, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return old
+
+    def _write(self, conn, key, value, ttl, now):
+        conn.execute(
+            "INSERT INTO entries (key, value, size, expires_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+            "value = excluded.value, size = excluded.size, "
+            "expires_at = excluded.expires_at, accessed_at = excluded.accessed_at",
+            (key, sqlite3.Binary(value), len(value), now + ttl if ttl else None, now)
+        )
+        self._evict(conn, now)
+
+    def _total_bytes(self, conn):
+        row = conn.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()
+        return row[0] if row else 0
+
+    def _evict(self, conn, now):
+        """Si se supera el límite, borra expiradas y luego las menos usadas recientemente"""
+        total = self._total_bytes(conn)
+        if total <= self.max_bytes:
+            return
+        conn.execute(
+            "DELETE FROM entries WHERE key IN ("
+            "SELECT key FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?)",
+            (now,)
+        )
+        total = self._total_bytes(conn)
+        while total > self.max_bytes:
+            batch = conn.execute(
+                "SELECT key, size FROM entries ORDER BY accessed_at LIMIT 32"
+            ).fetchall()
+            if not batch:
+                break
+            for key, size in batch:
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if keys:
+            self._connection().executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in keys])
+
+    def delete_prefix(self, prefix):
+        cursor = self._connection().execute(
+            "DELETE FROM entries WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+        )
+        return cursor.rowcount
+
+    def keys(self, prefix=''):
+        rows = self._connection().execute(
+            "SELECT key FROM entries WHERE substr(key, 1, ?) = ? "
+            "AND (expires_at IS NULL OR expires_at > ?)",
+            (len(prefix), prefix, time.time())
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def purge_expired(self, limit=None):
+        cursor = self._connection().execute(
+            "DELETE FROM entries WHERE key IN ("
+            "SELECT key FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ? LIMIT ?)",
+            (time.time(), -1 if limit is None else limit)
+        )
+        return cursor.rowcount
+
+    def stats(self):
+        conn = self._connection()
+        entries = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        total = self._total_bytes(conn)
+        return {
+            "backend": self.name,
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes
+        }
+
+
+class RedisStorage:
+    """
+    Entradas en un servidor Redis (o compatible), compartidas entre hosts.
+
+    Junto a las entradas se mantienen, en el mismo servidor, el tamaño de
+    cada una (hash `__sizes`), el total de bytes (`__bytes`) y su expiración
+    (zset `__expiry`); cada escritura o borrado actualiza entrada y contadores
+    en una transacción (WATCH/MULTI sobre la clave), así stats() es O(1) en
+    lugar de recorrer todas las claves. Las que el servidor expira solo se
+    descuentan al pasar purge_expired().
+
+    Se le puede pasar un `client` ya creado con la API de redis-py, p. ej.
+    un servidor local de pruebas.
+    """
+
+    name = 'redis'
+
+    def __init__(self, url=CACHE_REDIS_URL, client=None, namespace='visagista:'):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("CACHE_BACKEND=redis requiere el paquete 'redis'")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.namespace = namespace
+        self._sizes = f"{namespace}__sizes"
+        self._bytes = f"{namespace}__bytes"
+        self._expiry = f"{namespace}__expiry"
+
+    def _key(self, key):
+        return f"{self.namespace}{key}"
+
+    def _pattern(self, prefix):
+        escaped = ''.join(f"\\{c}" if c in '*?[]\\' else c for c in self._key(prefix))
+        return f"{escaped}*"
+
+    def get(self, key):
+        return self.client.get(self._key(key))
+
+    def has(self, key):
+        return bool(self.client.exists(self._key(key)))
+
+    def _queue_set(self, pipe, full_key, value, ttl, old_size):
+        """Encola (tras multi()) la escritura de la entrada y sus contadores"""
+        ex = max(1, int(ttl)) if ttl else None
+        # SET con EX es atómico: valor y expiración se guardan juntos
+        pipe.set(full_key, value, ex=ex)
+        pipe.hset(self._sizes, full_key, len(value))
+        pipe.incrby(self._bytes, len(value) - old_size)
+        if ex:
+            pipe.zadd(self._expiry, {full_key: time.time() + ex})
+        else:
+            pipe.zrem(self._expiry, full_key)
+
+    def set(self, key, value, ttl=None):
+        full_key = self._key(key)
+
+        def write(pipe):
+            old_size = int(pipe.hget(self._sizes, full_key) or 0)
+            pipe.multi()
+            self._queue_set(pipe, full_key, value, ttl, old_size)
+
+        self.client.transaction(write, full_key)
+
+    def update(self, key, fn, ttl=None):
+        """
+        Reemplaza el valor por fn(valor actual o None); si fn devuelve None
+        la entrada se borra. Devuelve el valor anterior.
+
+        WATCH sobre la clave: si otro cliente la modifica entre la lectura y
+        el EXEC, la transacción se repite con el valor nuevo.
+        """
+        full_key = self._key(key)
+
+        def modify(pipe):
+            old = pipe.get(full_key)
+            old_size = int(pipe.hget(self._sizes, full_key) or 0)
+            value = fn(old)
+            pipe.multi()
+            if value is None:
+                pipe.delete(full_key)
+                pipe.hdel(self._sizes, full_key)
+                pipe.zrem(self._expiry, full_key)
+                pipe.incrby(self._bytes, -old_size)
+            else:
+                self._queue_set(pipe, full_key, value, ttl, old_size)
+            return old
+
+        return self.client.transaction(modify, full_key, value_from_callable=True)
+
+    def _delete_keys(self, full_keys, only_missing=False):
+        """
+        Borra las claves y descuenta su tamaño. Con only_missing solo
+        descuenta las que el servidor ya expiró. Devuelve cuántas descontó.
+        """
+        if not full_keys:
+            return 0
+
+        def remove(pipe):
+            sizes = pipe.hmget(self._sizes, full_keys)
+            gone = [(key, size) for key, size in zip(full_keys, sizes)
+                    if not only_missing or not pipe.exists(key)]
+            pipe.multi()
+            if gone:
+                if not only_missing:
+                    pipe.delete(*[key for key, _ in gone])
+                pipe.hdel(self._sizes, *[key for key, _ in gone])
+                pipe.zrem(self._expiry, *[key for key, _ in gone])
+                pipe.incrby(self._bytes, -sum(int(size or 0) for _, size in gone))
+            return len(gone)
+
+        return self.client.transaction(remove, *full_keys, value_from_callable=True)
+
+    def delete(self, key):
+        self._delete_keys([self._key(key)])
+
+    def delete_many(self, keys):
+        self._delete_keys([self._key(key) for key in keys])
+
+    def _scan(self, prefix):
+        """Claves de entradas con el prefijo (sin las de los contadores)"""
+        meta = {self._sizes, self._bytes, self._expiry}
+        keys = (key.decode() if isinstance(key, bytes) else key
+                for key in self.client.scan_iter(match=self._pattern(prefix)))
+        return [key for key in keys if key not in meta]
+
+    def delete_prefix(self, prefix):
+        matches = self._scan(prefix)
+        self._delete_keys(matches)
+        return len(matches)
+
+    def keys(self, prefix=''):
+        start = len(self.namespace)
+        return [key[start:] for key in self._scan(prefix)]
+
+    def purge_expired(self, limit=None):
+        # Redis ya borró las entradas vencidas; aquí solo se descuentan
+        expired = self.client.zrangebyscore(
+            self._expiry, '-inf', time.time(),
+            start=0 if limit is not None else None, num=limit
+        )
+        return self._delete_keys(
+            [key.decode() if isinstance(key, bytes) else key for key in expired],
+            only_missing=True
+        )
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "entries": self.client.hlen(self._sizes),
+            "bytes": int(self.client.get(self._bytes) or 0),
+            "max_bytes": None
+        }
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """
+    Backend configurado en CACHE_BACKEND (memory | sqlite | redis).
+    Si no se puede abrir, se usa memoria para no romper el análisis.
+    """
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            try:
+                if CACHE_BACKEND == 'redis':
+                    _storage = RedisStorage(CACHE_REDIS_URL)
+                elif CACHE_BACKEND == 'sqlite':
+                    _storage = SQLiteStorage(CACHE_DB)
+                else:
+                    _storage = MemoryLRUStorage()
+            except Exception as e:
+                print(f"[CACHE] No se pudo abrir el backend '{CACHE_BACKEND}', usando memoria: {e}")
+                _storage = MemoryLRUStorage()
+            print(f"[CACHE] Backend de caché: {_storage.name}")
+        return _storage
+
+
+def set_storage(storage):
+    """Reemplaza el backend en uso (p. ej. un RedisStorage con otro cliente)"""
+    global _storage
+    with _storage_lock:
+        _storage = storage
@@ -0,0 +1,143 @@
+"""
+Barrido periódico de la caché en segundo plano.
+
+Un hilo daemon borra, por lotes pequeños, las entradas expiradas del backend
+de caché (checkpoints, manifiestos de sesión y resultados), los trabajos de
+análisis terminados, los trackers de progreso abandonados y los blobs de
+imagen sin uso. Cada pasada revisa por antigüedad solo una parte del almacén
+de blobs; además, si el almacén supera BLOB_STORE_MAX_BYTES, expulsa los
+blobs usados hace más tiempo hasta volver al límite.
+"""
+import os
+import threading
+import time
+
+from .blob_store import BLOB_STORE_MAX_BYTES, evict_blobs, sweep_blobs
+from .cache_storage import get_storage
+from .checkpoint_cache import CACHE_TTL_HOURS, cleanup_expired
+from .event_buffer import get_replay_stats
+from .progress_tracker import evict_idle_trackers, get_tracker_store
+from .job_queue import purge_finished_jobs
+from .result_cache import RESULT_CACHE_TTL_HOURS
+
+CACHE_SWEEP_ENABLED = os.getenv('CACHE_SWEEP_ENABLED', 'true').lower() == 'true'
+CACHE_SWEEP_INTERVAL_SECONDS = float(os.getenv('CACHE_SWEEP_INTERVAL_SECONDS', 300))
+# Máximo de entradas expiradas a borrar por pasada
+CACHE_SWEEP_BATCH = int(os.getenv('CACHE_SWEEP_BATCH', 500))
+# Subdirectorios del almacén de blobs (de 256) revisados por pasada
+BLOB_SWEEP_SHARDS_PER_RUN = int(os.getenv('BLOB_SWEEP_SHARDS_PER_RUN', 16))
+# Un blob sin uso por más tiempo que el TTL más largo ya no lo referencia nadie
+BLOB_MAX_AGE_SECONDS = max(CACHE_TTL_HOURS, RESULT_CACHE_TTL_HOURS) * 3600
+
+_ALL_SHARDS = [f"{i:02x}" for i in range(256)]
+
+
+class CacheSweeper:
+    """Hilo de barrido con métricas acumuladas"""
+
+    def __init__(self, interval=CACHE_SWEEP_INTERVAL_SECONDS, batch=CACHE_SWEEP_BATCH,
+                 shards_per_run=BLOB_SWEEP_SHARDS_PER_RUN):
+        self.interval = interval
+        self.batch = batch
+        self.shards_per_run = shards_per_run
+        self._next_shard = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.metrics = {
+            "runs": 0,
+            "errors": 0,
+            "expired_entries_removed": 0,
+            "jobs_removed": 0,
+            "trackers_evicted": 0,
+            "blobs_removed": 0,
+            "blob_bytes_freed": 0,
+            "blobs_evicted": 0,
+            "last_run_at": None,
+            "last_run_ms": None,
+            "last_error": None
+        }
+
+    def run_once(self):
+        """Una pasada: un lote de entradas expiradas y una parte de los blobs"""
+        start = time.time()
+        try:
+            expired = cleanup_expired(limit=self.batch)
+            jobs = purge_finished_jobs(limit=self.batch)
+            trackers = evict_idle_trackers()
+
+            shards = [
+                _ALL_SHARDS[(self._next_shard + i) % len(_ALL_SHARDS)]
+                for i in range(self.shards_per_run)
+            ]
+            self._next_shard = (self._next_shard + self.shards_per_run) % len(_ALL_SHARDS)
+            blobs, freed = sweep_blobs(BLOB_MAX_AGE_SECONDS, shards)
+            evicted, evicted_bytes = evict_blobs(BLOB_STORE_MAX_BYTES)
+
+            with self._lock:
+                self.metrics["expired_entries_removed"] += expired
+                self.metrics["jobs_removed"] += jobs
+                self.metrics["trackers_evicted"] += trackers
+                self.metrics["blobs_removed"] += blobs
+                self.metrics["blob_bytes_freed"] += freed + evicted_bytes
+                self.metrics["blobs_evicted"] += evicted
+            if blobs:
+                print(f"[SWEEPER] Borrados {blobs} blobs sin uso ({freed} bytes)")
+            if evicted:
+                print(f"[SWEEPER] Almacén de blobs sobre el límite: expulsados {evicted} ({evicted_bytes} bytes)")
+        except Exception as e:
+            print(f"[SWEEPER] Error en barrido: {e}")
+            with self._lock:
+                self.metrics["errors"] += 1
+                self.metrics["last_error"] = str(e)
+        finally:
+            with self._lock:
+                self.metrics["runs"] += 1
+                self.metrics["last_run_at"] = start
+                self.metrics["last_run_ms"] = round((time.time() - start) * 1000, 1)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="cache-sweeper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.metrics)
+
+
+_sweeper = CacheSweeper()
+
+
+def start_cache_sweeper():
+    """Arranca el barrido en segundo plano (una vez por proceso)"""
+    if CACHE_SWEEP_ENABLED:
+        _sweeper.start()
+
+
+def get_cache_stats():
+    """
+    Estado de la caché para monitoreo.
+
+    Returns:
+        dict: {"storage": estadísticas del backend, "sweeper": métricas del barrido,
+               "replay": buffers de reenvío SSE, "trackers": store de progreso}
+    """
+    try:
+        storage_stats = get_storage().stats()
+    except Exception as e:
+        storage_stats = {"error": str(e)}
+    return {
+        "storage": storage_stats,
+        "sweeper": _sweeper.snapshot(),
+        "replay": get_replay_stats(),
+        "trackers": get_tracker_store().stats()
+    }
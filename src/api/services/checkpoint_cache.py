@@ -1,52 +1,90 @@
 """
 Módulo de Checkpoint Cache para Análisis de Gafas
 Guarda progreso de generación para poder resumir si falla
+
+Cada sesión tiene un manifiesto (sus checkpoints, cada uno con su
+expiración): el estado de una sesión y su limpieza cuestan una sola lectura,
+sin importar cuántas sesiones haya en la caché. Cada checkpoint nuevo renueva
+el TTL del manifiesto, pero no el de los anteriores: al leerlo se descartan
+los que ya expiraron.
 """
 
 import hashlib
 import json
 import os
-from datetime import datetime, timedelta
-
-# Directorio para almacenar checkpoints
-CACHE_DIR = os.path.join(os.path.dirname(__file__), '.cache')
-CACHE_TTL_HOURS = 1  # Tiempo de vida del caché en horas
-
+import time
 
-def _ensure_cache_dir():
-    """Crea el directorio de caché si no existe"""
-    if not os.path.exists(CACHE_DIR):
-        os.makedirs(CACHE_DIR)
-        print(f"[CACHE] Directorio de caché creado: {CACHE_DIR}")
+from .blob_store import BlobMissing, pack_images, unpack_images
+from .cache_storage import get_storage
 
+# Tiempo de vida de los checkpoints en horas
+CACHE_TTL_HOURS = float(os.getenv('CACHE_TTL_HOURS', 1))
+# Prefijo de las claves de checkpoints en el backend de caché
+CHECKPOINT_PREFIX = 'ckpt:'
+MANIFEST_PREFIX = 'manifest:'
 
-def get_session_id(selfie_url):
+def get_session_id(selfie_key):
     """
-    Genera un ID de sesión único basado en la URL de la selfie.
+    Genera un ID de sesión único basado en la selfie.
     La misma imagen siempre genera el mismo ID.
     
     Args:
-        selfie_url: URL de la selfie en Cloudinary
+        selfie_key: Identificador de la selfie (SHA-256 de su contenido,
+                    o la URL de Cloudinary)
     
     Returns:
         str: Hash MD5 truncado de 12 caracteres
     """
-    return hashlib.md5(selfie_url.encode()).hexdigest()[:12]
+    return hashlib.md5(selfie_key.encode()).hexdigest()[:12]
 
 
-def _get_cache_path(session_id, key):
-    """Genera la ruta del archivo de caché"""
-    return os.path.join(CACHE_DIR, f"{session_id}_{key}.json")
+def _storage_key(session_id, key):
+    """Genera la clave del checkpoint en el backend de caché"""
+    return f"{CHECKPOINT_PREFIX}{session_id}:{key}"
 
 
-def _is_expired(timestamp_str):
-    """Verifica si un timestamp ha expirado según el TTL"""
-    try:
-        cached_time = datetime.fromisoformat(timestamp_str)
-        expiry_time = cached_time + timedelta(hours=CACHE_TTL_HOURS)
-        return datetime.now() > expiry_time
-    except:
-        return True
+def _manifest_key(session_id):
+    return f"{MANIFEST_PREFIX}{session_id}"
+
+
+def _manifest_entries(raw):
+    """
+    {clave: expira_en} de un manifiesto guardado. Los del formato anterior
+    (lista de claves) no tienen expiración por entrada.
+    """
+    if raw is None:
+        return {}
+    entries = json.loads(raw)
+    if isinstance(entries, list):
+        return dict.fromkeys(entries)
+    return entries
+
+
+def _read_manifest(session_id):
+    """Claves de checkpoint de la sesión que aún no expiraron"""
+    now = time.time()
+    entries = _manifest_entries(get_storage().get(_manifest_key(session_id)))
+    return [key for key, expires_at in entries.items() if expires_at is None or expires_at > now]
+
+
+def _add_to_manifest(session_id, key, expires_at):
+    """
+    Registra un checkpoint (con su expiración) en el manifiesto, descarta los
+    ya expirados y renueva el TTL del manifiesto.
+    Es un update() atómico del backend: dos workers que guardan checkpoints
+    de la misma sesión a la vez no se pisan el manifiesto.
+    """
+    def add(raw):
+        now = time.time()
+        entries = {
+            other: other_expires_at
+            for other, other_expires_at in _manifest_entries(raw).items()
+            if other_expires_at is None or other_expires_at > now
+        }
+        entries[key] = expires_at
+        return json.dumps(entries).encode('utf-8')
+
+    get_storage().update(_manifest_key(session_id), add, ttl=CACHE_TTL_HOURS * 3600)
 
 
 def get_checkpoint(session_id, key):
@@ -54,31 +92,25 @@ def get_checkpoint(session_id, key):
     Recupera un checkpoint si existe y no ha expirado.
     
     Args:
-        session_id: ID de sesión (del hash de selfie URL)
+        session_id: ID de sesión (del hash de la selfie)
         key: Clave del checkpoint (ej: 'analysis', 'styles', 'img_on_face_0')
     
     Returns:
         El valor cacheado o None si no existe/expiró
     """
-    _ensure_cache_dir()
-    cache_path = _get_cache_path(session_id, key)
-    
-    if not os.path.exists(cache_path):
-        return None
-    
     try:
-        with open(cache_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        # Verificar expiración
-        if _is_expired(data.get('timestamp', '')):
-            print(f"[CACHE] Checkpoint expirado: {key}")
-            os.remove(cache_path)
+        raw = get_storage().get(_storage_key(session_id, key))
+        if raw is None:
             return None
         
+        data = json.loads(raw)
+        value = unpack_images(data.get('value'))
         print(f"[CACHE] ✓ Recuperado checkpoint: {key}")
-        return data.get('value')
+        return value
     
+    except BlobMissing:
+        print(f"[CACHE] Imagen del checkpoint {key} ya no está en el almacén")
+        return None
     except Exception as e:
         print(f"[CACHE] Error leyendo checkpoint {key}: {e}")
         return None
@@ -86,29 +118,31 @@ def get_checkpoint(session_id, key):
 
 def save_checkpoint(session_id, key, value):
     """
-    Guarda un checkpoint con timestamp.
+    Guarda un checkpoint con TTL.
     
     Args:
         session_id: ID de sesión
         key: Clave del checkpoint
-        value: Valor a guardar (debe ser serializable a JSON)
+        value: Valor a guardar (debe ser serializable a JSON). Las imágenes
+               con data URI se guardan como blob binario aparte
     
     Returns:
         bool: True si se guardó correctamente
     """
-    _ensure_cache_dir()
-    cache_path = _get_cache_path(session_id, key)
-    
     try:
         data = {
-            'timestamp': datetime.now().isoformat(),
             'session_id': session_id,
             'key': key,
-            'value': value
+            'value': pack_images(value)
         }
         
-        with open(cache_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False)
+        ttl = CACHE_TTL_HOURS * 3600
+        get_storage().set(
+            _storage_key(session_id, key),
+            json.dumps(data, ensure_ascii=False).encode('utf-8'),
+            ttl=ttl
+        )
+        _add_to_manifest(session_id, key, time.time() + ttl)
         
         print(f"[CACHE] ✓ Guardado checkpoint: {key}")
         return True
@@ -126,16 +160,15 @@ def clear_session(session_id):
     Args:
         session_id: ID de sesión a limpiar
     """
-    _ensure_cache_dir()
-    
-    deleted_count = 0
-    for filename in os.listdir(CACHE_DIR):
-        if filename.startswith(session_id):
-            try:
-                os.remove(os.path.join(CACHE_DIR, filename))
-                deleted_count += 1
-            except:
-                pass
+    try:
+        # Se retira el manifiesto de forma atómica y luego sus checkpoints
+        raw = get_storage().update(_manifest_key(session_id), lambda raw: None)
+        keys = list(_manifest_entries(raw))
+        get_storage().delete_many([_storage_key(session_id, key) for key in keys])
+        deleted_count = len(keys)
+    except Exception as e:
+        print(f"[CACHE] Error limpiando sesión {session_id}: {e}")
+        return
     
     if deleted_count > 0:
         print(f"[CACHE] Limpiados {deleted_count} checkpoints de sesión {session_id}")
@@ -151,8 +184,6 @@ def get_session_status(session_id):
     Returns:
         dict: Estado de cada tipo de checkpoint
     """
-    _ensure_cache_dir()
-    
     status = {
         'analysis': False,
         'styles': False,
@@ -164,35 +195,35 @@ def get_session_status(session_id):
         'img_product_1': False
     }
     
+    try:
+        existing = set(_read_manifest(session_id))
+    except Exception as e:
+        print(f"[CACHE] Error consultando sesión {session_id}: {e}")
+        return status
+    
     for key in status.keys():
-        cache_path = _get_cache_path(session_id, key)
-        if os.path.exists(cache_path):
-            cached = get_checkpoint(session_id, key)
-            status[key] = cached is not None
+        status[key] = key in existing
     
     return status
 
 
-def cleanup_expired():
-    """
-    Limpia todos los checkpoints expirados del directorio de caché.
-    Útil para mantenimiento periódico.
+def cleanup_expired(limit=None):
     """
-    _ensure_cache_dir()
+    Limpia checkpoints expirados del backend de caché.
+    El barrido en segundo plano (cache_sweeper) la llama por lotes.
+    
+    Args:
+        limit: Máximo de entradas a borrar en esta llamada (None = todas)
     
-    deleted_count = 0
-    for filename in os.listdir(CACHE_DIR):
-        if filename.endswith('.json'):
-            filepath = os.path.join(CACHE_DIR, filename)
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                if _is_expired(data.get('timestamp', '')):
-                    os.remove(filepath)
-                    deleted_count += 1
-            except:
-                pass
+    Returns:
+        int: Entradas borradas
+    """
+    try:
+        deleted_count = get_storage().purge_expired(limit=limit)
+    except Exception as e:
+        print(f"[CACHE] Error limpiando expirados: {e}")
+        return 0
     
     if deleted_count > 0:
         print(f"[CACHE] Limpiados {deleted_count} checkpoints expirados")
+    return deleted_count
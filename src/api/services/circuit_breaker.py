@@ -0,0 +1,166 @@
+"""
+Circuit breakers por modelo de Gemini.
+
+Durante un incidente del proveedor cada llamada espera su timeout completo o
+reintenta con backoff, y los workers se acumulan detrás de un servicio que no
+responde. Cada modelo tiene su breaker:
+
+- closed: las llamadas pasan; CIRCUIT_FAILURE_THRESHOLD fallos seguidos del
+  proveedor (transient o timeout) lo abren.
+- open: las llamadas fallan al instante con CircuitOpenError, sin tomar
+  cuota ni esperar, durante CIRCUIT_OPEN_SECONDS.
+- half_open: pasado ese tiempo se deja pasar una sola llamada de prueba; si
+  responde el breaker se cierra, si falla vuelve a abrirse.
+
+Un 429 no cuenta como fallo (lo maneja el limitador de tasa), y un bloqueo
+de seguridad o un request inválido tampoco: el proveedor respondió.
+
+El estado vive en cada proceso: cada worker abre su breaker tras sus propios
+fallos, sin coordinarse con los demás. Se consulta en /api/model-status.
+"""
+import os
+import threading
+import time
+
+from .gemini_errors import CircuitOpenError
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', 30))
+
+# Clases de error (gemini_errors) que indican un proveedor caído
+FAILURE_KINDS = {'transient', 'timeout'}
+# Resultados que no dicen nada de la salud del proveedor
+NEUTRAL_KINDS = {'rate_limited', 'cancelled'}
+
+
+class CircuitBreaker:
+    """Estado closed / open / half_open de un modelo"""
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, open_seconds=CIRCUIT_OPEN_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.metrics = {"opened": 0, "rejected": 0, "probes": 0}
+
+    def _cooldown_left(self):
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def _open(self):
+        self.state = 'open'
+        self._opened_at = time.monotonic()
+        self._probing = False
+        self.metrics["opened"] += 1
+        print(f"[CIRCUIT] {self.name}: abierto por {self.open_seconds:.0f}s")
+
+    def available(self):
+        """True si una llamada ahora pasaría (sin reservar la prueba)"""
+        with self._lock:
+            if self.state == 'open':
+                return self._cooldown_left() == 0
+            if self.state == 'half_open':
+                return not self._probing
+            return True
+
+    def allow(self):
+        """
+        Decide si una llamada puede salir. En half_open solo deja pasar la
+        llamada de prueba; quien recibe True debe reportar su resultado con record().
+        """
+        with self._lock:
+            if self.state == 'open' and self._cooldown_left() == 0:
+                self.state = 'half_open'
+                print(f"[CIRCUIT] {self.name}: half-open, probando el modelo")
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                self.metrics["probes"] += 1
+                return True
+            if self.state == 'closed':
+                return True
+            self.metrics["rejected"] += 1
+            return False
+
+    def record(self, kind=None):
+        """
+        Resultado de una llamada que allow() dejó pasar.
+
+        Args:
+            kind: Clase del error (gemini_errors), 'cancelled' o None si respondió
+        """
+        with self._lock:
+            if kind in NEUTRAL_KINDS:
+                self._probing = False
+                return
+            if kind in FAILURE_KINDS:
+                self._failures += 1
+                if self.state == 'half_open' or (self.state == 'closed' and self._failures >= self.failure_threshold):
+                    self._open()
+                return
+            self._failures = 0
+            if self.state == 'half_open':
+                print(f"[CIRCUIT] {self.name}: cerrado, el modelo responde")
+            self.state = 'closed'
+            self._probing = False
+
+    def retry_after(self):
+        """Segundos hasta la próxima prueba (0 si no está abierto)"""
+        with self._lock:
+            return round(self._cooldown_left(), 1) if self.state == 'open' else 0.0
+
+    def unavailable_error(self):
+        """CircuitOpenError para una llamada rechazada"""
+        return CircuitOpenError(
+            f"Modelo {self.name} no disponible temporalmente (circuito abierto)",
+            retry_after=self.retry_after()
+        )
+
+    def ensure_available(self):
+        """Lanza CircuitOpenError si una llamada ahora sería rechazada"""
+        if not self.available():
+            with self._lock:
+                self.metrics["rejected"] += 1
+            raise self.unavailable_error()
+
+    def status(self):
+        with self._lock:
+            state = self.state
+            if state == 'open' and self._cooldown_left() == 0:
+                state = 'half_open'
+            return {
+                **self.metrics,
+                "state": state,
+                "consecutive_failures": self._failures,
+                "retry_after": round(self._cooldown_left(), 1) if self.state == 'open' else 0.0,
+                "failure_threshold": self.failure_threshold,
+                "open_seconds": self.open_seconds
+            }
+
+
+_lock = threading.Lock()
+_breakers = {}
+
+
+def configure_breaker(name, **kwargs):
+    """Registra (o reemplaza) el breaker de un modelo"""
+    with _lock:
+        _breakers[name] = CircuitBreaker(name, **kwargs)
+        return _breakers[name]
+
+
+def get_breaker(name):
+    """Breaker del modelo (se crea con la configuración por defecto si no existe)"""
+    with _lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def get_breaker_states():
+    with _lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.status() for breaker in breakers}
@@ -4,9 +4,14 @@ Servicio para gestión de imágenes con Cloudinary
 import os
 import cloudinary
 import cloudinary.uploader
-import base64
 import uuid
 
+import urllib3
+
+from .http_transport import stage_timeout, track
+from .selfie_blob import SelfieBlob, decode_image_data, remember_selfie
+from .selfie_normalizer import normalize_selfie
+
 # Configurar Cloudinary desde CLOUDINARY_URL
 cloudinary.config(
     cloudinary_url=os.getenv('CLOUDINARY_URL')
@@ -17,39 +22,54 @@ def upload_selfie(image_data, filename=None):
     Sube una imagen a Cloudinary y retorna la URL pública
     
     Args:
-        image_data: Datos de la imagen (base64 string o file path)
+        image_data: Datos de la imagen (base64 string, file path, bytes o un
+                    archivo binario abierto, p. ej. la subida multipart)
         filename: Nombre base para el archivo (opcional)
     
     Returns:
-        dict: Información de la imagen subida incluyendo URL pública
+        dict: Información de la imagen subida incluyendo URL pública y el
+              SelfieBlob ("selfie") que deben recibir las etapas del análisis
     """
     try:
         # Generar nombre único si no se proporciona
         if filename is None:
             filename = f"selfie_{uuid.uuid4().hex[:8]}"
         
-        # Si es base64, preparar para upload
-        if isinstance(image_data, str) and image_data.startswith('data:image'):
-            # Ya está en formato data URI, Cloudinary lo acepta directamente
-            upload_data = image_data
-        elif isinstance(image_data, str) and not os.path.exists(image_data):
-            # Es base64 sin prefijo, agregar prefijo
-            upload_data = f"data:image/jpeg;base64,{image_data}"
+        # Decodificar una sola vez: estos bytes se suben y se reutilizan en todo el análisis
+        # (el tipo real lo detecta normalize_selfie a partir del contenido)
+        if isinstance(image_data, str) and (image_data.startswith('data:image') or not os.path.exists(image_data)):
+            image_bytes, _ = decode_image_data(image_data)
+        elif isinstance(image_data, str):
+            # Es una ruta de archivo
+            with open(image_data, 'rb') as f:
+                image_bytes = f.read()
         else:
-            upload_data = image_data
+            # bytes o archivo: la normalización lee directo del archivo
+            image_bytes = image_data
+        
+        # Imagen canónica (orientación, tamaño, tipo real): la misma para
+        # Cloudinary y para todas las llamadas a Gemini
+        image_bytes, mime_type = normalize_selfie(image_bytes)
+        
+        # Subir imagen a Cloudinary (binario, sin volver a codificar en base64)
+        connect, read = stage_timeout('cloudinary')
+        with track('cloudinary'):
+            upload_result = cloudinary.uploader.upload(
+                image_bytes,
+                folder="glasses-selfies",
+                public_id=filename,
+                overwrite=True,
+                resource_type="image",
+                timeout=urllib3.Timeout(connect=connect, read=read)
+            )
         
-        # Subir imagen a Cloudinary
-        upload_result = cloudinary.uploader.upload(
-            upload_data,
-            folder="glasses-selfies",
-            public_id=filename,
-            overwrite=True,
-            resource_type="image"
-        )
+        selfie = SelfieBlob(image_bytes, mime_type=mime_type, url=upload_result.get('secure_url'))
+        remember_selfie(selfie)
         
         return {
             "success": True,
             "url": upload_result.get('secure_url'),
+            "selfie": selfie,
             "public_id": upload_result.get('public_id'),
             "width": upload_result.get('width'),
             "height": upload_result.get('height')
@@ -71,7 +91,9 @@ def delete_selfie(public_id):
         dict: Resultado de la operación
     """
     try:
-        result = cloudinary.uploader.destroy(public_id)
+        connect, read = stage_timeout('cloudinary')
+        with track('cloudinary'):
+            result = cloudinary.uploader.destroy(public_id, timeout=urllib3.Timeout(connect=connect, read=read))
         return {
             "success": True,
             "result": result
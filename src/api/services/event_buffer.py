@@ -0,0 +1,248 @@
+"""
+Buffer de reenvío de eventos SSE por sesión (reconexión con Last-Event-ID).
+
+Cada evento de un análisis recibe un número de secuencia (el campo `id:` del
+SSE) y se guarda en un ring buffer de la sesión. Si la conexión se corta, el
+cliente vuelve a /api/analyze-progress/<session_id> con el header
+Last-Event-ID: se le reenvían los eventos que no recibió y luego sigue en
+vivo, sin repetir el análisis.
+
+Los buffers están acotados por número de eventos y bytes cada uno, y por
+bytes en total; un buffer terminado (o sin eventos nuevos) expira a los
+SSE_REPLAY_TTL_SECONDS. La expulsión es perezosa, al crear o buscar buffers.
+
+Un buffer puede registrarse con una flight_key (selfie + datos del usuario):
+mientras su análisis sigue abierto, un request idéntico se une a ese buffer
+y recibe los mismos eventos desde el principio, sin repetir el análisis.
+
+Con la cola de trabajos activa el log persistente de job_queue cumple este
+papel; el buffer cubre el modo de stream directo (JOB_QUEUE_ENABLED=false).
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+SSE_REPLAY_MAX_EVENTS = int(os.getenv('SSE_REPLAY_MAX_EVENTS', 256))
+SSE_REPLAY_MAX_BYTES = int(os.getenv('SSE_REPLAY_MAX_BYTES', 1024 * 1024))
+SSE_REPLAY_MAX_TOTAL_BYTES = int(os.getenv('SSE_REPLAY_MAX_TOTAL_BYTES', 64 * 1024 * 1024))
+SSE_REPLAY_TTL_SECONDS = float(os.getenv('SSE_REPLAY_TTL_SECONDS', 300))
+# Sin eventos durante este tiempo se envía un comentario keepalive
+SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', 15))
+
+
+class EventBuffer:
+    """Últimos eventos de una sesión, con número de secuencia"""
+
+    def __init__(self, session_id, max_events=SSE_REPLAY_MAX_EVENTS, max_bytes=SSE_REPLAY_MAX_BYTES,
+                 flight_key=None):
+        self.session_id = session_id
+        self.flight_key = flight_key
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.last_seq = 0
+        self.closed = False
+        self.subscribers = 0
+        self.updated_at = time.time()
+        # Momento en que se fue el último suscriptor
+        self.detached_at = self.updated_at
+        self._events = deque()  # (seq, evento, tamaño)
+        self._cond = threading.Condition()
+        self._listeners = set()
+
+    def append(self, event):
+        """
+        Agrega un evento y despierta a quienes esperan.
+
+        Returns:
+            int: número de secuencia asignado
+        """
+        size = len(json.dumps(event))
+        with self._cond:
+            self.last_seq += 1
+            self._events.append((self.last_seq, event, size))
+            self.bytes += size
+            while len(self._events) > 1 and (
+                len(self._events) > self.max_events or self.bytes > self.max_bytes
+            ):
+                self.bytes -= self._events.popleft()[2]
+            self.updated_at = time.time()
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+            seq = self.last_seq
+        for listener in listeners:
+            listener()
+        return seq
+
+    def close(self):
+        """El productor terminó: no habrá más eventos"""
+        with self._cond:
+            self.closed = True
+            self.updated_at = time.time()
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def events_after(self, after_seq):
+        """
+        Returns:
+            tuple: ([(seq, evento)] con seq > after_seq, missed). missed es
+                   True si parte de esos eventos ya salió del buffer.
+        """
+        with self._cond:
+            first_seq = self._events[0][0] if self._events else self.last_seq + 1
+            missed = after_seq + 1 < first_seq
+            return [(seq, event) for seq, event, _ in self._events if seq > after_seq], missed
+
+    def wait(self, after_seq, timeout):
+        """Bloquea hasta que haya eventos posteriores a after_seq, cierre o timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.last_seq > after_seq or self.closed, timeout)
+
+    def add_listener(self, callback):
+        """callback() se llama (sin argumentos, fuera del lock) en cada evento o cierre"""
+        with self._cond:
+            self._listeners.add(callback)
+
+    def remove_listener(self, callback):
+        with self._cond:
+            self._listeners.discard(callback)
+
+    def subscribe(self):
+        with self._cond:
+            self.subscribers += 1
+
+    def unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+            self.updated_at = time.time()
+            if self.subscribers == 0:
+                self.detached_at = self.updated_at
+
+
+class EventBufferRegistry:
+    """Buffers por session_id, acotados en bytes totales y con TTL"""
+
+    def __init__(self, max_total_bytes=SSE_REPLAY_MAX_TOTAL_BYTES, ttl=SSE_REPLAY_TTL_SECONDS):
+        self.max_total_bytes = max_total_bytes
+        self.ttl = ttl
+        self._buffers = OrderedDict()
+        # flight_key -> buffer de un análisis aún abierto
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.coalesced = 0
+
+    def join_or_create(self, flight_key):
+        """
+        Buffer abierto con esa flight_key, o uno nuevo registrado con ella.
+
+        Returns:
+            tuple: (buffer, created). Si created es False el análisis ya está
+                   en curso y el llamador solo debe seguir sus eventos.
+        """
+        with self._lock:
+            self._evict()
+            buffer = self._in_flight.get(flight_key)
+            if buffer is not None and not buffer.closed:
+                self.coalesced += 1
+                return buffer, False
+            buffer = EventBuffer(uuid.uuid4().hex, flight_key=flight_key)
+            self._buffers[buffer.session_id] = buffer
+            self._in_flight[flight_key] = buffer
+            return buffer, True
+
+    def get(self, session_id):
+        with self._lock:
+            self._evict()
+            return self._buffers.get(session_id)
+
+    def _evict(self):
+        """Expira buffers inactivos y, si se supera el total, los terminados más antiguos"""
+        now = time.time()
+        for flight_key, buffer in list(self._in_flight.items()):
+            if buffer.closed or buffer.session_id not in self._buffers:
+                del self._in_flight[flight_key]
+
+        for session_id, buffer in list(self._buffers.items()):
+            if buffer.subscribers == 0 and now - buffer.updated_at > self.ttl:
+                del self._buffers[session_id]
+                self.evictions += 1
+
+        total = sum(buffer.bytes for buffer in self._buffers.values())
+        for session_id, buffer in list(self._buffers.items()):
+            if total <= self.max_total_bytes:
+                break
+            if buffer.closed and buffer.subscribers == 0:
+                total -= buffer.bytes
+                del self._buffers[session_id]
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._buffers),
+                "bytes": sum(buffer.bytes for buffer in self._buffers.values()),
+                "max_bytes": self.max_total_bytes,
+                "evictions": self.evictions,
+                "in_flight": sum(not buffer.closed for buffer in self._in_flight.values()),
+                "coalesced": self.coalesced
+            }
+
+
+_registry = EventBufferRegistry()
+
+
+def join_or_create_event_buffer(flight_key):
+    return _registry.join_or_create(flight_key)
+
+
+def get_event_buffer(session_id):
+    return _registry.get(session_id)
+
+
+def get_replay_stats():
+    return _registry.stats()
+
+
+def follow_events(buffer, after_seq=0, heartbeat=SSE_HEARTBEAT_SECONDS):
+    """
+    Reenvía los eventos del buffer posteriores a after_seq y sigue los nuevos
+    hasta que el productor cierra.
+
+    Yields:
+        tuple: (seq, evento), o None tras `heartbeat` segundos sin eventos
+    """
+    buffer.subscribe()
+    try:
+        while True:
+            events, missed = buffer.events_after(after_seq)
+            if missed:
+                yield buffer.last_seq, {
+                    "type": "error",
+                    "error": "Se perdieron eventos del análisis, vuelve a intentarlo"
+                }
+                return
+            for seq, event in events:
+                yield seq, event
+                after_seq = seq
+            if events:
+                continue
+            if buffer.closed:
+                return
+            if not buffer.wait(after_seq, heartbeat):
+                yield None
+    finally:
+        buffer.unsubscribe()
+
+
+def parse_last_event_id(value):
+    """Valor del header Last-Event-ID como entero (0 si falta o es inválido)"""
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
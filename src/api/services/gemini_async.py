@@ -0,0 +1,434 @@
+"""
+Motor asíncrono del análisis con Gemini (client.aio).
+
+Misma lógica, prompts y checkpoints que gemini_service, pero cada etapa es una
+corrutina: un solo proceso puede atender muchos análisis a la vez porque las
+esperas de red no bloquean ningún hilo. Las operaciones que solo existen en
+versión síncrona (SDK de Cloudinary, SQLite, archivos de checkpoint) se
+delegan a hilos con asyncio.to_thread.
+"""
+import asyncio
+
+from google.genai import types
+
+from . import rate_limiter
+from .gemini_service import (
+    IMAGE_MODEL,
+    TEXT_MODEL,
+    PIPELINE_MAX_WORKERS,
+    ALL_FRAME_STYLES,
+    TEXT_ANALYSIS_PROMPT,
+    TEXT_RESULT_VERSION,
+    IMAGE_RESULT_VERSION,
+    gemini_stage,
+    with_stage_timeout,
+    build_style_selection_prompt,
+    parse_style_selection,
+    build_planning_prompt,
+    build_frame_plan_schema,
+    parse_frame_plan,
+    build_design_prompt,
+    extract_response_text,
+    extract_usage,
+    extract_image_result,
+    find_image_data,
+    attach_variant,
+    image_request,
+    label_image,
+    ImageCollector,
+    plan_image_retry,
+    record_image_success,
+    summarize_image_results
+)
+from .checkpoint_cache import get_session_id, get_checkpoint, save_checkpoint
+from .http_transport import get_genai_client, track
+from .hedging import image_hedge
+from .circuit_breaker import get_breaker
+from .model_files import selfie_part
+from .gemini_errors import GeminiError, classify_error, error_from_response, rephrase_prompt
+from .cloudinary_service import upload_selfie
+from .image_transcoder import submit_preview, submit_full
+from .result_cache import lookup_result_key, get_result, save_result
+from .selfie_blob import resolve_selfie_async
+
+
+async def upload_selfie_async(image_data, filename=None):
+    """Sube la selfie a Cloudinary sin bloquear el event loop (el SDK es síncrono)"""
+    return await asyncio.to_thread(upload_selfie, image_data, filename)
+
+
+async def generate_content_async(model, contents, config=None):
+    """
+    Versión asíncrona de gemini_service.generate_content: respeta el mismo
+    limitador de tasa compartido y el mismo circuit breaker, pero espera con
+    asyncio.sleep.
+    """
+    await admit_call_async(model)
+    return await _call_model_async(model, contents, config)
+
+
+async def admit_call_async(model):
+    """Versión asíncrona de admit_call: breaker primero, cuota después"""
+    breaker = get_breaker(model)
+    if not breaker.allow():
+        raise breaker.unavailable_error()
+    try:
+        await acquire_async(model)
+    except BaseException:
+        breaker.record('cancelled')
+        raise
+
+
+async def try_admit_call_async(model):
+    """Versión asíncrona de try_admit_call (sin esperar cuota)"""
+    breaker = get_breaker(model)
+    if not breaker.allow():
+        return False
+    if not await asyncio.to_thread(rate_limiter.try_reserve, model):
+        breaker.record('cancelled')
+        return False
+    return True
+
+
+async def acquire_async(model):
+    """Toma un token del limitador compartido esperando con asyncio.sleep"""
+    wait = await asyncio.to_thread(rate_limiter.reserve, model)
+    if wait > 0:
+        print(f"[RATE] Esperando {wait:.2f}s por cuota de {model}")
+        await asyncio.sleep(wait)
+
+
+async def _call_model_async(model, contents, config=None):
+    """Llamada a Gemini ya admitida por admit_call_async (alimenta el circuit breaker)"""
+    breaker = get_breaker(model)
+    stage = gemini_stage(model)
+    outcome = 'cancelled'
+    try:
+        with track(stage):
+            response = await get_genai_client().aio.models.generate_content(
+                model=model,
+                contents=contents,
+                config=with_stage_timeout(config, stage)
+            )
+        outcome = None
+        return response
+    except Exception as e:
+        error = classify_error(e)
+        outcome = error.kind
+        if error.kind == 'rate_limited':
+            await asyncio.to_thread(rate_limiter.report_rate_limited, model, error.retry_after)
+        raise error from e
+    finally:
+        breaker.record(outcome)
+
+
+async def select_best_frame_styles_async(selfie, all_styles):
+    """Versión asíncrona de select_best_frame_styles"""
+    try:
+        response = await generate_content_async(
+            model=TEXT_MODEL,
+            contents=[
+                build_style_selection_prompt(all_styles),
+                selfie_part(selfie)
+            ]
+        )
+        selection_text = extract_response_text(response)
+        print(f"[DEBUG] Respuesta de selección de IA: {selection_text.strip()}")
+
+        selected = parse_style_selection(selection_text, all_styles)
+        if selected:
+            print(f"[SUCCESS] IA seleccionó: {selected[0]['name']} y {selected[1]['name']}")
+            return selected
+
+        print("[WARN] No se pudo parsear selección, usando primeros 2 estilos por defecto")
+        return all_styles[:2]
+
+    except Exception as e:
+        print(f"[ERROR] Error en selección de estilos: {str(e)}")
+        print("[WARN] Usando primeros 2 estilos por defecto")
+        return all_styles[:2]
+
+
+async def plan_frames_async(selfie, all_styles):
+    """Versión asíncrona de plan_frames (selección + diseño en una llamada)"""
+    try:
+        response = await generate_content_async(
+            model=TEXT_MODEL,
+            contents=[
+                build_planning_prompt(all_styles),
+                selfie_part(selfie)
+            ],
+            config=types.GenerateContentConfig(
+                response_mime_type="application/json",
+                response_schema=build_frame_plan_schema(all_styles)
+            )
+        )
+
+        plan = parse_frame_plan(extract_response_text(response), all_styles)
+        if not plan:
+            print("[WARN] Respuesta de planificación inválida, usando flujo por etapas")
+            return None
+
+        print(f"[SUCCESS] IA planificó: {plan['styles'][0]['name']} y {plan['styles'][1]['name']}")
+        return plan
+
+    except Exception as e:
+        print(f"[ERROR] Error en planificación de estilos: {str(e)}")
+        return None
+
+
+async def design_glasses_specifications_async(selfie, frame_style_info):
+    """Versión asíncrona de design_glasses_specifications"""
+    try:
+        response = await generate_content_async(
+            model=TEXT_MODEL,
+            contents=[
+                build_design_prompt(frame_style_info),
+                selfie_part(selfie)
+            ]
+        )
+        description = extract_response_text(response).strip()
+        print(f"[DEBUG] Diseño creado: {description[:100]}...")
+        return description
+
+    except Exception as e:
+        print(f"[ERROR] Error diseñando especificaciones: {str(e)}")
+        return f"{frame_style_info['style']} eyeglasses with professional finish"
+
+
+async def generate_single_image_async(selfie, prompt, image_type, frame_style):
+    """Versión asíncrona de generate_single_image (sin reintentos; lanza GeminiError)"""
+    try:
+        if image_type == 'on_face' and selfie is not None:
+            contents = [prompt, selfie_part(selfie)]
+        else:
+            contents = [prompt]
+
+        config = types.GenerateContentConfig(response_modalities=["IMAGE"])
+
+        async def call():
+            # Solo se valida; se guarda la imagen de la llamada ganadora
+            response = await _call_model_async(IMAGE_MODEL, contents, config)
+            if find_image_data(response) is None:
+                raise error_from_response(response, f"No se generó imagen {image_type} para {frame_style}")
+            return response
+
+        await admit_call_async(IMAGE_MODEL)
+        response = await image_hedge.run_async(call, reserve_quota=lambda: try_admit_call_async(IMAGE_MODEL))
+        # store_image escribe en disco: fuera del event loop
+        return await asyncio.to_thread(extract_image_result, response, image_type, frame_style)
+
+    except Exception as e:
+        error = classify_error(e)
+        print(f"[ERROR] Error generando imagen {image_type} {frame_style} ({error.kind}): {error}")
+        if error is e:
+            raise
+        raise error from e
+
+
+async def generate_single_image_with_retry_async(selfie, prompt, image_type, frame_style, max_retries=3):
+    """Versión asíncrona de generate_single_image_with_retry (misma política por clase de error)"""
+    failures = {}
+    for attempt in range(max_retries):
+        try:
+            result = await generate_single_image_async(selfie, prompt, image_type, frame_style)
+        except GeminiError as e:
+            decision = plan_image_retry(e, failures, attempt, max_retries, image_type, frame_style)
+            if decision is None:
+                return None
+            wait_time, rephrase = decision
+            if rephrase:
+                prompt = rephrase_prompt(prompt)
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            continue
+
+        record_image_success(failures, attempt, max_retries, image_type, frame_style)
+        return result
+
+    return None
+
+
+async def generate_glasses_images_async(selfie, user_data, on_image_generated=None, on_image_upgraded=None):
+    """
+    Versión asíncrona de generate_glasses_images.
+
+    Mismo grafo de etapas (specs por montura -> rostro || producto), mismas
+    claves de checkpoint y mismos pasos compartidos (image_request,
+    label_image, ImageCollector), con la concurrencia acotada por un semáforo.
+    Todo lo que toca disco o CPU por un rato (checkpoints, caché, blobs, el
+    hash de la selfie) corre en hilos con asyncio.to_thread.
+    """
+    collector = ImageCollector(on_image_generated, on_image_upgraded)
+
+    try:
+        print(f"[DEBUG] Iniciando generación asíncrona de imágenes con modelo: {IMAGE_MODEL}")
+
+        selfie = await resolve_selfie_async(selfie)
+
+        session_id = get_session_id(await asyncio.to_thread(lambda: selfie.digest))
+        print(f"[CHECKPOINT] Session ID: {session_id}")
+
+        result_key = await asyncio.to_thread(lookup_result_key, selfie, IMAGE_RESULT_VERSION)
+        cached_result = await asyncio.to_thread(get_result, result_key)
+        if cached_result and len(cached_result.get('images', [])) == 4:
+            print("[RESULT CACHE] ✓ Imágenes ya generadas para esta selfie, sin llamar a Gemini")
+            collector.replay(cached_result['images'])
+            result = await asyncio.to_thread(
+                summarize_image_results, collector.images, cached_result['styles'], collector.usage, session_id
+            )
+            result["cached"] = True
+            return result
+
+        # Modelo de imágenes caído: el análisis sigue solo con texto
+        get_breaker(IMAGE_MODEL).ensure_available()
+
+        semaphore = asyncio.Semaphore(PIPELINE_MAX_WORKERS)
+
+        planned_specs = {}
+        cached_styles = await asyncio.to_thread(get_checkpoint, session_id, 'styles')
+        if cached_styles:
+            print("[CHECKPOINT] ✓ Usando estilos cacheados")
+            frame_styles = cached_styles
+        else:
+            async with semaphore:
+                plan = await plan_frames_async(selfie, ALL_FRAME_STYLES)
+            if plan:
+                frame_styles = plan['styles']
+                for idx, detailed_specs in enumerate(plan['specs']):
+                    planned_specs[idx] = detailed_specs
+                    await asyncio.to_thread(save_checkpoint, session_id, f"specs_{idx}", detailed_specs)
+            else:
+                async with semaphore:
+                    frame_styles = await select_best_frame_styles_async(selfie, ALL_FRAME_STYLES)
+            await asyncio.to_thread(save_checkpoint, session_id, 'styles', frame_styles)
+
+        async def specs_stage(idx, frame):
+            if idx in planned_specs:
+                return planned_specs[idx]
+
+            specs_key = f"specs_{idx}"
+            cached_specs = await asyncio.to_thread(get_checkpoint, session_id, specs_key)
+            if cached_specs:
+                print(f"[CHECKPOINT] ✓ Usando especificaciones cacheadas para {frame['name']}")
+                return cached_specs
+
+            async with semaphore:
+                detailed_specs = await design_glasses_specifications_async(selfie, frame)
+            await asyncio.to_thread(save_checkpoint, session_id, specs_key, detailed_specs)
+            return detailed_specs
+
+        async def render_stage(idx, frame, image_type, detailed_specs):
+            cache_key = f"img_{image_type}_{idx}"
+            result = await asyncio.to_thread(get_checkpoint, session_id, cache_key)
+            if result:
+                print(f"[CHECKPOINT] ✓ Usando imagen {image_type} cacheada para {frame['name']}")
+            else:
+                prompt, image_selfie = image_request(selfie, image_type, detailed_specs)
+                async with semaphore:
+                    result = await generate_single_image_with_retry_async(
+                        image_selfie, prompt, image_type, frame['id'], max_retries=3
+                    )
+
+                if result:
+                    await asyncio.to_thread(
+                        save_checkpoint, session_id, cache_key, label_image(result, frame, detailed_specs)
+                    )
+
+            if not result:
+                collector.deliver(result, frame, image_type)
+                return
+
+            # Preview liviano primero; la versión completa se anuncia después
+            preview = await asyncio.wrap_future(submit_preview(result))
+            attach_variant(result, 'preview_url', preview)
+            index = collector.deliver(result, frame, image_type)
+
+            collector.upgrade(result, index, await asyncio.wrap_future(submit_full(result)))
+
+        frame_specs = {}
+
+        async def frame_pipeline(idx, frame):
+            detailed_specs = await specs_stage(idx, frame)
+            frame_specs[idx] = detailed_specs
+            await asyncio.gather(
+                render_stage(idx, frame, 'on_face', detailed_specs),
+                render_stage(idx, frame, 'product', detailed_specs)
+            )
+
+        outcomes = await asyncio.gather(
+            *(frame_pipeline(idx, frame) for idx, frame in enumerate(frame_styles)),
+            return_exceptions=True
+        )
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                print(f"[ERROR] Error en etapa asíncrona: {str(outcome)}")
+
+        result = await asyncio.to_thread(
+            summarize_image_results, collector.images, frame_styles, collector.usage, session_id
+        )
+        if result["success"]:
+            await asyncio.to_thread(save_result, result_key, {
+                "styles": frame_styles,
+                "specs": [frame_specs.get(idx) for idx in range(len(frame_styles))],
+                "images": result["images"]
+            }, selfie)
+        return result
+
+    except Exception as e:
+        import traceback
+        print(f"[ERROR] Error generando imágenes: {str(e)}")
+        print(f"[ERROR] Traceback: {traceback.format_exc()}")
+        return {
+            "success": False,
+            "error": str(e),
+            "images": collector.images,
+            "usage": collector.usage
+        }
+
+
+async def generate_text_analysis_async(selfie, user_data):
+    """Versión asíncrona de generate_text_analysis"""
+    try:
+        print(f"[DEBUG] Iniciando análisis de texto asíncrono con modelo: {TEXT_MODEL}")
+        selfie = await resolve_selfie_async(selfie)
+
+        result_key = await asyncio.to_thread(lookup_result_key, selfie, TEXT_RESULT_VERSION)
+        cached_result = await asyncio.to_thread(get_result, result_key)
+        if cached_result:
+            print("[RESULT CACHE] ✓ Análisis de texto ya generado para esta selfie")
+            return {
+                "success": True,
+                "analysis": cached_result["analysis"],
+                "usage": None,
+                "cached": True
+            }
+
+        # Referencia al archivo si la generación de imágenes ya lo subió
+        response = await generate_content_async(
+            model=TEXT_MODEL,
+            contents=[TEXT_ANALYSIS_PROMPT, selfie_part(selfie)]
+        )
+
+        usage_metadata = extract_usage(response)
+        text_response = extract_response_text(response)
+        print(f"[DEBUG] Análisis de texto completado, longitud: {len(text_response)} chars")
+
+        if text_response:
+            await asyncio.to_thread(save_result, result_key, {"analysis": text_response}, selfie)
+
+        return {
+            "success": True,
+            "analysis": text_response,
+            "usage": usage_metadata
+        }
+
+    except Exception as e:
+        import traceback
+        print(f"[ERROR] Error generando análisis de texto: {str(e)}")
+        print(f"[ERROR] Traceback: {traceback.format_exc()}")
+        return {
+            "success": False,
+            "error": str(e),
+            "usage": None
+        }
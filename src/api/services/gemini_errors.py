@@ -0,0 +1,187 @@
+"""
+Errores tipados de las llamadas a Gemini y su política de reintentos.
+
+Cada fallo se clasifica en una de seis clases, y cada clase se reintenta a
+su manera:
+
+- rate_limited (429): se reintenta sin espera propia; el bucket compartido
+  ya quedó pausado el tiempo que pidió el servidor y la próxima reserva de
+  cuota espera lo necesario.
+- transient (5xx, conexión cortada, respuesta sin imagen): backoff con
+  jitter.
+- timeout: backoff con jitter, un solo reintento (cada timeout ya costó
+  el tiempo completo de la etapa).
+- blocked (filtro de seguridad): un reintento con el prompt reforzado
+  (SAFE_PROMPT_SUFFIX); repetir el mismo prompt daría el mismo bloqueo.
+- invalid (4xx: prompt o parámetros inválidos, clave o modelo inexistente):
+  falla de inmediato.
+- unavailable: el circuit breaker del modelo está abierto (ver
+  circuit_breaker); falla de inmediato sin llamar a Gemini.
+
+Los contadores por clase (errores, reintentos, recuperados, abandonados) se
+ven en /api/transport-stats.
+"""
+import asyncio
+import threading
+from collections import namedtuple
+
+import httpx
+import requests
+
+from . import rate_limiter
+
+# action: 'fail' | 'backoff' | 'wait_quota' | 'rephrase'
+RetryPolicy = namedtuple('RetryPolicy', ['action', 'max_attempts'])
+
+RETRY_POLICIES = {
+    'rate_limited': RetryPolicy('wait_quota', 3),
+    'transient': RetryPolicy('backoff', 3),
+    'timeout': RetryPolicy('backoff', 2),
+    'blocked': RetryPolicy('rephrase', 2),
+    'invalid': RetryPolicy('fail', 1),
+    'unavailable': RetryPolicy('fail', 1),
+}
+
+# Se agrega al prompt de imagen tras un bloqueo de seguridad
+SAFE_PROMPT_SUFFIX = (
+    "\n\nThis is a neutral, professional eyewear product visualization for an optical store. "
+    "Keep the person's appearance exactly as in the photo, fully clothed, natural expression. "
+    "No text, logos, brands or watermarks."
+)
+
+_BLOCKED_FINISH_REASONS = {
+    'SAFETY', 'IMAGE_SAFETY', 'PROHIBITED_CONTENT', 'IMAGE_PROHIBITED_CONTENT',
+    'BLOCKLIST', 'SPII', 'RECITATION', 'IMAGE_RECITATION'
+}
+_TIMEOUT_STATUSES = {408, 504}
+
+
+class GeminiError(Exception):
+    """Fallo de una llamada a Gemini; `kind` indica su clase"""
+    kind = 'transient'
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimitedError(GeminiError):
+    kind = 'rate_limited'
+
+
+class TransientError(GeminiError):
+    kind = 'transient'
+
+
+class GeminiTimeoutError(GeminiError):
+    kind = 'timeout'
+
+
+class BlockedError(GeminiError):
+    kind = 'blocked'
+
+
+class InvalidRequestError(GeminiError):
+    kind = 'invalid'
+
+
+class CircuitOpenError(GeminiError):
+    kind = 'unavailable'
+
+
+def _status_code(error):
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        return code
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def classify_error(error):
+    """
+    Convierte cualquier excepción de una llamada a Gemini en su GeminiError.
+    Lo que no se reconoce se trata como transitorio (el comportamiento previo).
+    """
+    if isinstance(error, GeminiError):
+        return error
+    message = str(error) or type(error).__name__
+    if rate_limiter.is_rate_limit_error(error):
+        return RateLimitedError(message, retry_after=rate_limiter.parse_retry_after(error))
+
+    status = _status_code(error)
+    if isinstance(error, (httpx.TimeoutException, requests.exceptions.Timeout,
+                          asyncio.TimeoutError, TimeoutError)) \
+            or status in _TIMEOUT_STATUSES or 'DEADLINE_EXCEEDED' in message:
+        return GeminiTimeoutError(message)
+    if status is not None and 400 <= status < 500:
+        return InvalidRequestError(message)
+    if isinstance(error, (ValueError, TypeError)) and status is None:
+        # El SDK valida contenidos y config antes de enviarlos
+        return InvalidRequestError(message)
+    return TransientError(message)
+
+
+def _reason_name(reason):
+    return getattr(reason, 'name', None) or (str(reason) if reason else None)
+
+
+def error_from_response(response, message):
+    """
+    Error para una respuesta sin el contenido esperado: BlockedError si la
+    bloqueó un filtro de seguridad, TransientError si no.
+    """
+    feedback = getattr(response, 'prompt_feedback', None)
+    block_reason = _reason_name(getattr(feedback, 'block_reason', None))
+    if block_reason:
+        return BlockedError(f"{message} (bloqueado: {block_reason})")
+    for candidate in getattr(response, 'candidates', None) or []:
+        finish_reason = _reason_name(getattr(candidate, 'finish_reason', None))
+        if finish_reason in _BLOCKED_FINISH_REASONS:
+            return BlockedError(f"{message} (bloqueado: {finish_reason})")
+    return TransientError(message)
+
+
+def next_retry(error, kind_attempts, attempt):
+    """
+    Decide si se reintenta tras un error.
+
+    Args:
+        error: GeminiError
+        kind_attempts: Intentos que ya fallaron con esta misma clase de error
+        attempt: Intentos fallidos en total (0 para el primero), para el backoff
+
+    Returns:
+        tuple: (segundos de espera, reforzar el prompt) o None si no se reintenta
+    """
+    policy = RETRY_POLICIES[error.kind]
+    if policy.action == 'fail' or kind_attempts >= policy.max_attempts:
+        return None
+    if policy.action == 'wait_quota':
+        return 0.0, False
+    if policy.action == 'rephrase':
+        return 0.0, True
+    return rate_limiter.full_jitter_backoff(attempt), False
+
+
+def rephrase_prompt(prompt):
+    """Prompt reforzado para reintentar tras un bloqueo (sin repetir el sufijo)"""
+    return prompt if prompt.endswith(SAFE_PROMPT_SUFFIX) else prompt + SAFE_PROMPT_SUFFIX
+
+
+_lock = threading.Lock()
+_outcomes = {kind: {"errors": 0, "retries": 0, "recovered": 0, "gave_up": 0} for kind in RETRY_POLICIES}
+
+
+def record_outcome(kind, outcome):
+    """Cuenta un evento (errors, retries, recovered, gave_up) de una clase de error"""
+    with _lock:
+        _outcomes[kind][outcome] += 1
+
+
+def get_error_stats():
+    with _lock:
+        return {
+            kind: {**counts, "policy": RETRY_POLICIES[kind].action,
+                   "max_attempts": RETRY_POLICIES[kind].max_attempts}
+            for kind, counts in _outcomes.items()
+        }
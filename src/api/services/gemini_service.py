@@ -7,8 +7,10 @@ Modelos:
 Usa el SDK google-genai con Vertex AI
 """
 import os
-import base64
-import requests
+import json
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from threading import Lock
 
 # Importar sistema de checkpoints
 from .checkpoint_cache import (
@@ -18,19 +20,54 @@ from .checkpoint_cache import (
     clear_session,
     get_session_status
 )
+from .result_cache import result_version, lookup_result_key, get_result, save_result
+from .stage_graph import StageGraph
+from .blob_store import store_image
+from .image_transcoder import submit_preview, submit_full
+from . import rate_limiter
+from .selfie_blob import resolve_selfie
+from .http_transport import get_genai_client, stage_timeout, track
+from .hedging import image_hedge
+from .circuit_breaker import configure_breaker, get_breaker
+from .model_files import selfie_part, selfie_session
+from .gemini_errors import (
+    GeminiError,
+    classify_error,
+    error_from_response,
+    next_retry,
+    record_outcome,
+    rephrase_prompt
+)
 
-from google import genai
 from google.genai import types
 
-# Configurar cliente con API Key (más simple que Vertex AI)
-# Solo requiere: GOOGLE_API_KEY en .env
-# Los modelos gemini-2.5-flash-* funcionan igual con API Key
-client = genai.Client(api_key=os.getenv('GOOGLE_API_KEY'))
+# El cliente de Gemini (API Key: GOOGLE_API_KEY en .env) lo crea http_transport
+# al primer uso, sobre su pool de conexiones
 
 # Modelos a utilizar
 IMAGE_MODEL = "gemini-2.5-flash-image"
 TEXT_MODEL = "gemini-2.5-flash"
 
+# Máximo de llamadas simultáneas a Gemini dentro de un mismo análisis
+PIPELINE_MAX_WORKERS = int(os.getenv('PIPELINE_MAX_WORKERS', 4))
+
+# Cuota por modelo (compartida entre hilos y workers): llamadas/minuto y ráfaga
+rate_limiter.configure_bucket(
+    IMAGE_MODEL,
+    requests_per_minute=float(os.getenv('IMAGE_MODEL_RPM', 20)),
+    burst=int(os.getenv('IMAGE_MODEL_BURST', 4))
+)
+rate_limiter.configure_bucket(
+    TEXT_MODEL,
+    requests_per_minute=float(os.getenv('TEXT_MODEL_RPM', 60)),
+    burst=int(os.getenv('TEXT_MODEL_BURST', 6))
+)
+
+# Circuit breaker por modelo: durante un incidente del proveedor las llamadas
+# fallan al instante y el análisis sigue en modo degradado
+configure_breaker(IMAGE_MODEL)
+configure_breaker(TEXT_MODEL)
+
 # Prompt ADAPTATIVO para generar imagen de la MONTURA EN EL ROSTRO de la persona
 # Ahora incluye especificaciones detalladas para garantizar consistencia
 GLASSES_ON_FACE_PROMPT = """
@@ -116,6 +153,72 @@ Generate EXACTLY ONE image.
 """
 
 
+# Catálogo completo: 10 estilos de monturas
+# La IA analizará el rostro y elegirá los 2 MEJORES estilos de estos 10
+ALL_FRAME_STYLES = [
+    {
+        "id": "classic_rectangular",
+        "name": "Rectangular Metálico",
+        "style": "rectangular metal",
+        "description": "Montura rectangular con armazón metálico, estilo profesional y elegante. Ideal para rostros redondos u ovalados."
+    },
+    {
+        "id": "modern_round",
+        "name": "Redondo de Acetato", 
+        "style": "round acetate",
+        "description": "Montura circular de acetato, estética retro-moderna. Perfecta para rostros cuadrados o angulares."
+    },
+    {
+        "id": "aviator_metal",
+        "name": "Aviador Metálico",
+        "style": "aviator metal",
+        "description": "Montura aviador clásica con puente doble y lentes en forma de lágrima invertida. Icónica y atemporal, favorece rostros cuadrados y rectangulares."
+    },
+    {
+        "id": "cat_eye_acetate",
+        "name": "Cat-Eye de Acetato",
+        "style": "cat-eye acetate",
+        "description": "Montura con esquinas superiores elevadas tipo ojo de gato. Femenina y vintage, ideal para rostros redondos, añade ángulos y sofisticación."
+    },
+    {
+        "id": "wayfarer_acetate",
+        "name": "Wayfarer de Acetato",
+        "style": "wayfarer acetate",
+        "description": "Montura trapezoidal clásica de acetato grueso. Versátil y urbana, favorece rostros ovalados, redondos y en forma de corazón."
+    },
+    {
+        "id": "oversized_square",
+        "name": "Cuadrado Oversized",
+        "style": "oversized square acetate",
+        "description": "Montura cuadrada de gran tamaño con armazón acetato. Moderna y statement, ideal para rostros pequeños o delicados que buscan impacto."
+    },
+    {
+        "id": "browline_combo",
+        "name": "Browline Combinado",
+        "style": "browline combination",
+        "description": "Montura con borde superior grueso (acetato/metal) y borde inferior delgado o sin marco. Retro-intelectual, favorece rostros ovalados y triangulares."
+    },
+    {
+        "id": "geometric_angular",
+        "name": "Geométrico Angular",
+        "style": "geometric angular",
+        "description": "Montura con formas octagonales o hexagonales. Vanguardista y artística, ideal para rostros redondos u ovalados que buscan contraste angular."
+    },
+    {
+        "id": "semi_rimless",
+        "name": "Semi-Rimless Minimalista",
+        "style": "semi-rimless metal",
+        "description": "Montura con marco solo en la parte superior, lentes sujetas por nylon transparente. Ligera y discreta, favorece cualquier rostro, especialmente profesionales."
+    },
+    {
+        "id": "sport_wrap",
+        "name": "Deportivo Wraparound",
+        "style": "sport wraparound",
+        "description": "Montura curva que envuelve el rostro, estilo deportivo moderno. Dinámico y juvenil, ideal para rostros angulares y activos."
+    }
+]
+
+
 TEXT_ANALYSIS_PROMPT = """
 Eres un estilista óptico que ayuda a clientes a elegir sus gafas perfectas.
 
@@ -155,6 +258,173 @@ Un consejo práctico de compra en 1 oración.
 Responde en español, amigable y listo para que el cliente tome una decisión de compra rápida.
 """
 
+# Subir al cambiar los prompts que se arman en funciones (selección, diseño, planificación)
+PROMPT_REVISION = 2
+
+# Versiones de la caché de resultados por contenido: cambian con modelos y prompts
+TEXT_RESULT_VERSION = result_version(PROMPT_REVISION, TEXT_MODEL, TEXT_ANALYSIS_PROMPT)
+IMAGE_RESULT_VERSION = result_version(
+    PROMPT_REVISION, TEXT_MODEL, IMAGE_MODEL,
+    GLASSES_ON_FACE_PROMPT, GLASSES_PRODUCT_PROMPT, ALL_FRAME_STYLES
+)
+
+
+def gemini_stage(model):
+    """Etapa de transporte (timeouts y métricas) de un modelo"""
+    return 'gemini_image' if model == IMAGE_MODEL else 'gemini_text'
+
+
+def with_stage_timeout(config, stage):
+    """Config de la llamada con el timeout de la etapa (si no trae uno propio)"""
+    _, read = stage_timeout(stage)
+    http_options = types.HttpOptions(timeout=int(read * 1000))
+    if config is None:
+        return types.GenerateContentConfig(http_options=http_options)
+    if config.http_options is not None:
+        return config
+    return config.model_copy(update={"http_options": http_options})
+
+
+def generate_content(model, contents, config=None):
+    """
+    Llamada a Gemini pasando por el limitador de tasa del modelo.
+    Si el servidor responde 429, pausa el bucket compartido el tiempo que indique.
+    Con el circuito del modelo abierto falla al instante, sin tomar cuota.
+    """
+    admit_call(model)
+    return _call_model(model, contents, config)
+
+
+def admit_call(model):
+    """
+    Pasa primero por el circuit breaker del modelo y después toma el token
+    de cuota: una llamada rechazada por el circuito no gasta cuota. Quien
+    entra debe hacer la llamada con _call_model, que reporta su resultado.
+
+    Raises:
+        CircuitOpenError: el circuito no deja pasar la llamada
+        RateLimitTimeout: no hubo cuota a tiempo
+    """
+    breaker = get_breaker(model)
+    if not breaker.allow():
+        raise breaker.unavailable_error()
+    try:
+        rate_limiter.acquire(model)
+    except BaseException:
+        # La llamada no sale: libera la prueba de half-open si la tenía
+        breaker.record('cancelled')
+        raise
+
+
+def try_admit_call(model):
+    """Como admit_call pero sin esperar cuota; retorna False si no pasa"""
+    breaker = get_breaker(model)
+    if not breaker.allow():
+        return False
+    if not rate_limiter.try_reserve(model):
+        breaker.record('cancelled')
+        return False
+    return True
+
+
+def _call_model(model, contents, config=None):
+    """
+    Llamada a Gemini ya admitida por admit_call (breaker y cuota). Su
+    resultado alimenta el circuit breaker del modelo.
+
+    Raises:
+        GeminiError: el fallo ya clasificado (ver gemini_errors)
+    """
+    breaker = get_breaker(model)
+    stage = gemini_stage(model)
+    outcome = 'cancelled'
+    try:
+        with track(stage):
+            response = get_genai_client().models.generate_content(
+                model=model,
+                contents=contents,
+                config=with_stage_timeout(config, stage)
+            )
+        outcome = None
+        return response
+    except Exception as e:
+        error = classify_error(e)
+        outcome = error.kind
+        if error.kind == 'rate_limited':
+            rate_limiter.report_rate_limited(model, error.retry_after)
+        raise error from e
+    finally:
+        breaker.record(outcome)
+
+
+def extract_response_text(response):
+    """Extrae el texto de una respuesta de Gemini"""
+    text = ""
+    if hasattr(response, 'text'):
+        text = response.text or ""
+    elif hasattr(response, 'candidates') and response.candidates:
+        for candidate in response.candidates:
+            if hasattr(candidate, 'content') and candidate.content:
+                for part in candidate.content.parts:
+                    if hasattr(part, 'text') and part.text:
+                        text += part.text
+    return text
+
+
+def extract_usage(response):
+    """Extrae los tokens usados de una respuesta de Gemini (o None)"""
+    if not hasattr(response, 'usage_metadata'):
+        return None
+    return {
+        "prompt_tokens": getattr(response.usage_metadata, 'prompt_token_count', 0),
+        "output_tokens": getattr(response.usage_metadata, 'candidates_token_count', 0),
+        "total_tokens": getattr(response.usage_metadata, 'total_token_count', 0)
+    }
+
+
+def find_image_data(response):
+    """Primera imagen inline de una respuesta de Gemini (o None), sin guardarla"""
+    if hasattr(response, 'candidates') and response.candidates:
+        for candidate in response.candidates:
+            if hasattr(candidate, 'content') and candidate.content:
+                for part in candidate.content.parts:
+                    if hasattr(part, 'inline_data') and part.inline_data and part.inline_data.data:
+                        return part.inline_data
+    return None
+
+
+def extract_image_result(response, image_type, frame_style):
+    """
+    Extrae la primera imagen de una respuesta de Gemini.
+
+    La imagen se guarda en el almacén de blobs y el resultado solo lleva su
+    referencia (URL del endpoint /api/images/<sha256>).
+
+    Returns:
+        dict con la referencia a la imagen y su uso de tokens, o None si no hay imagen
+    """
+    inline_data = find_image_data(response)
+    if inline_data is None:
+        return None
+    return store_image(
+        inline_data.data,
+        inline_data.mime_type,
+        style=frame_style,
+        type=image_type,
+        usage=extract_usage(response)
+    )
+
+
+def add_usage(total_usage, usage):
+    """Suma los tokens de `usage` (puede ser None) al acumulado total_usage"""
+    if not usage:
+        return total_usage
+    total_usage["prompt_tokens"] += usage.get("prompt_tokens", 0) or 0
+    total_usage["output_tokens"] += usage.get("output_tokens", 0) or 0
+    total_usage["total_tokens"] += usage.get("total_tokens", 0) or 0
+    return total_usage
+
+
 def format_user_data(user_data):
     """Formatea los datos del usuario para el prompt"""
     formatted = []
@@ -193,27 +463,15 @@ def format_user_data(user_data):
     
     return "\n".join(formatted)
 
-def select_best_frame_styles(image_bytes, all_styles):
-    """
-    La IA analiza el rostro y selecciona los 2 estilos más favorecedores de 10 opciones.
+def build_style_selection_prompt(all_styles):
+    """Prompt para que la IA elija los 2 mejores estilos del catálogo"""
+    # Construir lista de opciones para el prompt
+    styles_list = "\n".join([
+        f"{i+1}. **{s['name']}** ({s['style']}): {s['description']}"
+        for i, s in enumerate(all_styles)
+    ])
     
-    Args:
-        image_bytes: Bytes de la imagen selfie
-        all_styles: Lista con los 10 estilos disponibles
-    
-    Returns:
-        list: Los 2 estilos seleccionados (o todos si falla)
-    """
-    try:
-        print(f"[DEBUG] Solicitando a la IA que seleccione los 2 mejores estilos de {len(all_styles)} opciones...")
-        
-        # Construir lista de opciones para el prompt
-        styles_list = "\n".join([
-            f"{i+1}. **{s['name']}** ({s['style']}): {s['description']}"
-            for i, s in enumerate(all_styles)
-        ])
-        
-        selection_prompt = f"""You are an expert eyewear stylist analyzing a client's face.
+    return f"""You are an expert eyewear stylist analyzing a client's face.
 
 STEP 1 - ANALYZE THIS PERSON'S FACE:
 Carefully observe:
@@ -239,44 +497,62 @@ Example response: "3, 7"
 
 DO NOT include explanations, just the two numbers.
 """
+
+
+def parse_style_selection(selection_text, all_styles):
+    """
+    Convierte la respuesta de la IA ("3, 7") en los 2 estilos elegidos.
+
+    Returns:
+        list: Los 2 estilos seleccionados o None si la respuesta no es válida
+    """
+    import re
+    numbers = re.findall(r'\d+', selection_text)
+    if len(numbers) >= 2:
+        idx1 = int(numbers[0]) - 1  # Convertir de 1-indexed a 0-indexed
+        idx2 = int(numbers[1]) - 1
+
+        # Validar índices
+        if 0 <= idx1 < len(all_styles) and 0 <= idx2 < len(all_styles) and idx1 != idx2:
+            return [all_styles[idx1], all_styles[idx2]]
+    return None
+
+
+def select_best_frame_styles(selfie, all_styles):
+    """
+    La IA analiza el rostro y selecciona los 2 estilos más favorecedores de 10 opciones.
+
+    Args:
+        selfie: SelfieBlob del análisis
+        all_styles: Lista con los 10 estilos disponibles
+
+    Returns:
+        list: Los 2 estilos seleccionados (o todos si falla)
+    """
+    try:
+        print(f"[DEBUG] Solicitando a la IA que seleccione los 2 mejores estilos de {len(all_styles)} opciones...")
+
+        selection_prompt = build_style_selection_prompt(all_styles)
         
         # Crear parte de imagen
-        image_part = types.Part.from_bytes(
-            data=image_bytes,
-            mime_type="image/png"
-        )
+        image_part = selfie_part(selfie)
         
         # Generar respuesta
-        response = client.models.generate_content(
+        response = generate_content(
             model=TEXT_MODEL,
             contents=[selection_prompt, image_part]
         )
         
         # Extraer respuesta de texto
-        selection_text = ""
-        if hasattr(response, 'text'):
-            selection_text = response.text
-        elif hasattr(response, 'candidates') and response.candidates:
-            for candidate in response.candidates:
-                if hasattr(candidate, 'content') and candidate.content:
-                    for part in candidate.content.parts:
-                        if hasattr(part, 'text') and part.text:
-                            selection_text += part.text
+        selection_text = extract_response_text(response)
         
         print(f"[DEBUG] Respuesta de selección de IA: {selection_text.strip()}")
         
         # Parsear números seleccionados
-        import re
-        numbers = re.findall(r'\d+', selection_text)
-        if len(numbers) >= 2:
-            idx1 = int(numbers[0]) - 1  # Convertir de 1-indexed a 0-indexed
-            idx2 = int(numbers[1]) - 1
-            
-            # Validar índices
-            if 0 <= idx1 < len(all_styles) and 0 <= idx2 < len(all_styles) and idx1 != idx2:
-                selected = [all_styles[idx1], all_styles[idx2]]
-                print(f"[SUCCESS] IA seleccionó: {selected[0]['name']} y {selected[1]['name']}")
-                return selected
+        selected = parse_style_selection(selection_text, all_styles)
+        if selected:
+            print(f"[SUCCESS] IA seleccionó: {selected[0]['name']} y {selected[1]['name']}")
+            return selected
         
         # Si falla el parseo, usar los primeros 2 por defecto
         print(f"[WARN] No se pudo parsear selección, usando primeros 2 estilos por defecto")
@@ -287,22 +563,9 @@ DO NOT include explanations, just the two numbers.
         print(f"[WARN] Usando primeros 2 estilos por defecto")
         return all_styles[:2]
 
-def design_glasses_specifications(image_bytes, frame_style_info):
-    """
-    La IA analiza el rostro y diseña especificaciones detalladas de las gafas EN TEXTO.
-    Esto garantiza que el color y detalles sean idénticos en rostro y producto.
-    
-    Args:
-        image_bytes: Bytes de la imagen selfie
-        frame_style_info: Dict con info del estilo (name, style, description)
-    
-    Returns:
-        str: Descripción detallada de las gafas diseñadas
-    """
-    try:
-        print(f"[DEBUG] Diseñando especificaciones para {frame_style_info['name']}...")
-        
-        design_prompt = f"""You are an expert eyewear designer analyzing this client's face.
+def build_design_prompt(frame_style_info):
+    """Prompt para diseñar las especificaciones exactas de una montura"""
+    return f"""You are an expert eyewear designer analyzing this client's face.
 
 STEP 1 - ANALYZE THE FACE:
 Observe this person's:
@@ -330,30 +593,194 @@ Example format:
 
 Your detailed description:"""
 
-        # Crear parte de imagen
-        image_part = types.Part.from_bytes(
-            data=image_bytes,
-            mime_type="image/png"
+
+def build_planning_prompt(all_styles):
+    """
+    Prompt de la etapa combinada de "planificación del estilista": elegir los
+    2 mejores estilos del catálogo y diseñar sus especificaciones en una sola llamada.
+    """
+    styles_list = "\n".join([
+        f"- id: {s['id']} | **{s['name']}** ({s['style']}): {s['description']}"
+        for s in all_styles
+    ])
+
+    return f"""You are an expert eyewear stylist and designer analyzing a client's face.
+
+STEP 1 - ANALYZE THIS PERSON'S FACE:
+- Face shape and proportions (face width, face length, jawline, forehead)
+- Features (eyes distance, nose bridge width, cheekbone prominence)
+- Skin tone (warm/cool/neutral undertones), hair color and eye color
+- Overall aesthetic (professional, casual, artistic, sporty, elegant)
+
+STEP 2 - SELECT THE 2 BEST FRAME STYLES from this catalog:
+
+{styles_list}
+
+SELECTION CRITERIA:
+- Face shape compatibility (frames should complement, not mirror face shape)
+- Proportional balance (frame size should match face size)
+- Style coherence (match their apparent lifestyle/aesthetic)
+- Versatility (at least one versatile option, one bold option)
+
+STEP 3 - DESIGN EACH SELECTED FRAME with EXACT specifications:
+- color_finish: Be very specific (e.g., "brushed gold", "matte black", "tortoiseshell brown with amber flecks")
+- thickness: Exact thickness (e.g., "thin 1mm", "medium 2-3mm", "thick 4-5mm")
+- material: Material and finish (e.g., "matte acetate", "glossy polish", "brushed metal")
+- lens_tint: Clear or subtle tint
+- temple_arms: Shape and finish of the temple arms
+- description: A SINGLE PARAGRAPH describing the complete glasses, starting directly with the description
+
+Return exactly 2 frames with 2 DIFFERENT style_id values taken from the catalog.
+"""
+
+
+def build_frame_plan_schema(all_styles):
+    """Esquema JSON de la respuesta de planificación (ids restringidos al catálogo)"""
+    text = types.Schema(type=types.Type.STRING)
+    frame = types.Schema(
+        type=types.Type.OBJECT,
+        properties={
+            "style_id": types.Schema(
+                type=types.Type.STRING,
+                enum=[s['id'] for s in all_styles]
+            ),
+            "color_finish": text,
+            "thickness": text,
+            "material": text,
+            "lens_tint": text,
+            "temple_arms": text,
+            "description": text
+        },
+        required=["style_id", "color_finish", "thickness", "material", "lens_tint", "temple_arms", "description"],
+        property_ordering=["style_id", "color_finish", "thickness", "material", "lens_tint", "temple_arms", "description"]
+    )
+    return types.Schema(
+        type=types.Type.OBJECT,
+        properties={
+            "frames": types.Schema(type=types.Type.ARRAY, items=frame, min_items=2, max_items=2)
+        },
+        required=["frames"]
+    )
+
+
+def format_frame_spec(frame_plan):
+    """Convierte la especificación estructurada de una montura en el texto para los prompts de imagen"""
+    return (
+        f"{frame_plan['description'].strip()} "
+        f"Exact color/finish: {frame_plan['color_finish']}. "
+        f"Frame thickness: {frame_plan['thickness']}. "
+        f"Material: {frame_plan['material']}. "
+        f"Lens tint: {frame_plan['lens_tint']}. "
+        f"Temple arms: {frame_plan['temple_arms']}."
+    )
+
+
+def parse_frame_plan(response_text, all_styles):
+    """
+    Valida la respuesta JSON de planificación.
+
+    Returns:
+        dict: {"styles": [2 estilos del catálogo], "specs": [2 textos], "plan": [...]}
+              o None si la respuesta no cumple el esquema
+    """
+    try:
+        data = json.loads(response_text)
+    except (TypeError, ValueError):
+        return None
+
+    frames = data.get("frames") if isinstance(data, dict) else None
+    if not isinstance(frames, list) or len(frames) < 2:
+        return None
+
+    catalog = {s['id']: s for s in all_styles}
+    required = ("style_id", "color_finish", "thickness", "material", "lens_tint", "temple_arms", "description")
+    frames = frames[:2]
+    for frame_plan in frames:
+        if not isinstance(frame_plan, dict):
+            return None
+        if any(not str(frame_plan.get(field) or "").strip() for field in required):
+            return None
+        if frame_plan["style_id"] not in catalog:
+            return None
+    if frames[0]["style_id"] == frames[1]["style_id"]:
+        return None
+
+    return {
+        "styles": [catalog[f["style_id"]] for f in frames],
+        "specs": [format_frame_spec(f) for f in frames],
+        "plan": frames
+    }
+
+
+def plan_frames(selfie, all_styles):
+    """
+    Etapa combinada: la IA elige los 2 estilos y diseña sus especificaciones
+    en UNA sola llamada multimodal con salida JSON validada por esquema.
+    Reemplaza a select_best_frame_styles + 2 × design_glasses_specifications.
+
+    Args:
+        selfie: SelfieBlob del análisis
+        all_styles: Lista con los estilos disponibles
+
+    Returns:
+        dict con "styles" y "specs", o None si falla (el llamador usa el flujo anterior)
+    """
+    try:
+        print("[DEBUG] Planificando estilos y especificaciones en una sola llamada...")
+
+        response = generate_content(
+            model=TEXT_MODEL,
+            contents=[
+                build_planning_prompt(all_styles),
+                selfie_part(selfie)
+            ],
+            config=types.GenerateContentConfig(
+                response_mime_type="application/json",
+                response_schema=build_frame_plan_schema(all_styles)
+            )
         )
+
+        plan = parse_frame_plan(extract_response_text(response), all_styles)
+        if not plan:
+            print("[WARN] Respuesta de planificación inválida, usando flujo por etapas")
+            return None
+
+        print(f"[SUCCESS] IA planificó: {plan['styles'][0]['name']} y {plan['styles'][1]['name']}")
+        return plan
+
+    except Exception as e:
+        print(f"[ERROR] Error en planificación de estilos: {str(e)}")
+        return None
+
+
+def design_glasses_specifications(selfie, frame_style_info):
+    """
+    La IA analiza el rostro y diseña especificaciones detalladas de las gafas EN TEXTO.
+    Esto garantiza que el color y detalles sean idénticos en rostro y producto.
+
+    Args:
+        selfie: SelfieBlob del análisis
+        frame_style_info: Dict con info del estilo (name, style, description)
+
+    Returns:
+        str: Descripción detallada de las gafas diseñadas
+    """
+    try:
+        print(f"[DEBUG] Diseñando especificaciones para {frame_style_info['name']}...")
+
+        design_prompt = build_design_prompt(frame_style_info)
+
+        # Crear parte de imagen
+        image_part = selfie_part(selfie)
         
         # Generar especificaciones
-        response = client.models.generate_content(
+        response = generate_content(
             model=TEXT_MODEL,
             contents=[design_prompt, image_part]
         )
         
         # Extraer descripción
-        description = ""
-        if hasattr(response, 'text'):
-            description = response.text
-        elif hasattr(response, 'candidates') and response.candidates:
-            for candidate in response.candidates:
-                if hasattr(candidate, 'content') and candidate.content:
-                    for part in candidate.content.parts:
-                        if hasattr(part, 'text') and part.text:
-                            description += part.text
-        
-        description = description.strip()
+        description = extract_response_text(response).strip()
         print(f"[DEBUG] Diseño creado: {description[:100]}...")
         return description
         
@@ -362,40 +789,27 @@ Your detailed description:"""
         # Descripción genérica de fallback
         return f"{frame_style_info['style']} eyeglasses with professional finish"
 
-def download_image_as_bytes(image_url):
-    """Descarga una imagen desde URL y retorna los bytes"""
-    try:
-        response = requests.get(image_url)
-        response.raise_for_status()
-        return response.content
-    except Exception as e:
-        raise Exception(f"Error descargando imagen: {str(e)}")
-
-
-
-
 
-def generate_single_image(image_bytes, prompt, image_type, frame_style):
+def generate_single_image(selfie, prompt, image_type, frame_style):
     """
     Genera una imagen SIN reintentos.
-    Si falla, retorna None inmediatamente.
     
     Args:
-        image_bytes: Bytes de la imagen selfie (puede ser None)
+        selfie: SelfieBlob del análisis (puede ser None)
         prompt: Prompt formateado para generar la imagen
         image_type: Tipo de imagen ('on_face' o 'product')
         frame_style: Estilo de la montura
     
     Returns:
-        dict con la imagen generada o None si falla
+        dict con la imagen generada
+
+    Raises:
+        GeminiError: fallo tipado (cuota, transitorio, timeout, bloqueo o inválido)
     """
     try:
         # Preparar contenido según el tipo de imagen
-        if image_type == 'on_face' and image_bytes:
-            image_part = types.Part.from_bytes(
-                data=image_bytes,
-                mime_type="image/png"
-            )
+        if image_type == 'on_face' and selfie is not None:
+            image_part = selfie_part(selfie)
             contents = [prompt, image_part]
         else:
             contents = [prompt]
@@ -405,54 +819,75 @@ def generate_single_image(image_bytes, prompt, image_type, frame_style):
             response_modalities=["IMAGE"]
         )
         
-        response = client.models.generate_content(
-            model=IMAGE_MODEL,
-            contents=contents,
-            config=config
-        )
-        
-        # Extraer tokens/uso de la respuesta
-        usage_metadata = None
-        if hasattr(response, 'usage_metadata'):
-            usage_metadata = {
-                "prompt_tokens": getattr(response.usage_metadata, 'prompt_token_count', 0),
-                "output_tokens": getattr(response.usage_metadata, 'candidates_token_count', 0),
-                "total_tokens": getattr(response.usage_metadata, 'total_token_count', 0)
-            }
+        def call():
+            # Solo se valida la respuesta: la imagen se guarda después, y solo
+            # la de la llamada ganadora (la del respaldo perdedor se descarta)
+            response = _call_model(IMAGE_MODEL, contents, config)
+            if find_image_data(response) is None:
+                raise error_from_response(response, f"No se generó imagen {image_type} para {frame_style}")
+            return response
         
-        # Extraer imagen
-        if hasattr(response, 'candidates') and response.candidates:
-            for candidate in response.candidates:
-                if hasattr(candidate, 'content') and candidate.content:
-                    for part in candidate.content.parts:
-                        if hasattr(part, 'inline_data') and part.inline_data and part.inline_data.data:
-                            img_data = base64.b64encode(part.inline_data.data).decode('utf-8')
-                            return {
-                                "data": f"data:{part.inline_data.mime_type};base64,{img_data}",
-                                "mime_type": part.inline_data.mime_type,
-                                "style": frame_style,
-                                "type": image_type,
-                                "usage": usage_metadata
-                            }
-        
-        print(f"[WARN] No se generó imagen {image_type} para {frame_style}")
-        return None
+        # Con IMAGE_HEDGE_ENABLED, una llamada lenta recibe un respaldo (ver hedging)
+        admit_call(IMAGE_MODEL)
+        response = image_hedge.run(call, reserve_quota=lambda: try_admit_call(IMAGE_MODEL))
+        # Extraer imagen y tokens/uso de la respuesta
+        return extract_image_result(response, image_type, frame_style)
         
     except Exception as e:
-        error_str = str(e)
-        print(f"[ERROR] Error generando imagen {image_type} {frame_style}: {error_str}")
+        error = classify_error(e)
+        print(f"[ERROR] Error generando imagen {image_type} {frame_style} ({error.kind}): {error}")
+        if error is e:
+            raise
+        raise error from e
+
+
+def plan_image_retry(error, failures, attempt, max_retries, image_type, frame_style):
+    """
+    Registra el fallo de un intento de imagen y decide el siguiente según la
+    política de su clase (ver gemini_errors).
+
+    Args:
+        error: GeminiError del intento
+        failures: dict clase -> intentos fallidos de esa clase (se actualiza)
+        attempt: Número del intento que falló (0 para el primero)
+        max_retries: Máximo de intentos en total
+
+    Returns:
+        tuple: (segundos de espera, reforzar el prompt) o None para abandonar
+    """
+    record_outcome(error.kind, 'errors')
+    failures[error.kind] = failures.get(error.kind, 0) + 1
+    decision = next_retry(error, failures[error.kind], attempt) if attempt < max_retries - 1 else None
+    if decision is None:
+        record_outcome(error.kind, 'gave_up')
+        print(f"[ERROR] ✗ Falló {image_type} {frame_style} ({error.kind}) después de {attempt + 1} intento(s)")
         return None
+    record_outcome(error.kind, 'retries')
+    wait_time, rephrase = decision
+    detail = " con prompt reforzado" if rephrase else ""
+    print(f"[RETRY] Reintentando {image_type} {frame_style} ({error.kind}) en {wait_time:.1f}s{detail} (intento {attempt + 2}/{max_retries})...")
+    return decision
+
 
+def record_image_success(failures, attempt, max_retries, image_type, frame_style):
+    """Cuenta como recuperadas las clases de error que fallaron antes del éxito"""
+    for kind in failures:
+        record_outcome(kind, 'recovered')
+    if attempt > 0:
+        print(f"[SUCCESS] ✓ Imagen {image_type} {frame_style} generada en intento {attempt + 1}/{max_retries}")
 
-def generate_single_image_with_retry(image_bytes, prompt, image_type, frame_style, max_retries=3):
+
+def generate_single_image_with_retry(selfie, prompt, image_type, frame_style, max_retries=3):
     """
-    Genera una imagen CON reintentos automáticos y backoff exponencial.
+    Genera una imagen CON reintentos según la clase del error.
     
-    Maneja errores 429 (Rate Limiting) y 500 (Internal Error) reintentando
-    automáticamente con esperas crecientes entre intentos.
+    Un 429 se reintenta sin espera propia (el bucket compartido ya quedó
+    pausado lo que pidió el servidor), un error transitorio o un timeout con
+    backoff full-jitter, un bloqueo de seguridad una vez con el prompt
+    reforzado, y un request inválido no se reintenta.
     
     Args:
-        image_bytes: Bytes de la imagen selfie (puede ser None)
+        selfie: SelfieBlob del análisis (puede ser None)
         prompt: Prompt formateado para generar la imagen
         image_type: Tipo de imagen ('on_face' o 'product')
         frame_style: Estilo de la montura
@@ -463,127 +898,220 @@ def generate_single_image_with_retry(image_bytes, prompt, image_type, frame_styl
     """
     import time
     
-    # Backoff exponencial: 3s, 6s, 12s
-    retry_delays = [3, 6, 12]
-    
+    failures = {}
     for attempt in range(max_retries):
-        # Intentar generar imagen
-        result = generate_single_image(image_bytes, prompt, image_type, frame_style)
+        try:
+            result = generate_single_image(selfie, prompt, image_type, frame_style)
+        except GeminiError as e:
+            decision = plan_image_retry(e, failures, attempt, max_retries, image_type, frame_style)
+            if decision is None:
+                return None
+            wait_time, rephrase = decision
+            if rephrase:
+                prompt = rephrase_prompt(prompt)
+            if wait_time > 0:
+                time.sleep(wait_time)
+            continue
         
-        if result:
-            # Éxito
-            if attempt > 0:
-                print(f"[SUCCESS] ✓ Imagen {image_type} {frame_style} generada en intento {attempt + 1}/{max_retries}")
-            return result
-        
-        # Si falló y quedan reintentos
-        if attempt < max_retries - 1:
-            wait_time = retry_delays[attempt]
-            print(f"[RETRY] Reintentando {image_type} {frame_style} en {wait_time}s (intento {attempt + 2}/{max_retries})...")
-            time.sleep(wait_time)
-        else:
-            # Último intento falló
-            print(f"[ERROR] ✗ Falló {image_type} {frame_style} después de {max_retries} intentos")
+        record_image_success(failures, attempt, max_retries, image_type, frame_style)
+        return result
     
     return None
 
 
+def attach_variant(image, field, variant):
+    """Guarda en `field` la URL de una variante (o la del original si no hay variante)"""
+    image[field] = (variant or image)['url']
+    return image
+
+
+def image_upgrade_event(image):
+    """Datos del evento que reemplaza el preview de una imagen por su versión completa"""
+    return {
+        "style": image.get('style'),
+        "type": image.get('type'),
+        "url": image.get('full_url') or image.get('url')
+    }
+
+
+def image_request(selfie, image_type, detailed_specs):
+    """
+    Prompt y selfie de una imagen: en rostro con la selfie, de producto sin
+    ella pero con las MISMAS especificaciones (mismo color).
+
+    Returns:
+        tuple: (prompt, SelfieBlob o None)
+    """
+    if image_type == 'on_face':
+        return GLASSES_ON_FACE_PROMPT.format(detailed_specs=detailed_specs), selfie
+    return GLASSES_PRODUCT_PROMPT.format(detailed_specs=detailed_specs), None
+
+
+def label_image(result, frame, detailed_specs):
+    """Agrega a la imagen generada los datos de su montura (antes del checkpoint)"""
+    result['frame_name'] = frame['name']
+    result['description'] = frame['description']
+    result['detailed_specs'] = detailed_specs
+    return result
+
+
+class ImageCollector:
+    """
+    Imágenes terminadas de un análisis y su uso de tokens. Las entrega a los
+    callbacks en orden de llegada; la usan los dos motores (hilos o tareas).
+    """
+
+    def __init__(self, on_image_generated=None, on_image_upgraded=None):
+        self.images = []
+        self.usage = {
+            "prompt_tokens": 0,
+            "output_tokens": 0,
+            "total_tokens": 0,
+            "image_generations": 0
+        }
+        self.on_image_generated = on_image_generated
+        self.on_image_upgraded = on_image_upgraded
+        self._lock = Lock()
+
+    def deliver(self, result, frame, kind):
+        """
+        Registra una imagen terminada y la entrega al callback (en orden de llegada).
+
+        Returns:
+            int: Índice de llegada, o None si la imagen falló
+        """
+        if not result:
+            print(f"[WARN] ✗ Falló imagen {kind}: {frame['name']}")
+            return None
+        with self._lock:
+            self.images.append(result)
+            index = len(self.images) - 1
+            add_usage(self.usage, result.get('usage'))
+            self.usage["image_generations"] += 1
+            # Llamar callback para entrega progresiva (copia: la versión
+            # completa se agrega al registro después)
+            if self.on_image_generated:
+                self.on_image_generated(dict(result), index)
+        print(f"[DEBUG] ✓ Imagen {kind} generada: {frame['name']}")
+        return index
+
+    def upgrade(self, result, index, variant):
+        """La versión completa de una imagen ya entregada está lista"""
+        attach_variant(result, 'full_url', variant)
+        if self.on_image_upgraded:
+            self.on_image_upgraded(image_upgrade_event(result), index)
+
+    def replay(self, images):
+        """Entrega las imágenes de un resultado cacheado (ya con su versión completa)"""
+        self.images.extend(images)
+        for index, image in enumerate(self.images):
+            if self.on_image_generated:
+                self.on_image_generated(image, index)
+            if self.on_image_upgraded:
+                self.on_image_upgraded(image_upgrade_event(image), index)
+
+
+def summarize_image_results(generated_images, frame_styles, total_usage, session_id):
+    """
+    Ordena las imágenes generadas, valida que estén las 4 y arma el resultado final.
+    Limpia los checkpoints de la sesión si la generación fue completa.
+
+    Returns:
+        dict: Resultado con imágenes generadas, conteos, uso y error (si aplica)
+    """
+    # Orden estable en el resultado final: montura 1 (rostro, producto), montura 2...
+    stage_order = {f"{fs['id']}:{kind}": i for i, (fs, kind) in enumerate(
+        (fs, kind) for fs in frame_styles for kind in ('on_face', 'product')
+    )}
+    generated_images.sort(key=lambda img: stage_order.get(f"{img.get('style')}:{img.get('type')}", 0))
+
+    final_count = len(generated_images)
+    on_face_count = sum(1 for img in generated_images if img.get('type') == 'on_face')
+    product_count = sum(1 for img in generated_images if img.get('type') == 'product')
+
+    print(f"[DEBUG] ========================================")
+    print(f"[DEBUG] RESULTADO FINAL DE GENERACIÓN:")
+    print(f"[DEBUG] - Total imágenes: {final_count}/4")
+    print(f"[DEBUG] - En rostro: {on_face_count}/2")
+    print(f"[DEBUG] - Producto: {product_count}/2")
+    print(f"[DEBUG] ========================================")
+
+    # Validar que se generaron exactamente 4 imágenes
+    if final_count == 4:
+        success_msg = "✓ Se generaron exitosamente las 4 imágenes requeridas"
+        print(f"[SUCCESS] {success_msg}")
+        # Limpiar caché después de éxito completo
+        clear_session(session_id)
+        print(f"[CHECKPOINT] Caché limpiado después de éxito")
+        error = None
+    elif final_count > 0:
+        warning_msg = f"Se generaron solo {final_count}/4 imágenes ({on_face_count} en rostro, {product_count} producto)"
+        print(f"[WARN] {warning_msg}")
+        error = warning_msg
+    else:
+        error = "No se pudo generar ninguna imagen"
+
+    return {
+        "success": final_count >= 4,  # Éxito SOLO si se generaron las 4 imágenes
+        "images": generated_images,
+        "count": final_count,
+        "on_face_count": on_face_count,
+        "product_count": product_count,
+        "usage": total_usage,
+        "error": error
+    }
+
 
-def generate_glasses_images(selfie_url, user_data, on_image_generated=None):
+def generate_glasses_images(selfie, user_data, on_image_generated=None, on_image_upgraded=None):
     """
     Genera 4 imágenes: 2 monturas × (1 en rostro + 1 producto) = 4 imágenes total
     
+    Las etapas se ejecutan como un grafo de dependencias: las especificaciones
+    de cada montura se diseñan en paralelo y, en cuanto existen, la imagen en
+    rostro y la de producto se generan a la vez.
+
     Args:
-        selfie_url: URL de la selfie en Cloudinary
+        selfie: SelfieBlob del análisis (o URL de la selfie en Cloudinary)
         user_data: Diccionario con datos del usuario (no usado)
         on_image_generated: Callback opcional que se llama cada vez que una imagen
                            es generada. Recibe (image_data, image_index) como parámetros.
-                           Esto permite enviar imágenes progresivamente.
+                           Esto permite enviar imágenes progresivamente. Las imágenes
+                           llegan en orden de finalización; image_index es el orden de llegada.
+                           La imagen entregada apunta a su preview liviano (preview_url).
+        on_image_upgraded: Callback opcional que se llama cuando la versión completa
+                           de una imagen está lista. Recibe (image_upgrade_event(), image_index).
     
     Returns:
         dict: Resultado con imágenes generadas
     """
-    import time
-    
-    DELAY_BETWEEN_CALLS = 4  # Segundos entre llamadas
-    
+    collector = ImageCollector(on_image_generated, on_image_upgraded)
     try:
         print(f"[DEBUG] Iniciando generación de imágenes con modelo: {IMAGE_MODEL}")
         
-        # Descargar imagen selfie
-        image_bytes = download_image_as_bytes(selfie_url)
-        print(f"[DEBUG] Imagen descargada, tamaño: {len(image_bytes)} bytes")
-        
-        # Catálogo completo: 10 estilos de monturas
-        # La IA analizará el rostro y elegirá los 2 MEJORES estilos de estos 10
-        ALL_FRAME_STYLES = [
-            {
-                "id": "classic_rectangular",
-                "name": "Rectangular Metálico",
-                "style": "rectangular metal",
-                "description": "Montura rectangular con armazón metálico, estilo profesional y elegante. Ideal para rostros redondos u ovalados."
-            },
-            {
-                "id": "modern_round",
-                "name": "Redondo de Acetato", 
-                "style": "round acetate",
-                "description": "Montura circular de acetato, estética retro-moderna. Perfecta para rostros cuadrados o angulares."
-            },
-            {
-                "id": "aviator_metal",
-                "name": "Aviador Metálico",
-                "style": "aviator metal",
-                "description": "Montura aviador clásica con puente doble y lentes en forma de lágrima invertida. Icónica y atemporal, favorece rostros cuadrados y rectangulares."
-            },
-            {
-                "id": "cat_eye_acetate",
-                "name": "Cat-Eye de Acetato",
-                "style": "cat-eye acetate",
-                "description": "Montura con esquinas superiores elevadas tipo ojo de gato. Femenina y vintage, ideal para rostros redondos, añade ángulos y sofisticación."
-            },
-            {
-                "id": "wayfarer_acetate",
-                "name": "Wayfarer de Acetato",
-                "style": "wayfarer acetate",
-                "description": "Montura trapezoidal clásica de acetato grueso. Versátil y urbana, favorece rostros ovalados, redondos y en forma de corazón."
-            },
-            {
-                "id": "oversized_square",
-                "name": "Cuadrado Oversized",
-                "style": "oversized square acetate",
-                "description": "Montura cuadrada de gran tamaño con armazón acetato. Moderna y statement, ideal para rostros pequeños o delicados que buscan impacto."
-            },
-            {
-                "id": "browline_combo",
-                "name": "Browline Combinado",
-                "style": "browline combination",
-                "description": "Montura con borde superior grueso (acetato/metal) y borde inferior delgado o sin marco. Retro-intelectual, favorece rostros ovalados y triangulares."
-            },
-            {
-                "id": "geometric_angular",
-                "name": "Geométrico Angular",
-                "style": "geometric angular",
-                "description": "Montura con formas octagonales o hexagonales. Vanguardista y artística, ideal para rostros redondos u ovalados que buscan contraste angular."
-            },
-            {
-                "id": "semi_rimless",
-                "name": "Semi-Rimless Minimalista",
-                "style": "semi-rimless metal",
-                "description": "Montura con marco solo en la parte superior, lentes sujetas por nylon transparente. Ligera y discreta, favorece cualquier rostro, especialmente profesionales."
-            },
-            {
-                "id": "sport_wrap",
-                "name": "Deportivo Wraparound",
-                "style": "sport wraparound",
-                "description": "Montura curva que envuelve el rostro, estilo deportivo moderno. Dinámico y juvenil, ideal para rostros angulares y activos."
-            }
-        ]
+        # Bytes de la selfie (ya en memoria si viene de upload_selfie)
+        selfie = resolve_selfie(selfie)
+        print(f"[DEBUG] Selfie disponible, tamaño: {selfie.size} bytes")
         
         # === SISTEMA DE CHECKPOINTS ===
-        # Generar ID de sesión basado en la selfie URL
-        session_id = get_session_id(selfie_url)
+        # ID de sesión basado en el contenido de la selfie: un reintento con la
+        # misma foto retoma los checkpoints aunque Cloudinary le dé otra URL
+        session_id = get_session_id(selfie.digest)
         print(f"[CHECKPOINT] Session ID: {session_id}")
         
+        # === CACHÉ DE RESULTADOS (misma selfie ya analizada) ===
+        result_key = lookup_result_key(selfie, IMAGE_RESULT_VERSION)
+        cached_result = get_result(result_key)
+        if cached_result and len(cached_result.get('images', [])) == 4:
+            print("[RESULT CACHE] ✓ Imágenes ya generadas para esta selfie, sin llamar a Gemini")
+            collector.replay(cached_result['images'])
+            result = summarize_image_results(collector.images, cached_result['styles'], collector.usage, session_id)
+            result["cached"] = True
+            return result
+
+        # Con el modelo de imágenes caído no se diseñan monturas que no se
+        # podrán dibujar: el análisis sigue solo con texto
+        get_breaker(IMAGE_MODEL).ensure_available()
+
         # Verificar estado de checkpoints existentes
         cache_status = get_session_status(session_id)
         cached_items = sum(1 for v in cache_status.values() if v)
@@ -596,13 +1124,21 @@ def generate_glasses_images(selfie_url, user_data, on_image_generated=None):
         print(f"[DEBUG] ========================================")
         
         # Verificar caché de estilos
+        planned_specs = {}
         cached_styles = get_checkpoint(session_id, 'styles')
         if cached_styles:
             print(f"[CHECKPOINT] ✓ Usando estilos cacheados")
             frame_styles = cached_styles
         else:
-            # Generar nueva selección
-            frame_styles = select_best_frame_styles(image_bytes, ALL_FRAME_STYLES)
+            # Selección + diseño en una sola llamada; si falla, flujo por etapas
+            plan = plan_frames(selfie, ALL_FRAME_STYLES)
+            if plan:
+                frame_styles = plan['styles']
+                for idx, detailed_specs in enumerate(plan['specs']):
+                    planned_specs[idx] = detailed_specs
+                    save_checkpoint(session_id, f"specs_{idx}", detailed_specs)
+            else:
+                frame_styles = select_best_frame_styles(selfie, ALL_FRAME_STYLES)
             # Guardar checkpoint
             save_checkpoint(session_id, 'styles', frame_styles)
         
@@ -611,158 +1147,82 @@ def generate_glasses_images(selfie_url, user_data, on_image_generated=None):
             print(f"[DEBUG]   - {fs['name']} ({fs['style']})")
         print(f"[DEBUG] ========================================")
         
-        generated_images = []
-        total_usage = {
-            "prompt_tokens": 0,
-            "output_tokens": 0,
-            "total_tokens": 0,
-            "image_generations": 0
-        }
-        
-        # Generar imágenes SECUENCIALMENTE con diseño de especificaciones por adelantado
-        for idx, frame in enumerate(frame_styles):
-            print(f"[DEBUG] ========================================")
-            print(f"[DEBUG] === Procesando montura {idx + 1}/2: {frame['name']} ===")
-            print(f"[DEBUG] ========================================")
-            
-            # PASO 1: Diseñar especificaciones detalladas (con caché)
+        full_futures = []
+
+        def specs_stage(idx, frame):
+            """ETAPA 1: Diseñar especificaciones detalladas (con caché)"""
+            if idx in planned_specs:
+                return planned_specs[idx]
+
             specs_key = f"specs_{idx}"
             cached_specs = get_checkpoint(session_id, specs_key)
             
             if cached_specs:
                 print(f"[CHECKPOINT] ✓ Usando especificaciones cacheadas para {frame['name']}")
-                detailed_specs = cached_specs
-            else:
-                print(f"[DEBUG] PASO 1: Diseñando especificaciones detalladas para {frame['name']}...")
-                detailed_specs = design_glasses_specifications(image_bytes, frame)
-                save_checkpoint(session_id, specs_key, detailed_specs)
+                return cached_specs
             
+            print(f"[DEBUG] Diseñando especificaciones detalladas para {frame['name']}...")
+            detailed_specs = design_glasses_specifications(selfie, frame)
+            save_checkpoint(session_id, specs_key, detailed_specs)
             print(f"[DEBUG] Especificaciones diseñadas: {detailed_specs}")
+            return detailed_specs
+
+        def render_stage(idx, frame, image_type, detailed_specs):
+            """ETAPA 2: Generar imagen en rostro o de producto (con caché)"""
+            cache_key = f"img_{image_type}_{idx}"
+            cached_result = get_checkpoint(session_id, cache_key)
             
-            # PASO 2: Generar imagen EN ROSTRO (con caché)
-            on_face_key = f"img_on_face_{idx}"
-            cached_on_face = get_checkpoint(session_id, on_face_key)
-            
-            if cached_on_face:
-                print(f"[CHECKPOINT] ✓ Usando imagen en rostro cacheada para {frame['name']}")
-                on_face_result = cached_on_face
+            if cached_result:
+                print(f"[CHECKPOINT] ✓ Usando imagen {image_type} cacheada para {frame['name']}")
+                result = cached_result
             else:
-                print(f"[DEBUG] PASO 2: Generando imagen en rostro con especificaciones exactas...")
-                on_face_prompt = GLASSES_ON_FACE_PROMPT.format(detailed_specs=detailed_specs)
-                
-                on_face_result = generate_single_image_with_retry(
-                    image_bytes=image_bytes,
-                    prompt=on_face_prompt,
-                    image_type='on_face',
+                prompt, image_selfie = image_request(selfie, image_type, detailed_specs)
+                result = generate_single_image_with_retry(
+                    selfie=image_selfie,
+                    prompt=prompt,
+                    image_type=image_type,
                     frame_style=frame['id'],
                     max_retries=3
                 )
                 
                 # Guardar checkpoint si exitoso
-                if on_face_result:
-                    on_face_result['frame_name'] = frame['name']
-                    on_face_result['description'] = frame['description']
-                    on_face_result['detailed_specs'] = detailed_specs
-                    save_checkpoint(session_id, on_face_key, on_face_result)
-            
-            if on_face_result:
-                generated_images.append(on_face_result)
-                # Llamar callback para entrega progresiva
-                if on_image_generated:
-                    on_image_generated(on_face_result, len(generated_images) - 1)
-                if on_face_result.get('usage'):
-                    total_usage["prompt_tokens"] += on_face_result['usage'].get('prompt_tokens', 0)
-                    total_usage["output_tokens"] += on_face_result['usage'].get('output_tokens', 0)
-                    total_usage["total_tokens"] += on_face_result['usage'].get('total_tokens', 0)
-                total_usage["image_generations"] += 1
-                print(f"[DEBUG] ✓ Imagen en rostro generada: {frame['name']}")
-            else:
-                print(f"[WARN] ✗ Falló imagen en rostro: {frame['name']}")
+                if result:
+                    save_checkpoint(session_id, cache_key, label_image(result, frame, detailed_specs))
             
-            # Delay entre imágenes
-            print(f"[DEBUG] Esperando {DELAY_BETWEEN_CALLS}s...")
-            time.sleep(DELAY_BETWEEN_CALLS)
-            
-            # PASO 3: Generar imagen de PRODUCTO (con caché)
-            product_key = f"img_product_{idx}"
-            cached_product = get_checkpoint(session_id, product_key)
-            
-            if cached_product:
-                print(f"[CHECKPOINT] ✓ Usando imagen de producto cacheada para {frame['name']}")
-                product_result = cached_product
-            else:
-                print(f"[DEBUG] PASO 3: Generando imagen de producto con MISMAS especificaciones (mismo color)...")
-                product_prompt = GLASSES_PRODUCT_PROMPT.format(detailed_specs=detailed_specs)
-                
-                product_result = generate_single_image_with_retry(
-                    image_bytes=None,  # No necesita la selfie
-                    prompt=product_prompt,
-                    image_type='product',
-                    frame_style=frame['id'],
-                    max_retries=3
+            # ETAPA 3: Preview liviano primero; la versión completa se codifica
+            # en segundo plano y se anuncia con on_image_upgraded
+            if result:
+                attach_variant(result, 'preview_url', submit_preview(result).result())
+            index = collector.deliver(result, frame, image_type)
+            if result:
+                full_futures.append(submit_full(result, partial(collector.upgrade, result, index)))
+            return result
+
+        # Grafo de etapas: specs por montura -> (en rostro || producto) en paralelo
+        graph = StageGraph(max_workers=PIPELINE_MAX_WORKERS, name="glasses")
+        for idx, frame in enumerate(frame_styles):
+            specs_stage_name = f"specs_{idx}"
+            graph.add_stage(specs_stage_name, partial(specs_stage, idx, frame))
+            for image_type in ('on_face', 'product'):
+                graph.add_stage(
+                    f"img_{image_type}_{idx}",
+                    partial(render_stage, idx, frame, image_type),
+                    depends_on=[specs_stage_name]
                 )
-                
-                # Guardar checkpoint si exitoso
-                if product_result:
-                    product_result['frame_name'] = frame['name']
-                    product_result['description'] = frame['description']
-                    product_result['detailed_specs'] = detailed_specs
-                    save_checkpoint(session_id, product_key, product_result)
-            
-            if product_result:
-                generated_images.append(product_result)
-                # Llamar callback para entrega progresiva
-                if on_image_generated:
-                    on_image_generated(product_result, len(generated_images) - 1)
-                if product_result.get('usage'):
-                    total_usage["prompt_tokens"] += product_result['usage'].get('prompt_tokens', 0)
-                    total_usage["output_tokens"] += product_result['usage'].get('output_tokens', 0)
-                    total_usage["total_tokens"] += product_result['usage'].get('total_tokens', 0)
-                total_usage["image_generations"] += 1
-                print(f"[DEBUG] ✓ Imagen de producto generada: {frame['name']}")
-            else:
-                print(f"[WARN] ✗ Falló imagen de producto: {frame['name']}")
-            
-            # Delay antes de siguiente montura (si no es la última)
-            if idx < len(frame_styles) - 1:
-                print(f"[DEBUG] Esperando {DELAY_BETWEEN_CALLS}s antes de siguiente montura...")
-                time.sleep(DELAY_BETWEEN_CALLS)
-        
-        final_count = len(generated_images)
-        on_face_count = sum(1 for img in generated_images if img.get('type') == 'on_face')
-        product_count = sum(1 for img in generated_images if img.get('type') == 'product')
-        
-        print(f"[DEBUG] ========================================")
-        print(f"[DEBUG] RESULTADO FINAL DE GENERACIÓN:")
-        print(f"[DEBUG] - Total imágenes: {final_count}/4")
-        print(f"[DEBUG] - En rostro: {on_face_count}/2")
-        print(f"[DEBUG] - Producto: {product_count}/2")
-        print(f"[DEBUG] ========================================")
-        
-        # Validar que se generaron exactamente 4 imágenes
-        if final_count == 4:
-            success_msg = "✓ Se generaron exitosamente las 4 imágenes requeridas"
-            print(f"[SUCCESS] {success_msg}")
-            # Limpiar caché después de éxito completo
-            clear_session(session_id)
-            print(f"[CHECKPOINT] Caché limpiado después de éxito")
-            error = None
-        elif final_count > 0:
-            warning_msg = f"Se generaron solo {final_count}/4 imágenes ({on_face_count} en rostro, {product_count} producto)"
-            print(f"[WARN] {warning_msg}")
-            error = warning_msg
-        else:
-            error = "No se pudo generar ninguna imagen"
-        
-        return {
-            "success": final_count >= 4,  # Éxito SOLO si se generaron las 4 imágenes
-            "images": generated_images,
-            "count": final_count,
-            "on_face_count": on_face_count,
-            "product_count": product_count,
-            "usage": total_usage,
-            "error": error
-        }
+
+        print(f"[DEBUG] Ejecutando grafo de {len(frame_styles) * 3} etapas con {PIPELINE_MAX_WORKERS} workers...")
+        run_info = graph.run()
+        print(f"[PERF] Tiempos por etapa: {run_info['timings']}")
+        wait(full_futures)
+
+        result = summarize_image_results(collector.images, frame_styles, collector.usage, session_id)
+        if result["success"]:
+            save_result(result_key, {
+                "styles": frame_styles,
+                "specs": [run_info['results'].get(f"specs_{idx}") for idx in range(len(frame_styles))],
+                "images": result["images"]
+            }, selfie)
+        return result
         
     except Exception as e:
         import traceback
@@ -772,17 +1232,17 @@ def generate_glasses_images(selfie_url, user_data, on_image_generated=None):
         return {
             "success": False,
             "error": error_msg,
-            "images": generated_images if 'generated_images' in locals() else [],
-            "usage": total_usage if 'total_usage' in locals() else None
+            "images": collector.images,
+            "usage": collector.usage
         }
 
 
-def generate_text_analysis(selfie_url, user_data):
+def generate_text_analysis(selfie, user_data):
     """
     Genera análisis en texto de las recomendaciones de monturas
     
     Args:
-        selfie_url: URL de la selfie en Cloudinary
+        selfie: SelfieBlob del análisis (o URL de la selfie en Cloudinary)
         user_data: Diccionario con datos del usuario
     
     Returns:
@@ -791,47 +1251,47 @@ def generate_text_analysis(selfie_url, user_data):
     try:
         print(f"[DEBUG] Iniciando análisis de texto con modelo: {TEXT_MODEL}")
         
-        # Descargar imagen selfie
-        image_bytes = download_image_as_bytes(selfie_url)
+        # Bytes de la selfie (ya en memoria si viene de upload_selfie)
+        selfie = resolve_selfie(selfie)
+
+        # Caché de resultados: la misma selfie ya tiene análisis
+        result_key = lookup_result_key(selfie, TEXT_RESULT_VERSION)
+        cached_result = get_result(result_key)
+        if cached_result:
+            print("[RESULT CACHE] ✓ Análisis de texto ya generado para esta selfie")
+            return {
+                "success": True,
+                "analysis": cached_result["analysis"],
+                "usage": None,
+                "cached": True
+            }
         
         # Usar el prompt directamente (ya no requiere datos del usuario)
         prompt = TEXT_ANALYSIS_PROMPT
         
-        # Crear contenido con imagen
-        image_part = types.Part.from_bytes(
-            data=image_bytes,
-            mime_type="image/png"
-        )
-        
+        # Crear contenido con imagen: referencia al archivo si la generación
+        # de imágenes de esta selfie ya lo subió, bytes inline si no
+        image_part = selfie_part(selfie)
+
         # Generar respuesta (solo texto)
-        response = client.models.generate_content(
+        response = generate_content(
             model=TEXT_MODEL,
             contents=[prompt, image_part]
         )
         
         # Extraer tokens/uso de la respuesta
-        usage_metadata = None
-        if hasattr(response, 'usage_metadata'):
-            usage_metadata = {
-                "prompt_tokens": getattr(response.usage_metadata, 'prompt_token_count', 0),
-                "output_tokens": getattr(response.usage_metadata, 'candidates_token_count', 0),
-                "total_tokens": getattr(response.usage_metadata, 'total_token_count', 0)
-            }
+        usage_metadata = extract_usage(response)
+        if usage_metadata:
             print(f"[DEBUG] Tokens de análisis de texto: {usage_metadata}")
         
         # Extraer texto de la respuesta
-        text_response = ""
-        if hasattr(response, 'text'):
-            text_response = response.text
-        elif hasattr(response, 'candidates') and response.candidates:
-            for candidate in response.candidates:
-                if hasattr(candidate, 'content') and candidate.content:
-                    for part in candidate.content.parts:
-                        if hasattr(part, 'text') and part.text:
-                            text_response += part.text
+        text_response = extract_response_text(response)
         
         print(f"[DEBUG] Análisis de texto completado, longitud: {len(text_response)} chars")
         
+        if text_response:
+            save_result(result_key, {"analysis": text_response}, selfie)
+
         return {
             "success": True,
             "analysis": text_response,
@@ -849,13 +1309,13 @@ def generate_text_analysis(selfie_url, user_data):
             "usage": None
         }
 
-def analyze_face_for_glasses(selfie_url, user_data, tracker=None):
+def analyze_face_for_glasses(selfie, user_data, tracker=None):
     """
     Función principal que combina generación de imágenes y análisis de texto.
-    OPTIMIZADO: Ejecuta primero el texto (más rápido) y luego las imágenes.
+    OPTIMIZADO: El texto y las imágenes se generan a la vez.
     
     Args:
-        selfie_url: URL de la selfie en Cloudinary
+        selfie: SelfieBlob del análisis (o URL de la selfie en Cloudinary)
         user_data: Diccionario con datos del usuario
         tracker: ProgressTracker opcional para reportar progreso
     
@@ -874,25 +1334,27 @@ def analyze_face_for_glasses(selfie_url, user_data, tracker=None):
     text_result = {"success": False, "analysis": "", "error": None, "usage": None}
     
     try:
-        # === PASO 1: ANÁLISIS DE TEXTO (más rápido, ~20-50s) ===
-        if tracker:
-            tracker.update(10, "Analizando tu rostro...")
-        
-        print("[DEBUG] Paso 1/2: Generando análisis de texto...")
-        text_result = generate_text_analysis(selfie_url, user_data)
-        
-        text_time = time.time() - start_time
-        print(f"[PERF] Texto completado en {text_time:.2f}s")
-        
+        # Resolver la selfie una sola vez para ambas etapas
+        selfie = resolve_selfie(selfie)
+
+        # === TEXTO E IMÁGENES EN PARALELO (solo dependen de la selfie) ===
         if tracker:
-            tracker.update(40, "Análisis facial completado ✓ Generando monturas...")
-        
-        # === PASO 2: GENERAR IMÁGENES (más lento, ~30-90s) ===
-        print("[DEBUG] Paso 2/2: Generando imágenes de monturas...")
-        images_result = generate_glasses_images(selfie_url, user_data)
+            tracker.update(10, "Analizando tu rostro y generando monturas...")
         
-        images_time = time.time() - start_time
-        print(f"[PERF] Imágenes completadas en {images_time:.2f}s")
+        print("[DEBUG] Lanzando análisis de texto e imágenes en paralelo...")
+        # La selfie se sube una vez al modelo para ambas etapas (ver model_files)
+        with selfie_session(selfie), \
+                ThreadPoolExecutor(max_workers=2, thread_name_prefix="analysis") as executor:
+            text_future = executor.submit(generate_text_analysis, selfie, user_data)
+            images_future = executor.submit(generate_glasses_images, selfie, user_data)
+
+            text_result = text_future.result()
+            print(f"[PERF] Texto completado en {time.time() - start_time:.2f}s")
+            if tracker:
+                tracker.update(40, "Análisis facial completado ✓ Generando monturas...")
+
+            images_result = images_future.result()
+            print(f"[PERF] Imágenes completadas en {time.time() - start_time:.2f}s")
         
         if tracker:
             tracker.update(95, "Preparando resultados...")
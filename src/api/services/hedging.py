@@ -0,0 +1,251 @@
+"""
+Requests "hedged" para la generación de imágenes.
+
+La latencia del modelo de imágenes tiene una cola larga: una sola imagen
+lenta decide cuánto tarda el análisis completo. Con IMAGE_HEDGE_ENABLED=true,
+si una llamada supera el percentil IMAGE_HEDGE_PERCENTILE de las latencias
+recientes se lanza una llamada de respaldo idéntica; gana la primera que
+responde bien y la otra se cancela (motor asíncrono) o se descarta (motor
+síncrono: el hilo termina solo y su respuesta se ignora). Por eso la llamada
+solo devuelve la respuesta del modelo: quien llama guarda la imagen de la
+ganadora, y la perdedora no deja nada escrito.
+
+Las llamadas extra están acotadas por un presupuesto: cada llamada primaria
+suma IMAGE_HEDGE_BUDGET_RATIO fichas (hasta IMAGE_HEDGE_BUDGET_BURST) y cada
+respaldo gasta una, así que a largo plazo los respaldos no superan esa
+fracción del tráfico. Además solo se lanza un respaldo si el bucket del
+modelo tiene un token libre en ese momento: bajo presión de cuota no se
+hace hedging.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+IMAGE_HEDGE_ENABLED = os.getenv('IMAGE_HEDGE_ENABLED', 'false').lower() == 'true'
+IMAGE_HEDGE_PERCENTILE = float(os.getenv('IMAGE_HEDGE_PERCENTILE', 90))
+# Latencias recientes (llamadas exitosas) sobre las que se calcula el percentil
+IMAGE_HEDGE_WINDOW = int(os.getenv('IMAGE_HEDGE_WINDOW', 200))
+IMAGE_HEDGE_MIN_SAMPLES = int(os.getenv('IMAGE_HEDGE_MIN_SAMPLES', 20))
+IMAGE_HEDGE_MIN_DELAY_SECONDS = float(os.getenv('IMAGE_HEDGE_MIN_DELAY_SECONDS', 2))
+# Respaldos por llamada primaria a largo plazo, y ráfaga permitida
+IMAGE_HEDGE_BUDGET_RATIO = float(os.getenv('IMAGE_HEDGE_BUDGET_RATIO', 0.1))
+IMAGE_HEDGE_BUDGET_BURST = float(os.getenv('IMAGE_HEDGE_BUDGET_BURST', 3))
+
+
+class HedgePolicy:
+    """Umbral de hedging (percentil de latencias recientes), presupuesto y métricas"""
+
+    def __init__(self, name, enabled=IMAGE_HEDGE_ENABLED, percentile=IMAGE_HEDGE_PERCENTILE,
+                 window=IMAGE_HEDGE_WINDOW, min_samples=IMAGE_HEDGE_MIN_SAMPLES,
+                 min_delay=IMAGE_HEDGE_MIN_DELAY_SECONDS, budget_ratio=IMAGE_HEDGE_BUDGET_RATIO,
+                 budget_burst=IMAGE_HEDGE_BUDGET_BURST):
+        self.name = name
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self._latencies = deque(maxlen=window)
+        self._budget = budget_burst
+        self._lock = threading.Lock()
+        self.metrics = {
+            "calls": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "primary_wins": 0,
+            "budget_denied": 0,
+            "quota_denied": 0
+        }
+
+    def record(self, seconds):
+        """Registra la latencia de una llamada exitosa"""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def delay(self):
+        """
+        Segundos tras los que conviene lanzar el respaldo, o None si aún no
+        hay suficientes muestras.
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    def _start_call(self):
+        with self._lock:
+            self.metrics["calls"] += 1
+            self._budget = min(self.budget_burst, self._budget + self.budget_ratio)
+
+    def _take_budget(self):
+        with self._lock:
+            if self._budget < 1:
+                self.metrics["budget_denied"] += 1
+                return False
+            self._budget -= 1
+            return True
+
+    def _release_budget(self):
+        """Devuelve la ficha de un respaldo que no se lanzó (sin cuota)"""
+        with self._lock:
+            self._budget += 1
+            self.metrics["quota_denied"] += 1
+
+    def _finish(self, launched, backup_won):
+        with self._lock:
+            if launched:
+                self.metrics["hedged"] += 1
+                self.metrics["hedge_wins" if backup_won else "primary_wins"] += 1
+
+    def run(self, call, reserve_quota=None):
+        """
+        Ejecuta call() con hedging: si no responde a tiempo, lanza una copia y
+        retorna el primer resultado exitoso (distinto de None).
+
+        Args:
+            call: Función sin argumentos (la llamada al modelo, ya con su token);
+                  no debe tener efectos que el perdedor deje a medias
+            reserve_quota: Función que toma un token de cuota para el respaldo
+                           sin esperar; retorna False si no hay
+
+        Raises:
+            El error de la primaria (o del respaldo) si ninguna llamada tuvo éxito
+        """
+        if not self.enabled:
+            return call()
+        self._start_call()
+        delay = self.delay()
+        if delay is None:
+            # Sin muestras suficientes: llamada normal, que solo alimenta el percentil
+            start = time.monotonic()
+            result = call()
+            if result is not None:
+                self.record(time.monotonic() - start)
+            return result
+        results = queue.Queue()
+
+        def attempt(index):
+            start = time.monotonic()
+            try:
+                result = call()
+            except Exception as e:
+                results.put((index, None, e))
+                return
+            if result is not None:
+                self.record(time.monotonic() - start)
+            results.put((index, result, None))
+
+        threading.Thread(target=attempt, args=(0,), name=f"hedge-{self.name}", daemon=True).start()
+        pending, waited, launched = 1, False, False
+        errors = {}
+        while pending:
+            try:
+                index, result, error = results.get(timeout=None if waited else delay)
+            except queue.Empty:
+                waited = True
+                if self._take_budget():
+                    if reserve_quota is None or reserve_quota():
+                        print(f"[HEDGE] {self.name}: sin respuesta en {delay:.1f}s, lanzando respaldo")
+                        threading.Thread(target=attempt, args=(1,), name=f"hedge-{self.name}", daemon=True).start()
+                        pending += 1
+                        launched = True
+                    else:
+                        self._release_budget()
+                continue
+            pending -= 1
+            if result is not None:
+                self._finish(launched, index == 1)
+                return result
+            errors[index] = error
+        self._finish(launched, False)
+        error = errors.get(0) or errors.get(1)
+        if error is not None:
+            raise error
+        return None
+
+    async def run_async(self, call, reserve_quota=None):
+        """
+        Versión asíncrona de run: call() crea una corrutina nueva en cada
+        invocación, reserve_quota es asíncrona y el perdedor se cancela.
+        """
+        if not self.enabled:
+            return await call()
+        self._start_call()
+        delay = self.delay()
+
+        async def attempt():
+            start = time.monotonic()
+            result = await call()
+            if result is not None:
+                self.record(time.monotonic() - start)
+            return result
+
+        if delay is None:
+            return await attempt()
+        primary = asyncio.ensure_future(attempt())
+        tasks = {primary}
+        waited, launched = False, False
+        errors = {}
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks, timeout=None if waited else delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    waited = True
+                    if self._take_budget():
+                        if reserve_quota is None or await reserve_quota():
+                            print(f"[HEDGE] {self.name}: sin respuesta en {delay:.1f}s, lanzando respaldo")
+                            tasks.add(asyncio.ensure_future(attempt()))
+                            launched = True
+                        else:
+                            self._release_budget()
+                    continue
+                for task in done:
+                    tasks.discard(task)
+                    index = 0 if task is primary else 1
+                    if task.cancelled():
+                        # exception() lanzaría CancelledError
+                        errors[index] = asyncio.CancelledError()
+                        continue
+                    if task.exception() is None and task.result() is not None:
+                        self._finish(launched, index == 1)
+                        return task.result()
+                    errors[index] = task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+        self._finish(launched, False)
+        error = errors.get(0) or errors.get(1)
+        if error is not None:
+            raise error
+        return None
+
+    def stats(self):
+        with self._lock:
+            metrics = dict(self.metrics)
+            samples = len(self._latencies)
+            budget = round(self._budget, 2)
+        delay = self.delay()
+        return {
+            **metrics,
+            "enabled": self.enabled,
+            "hedge_win_rate": round(metrics["hedge_wins"] / metrics["hedged"], 3) if metrics["hedged"] else None,
+            "extra_call_ratio": round(metrics["hedged"] / metrics["calls"], 3) if metrics["calls"] else 0,
+            "delay_seconds": round(delay, 2) if delay is not None else None,
+            "samples": samples,
+            "budget": budget
+        }
+
+
+image_hedge = HedgePolicy('image')
+
+
+def get_hedge_stats():
+    return {image_hedge.name: image_hedge.stats()}
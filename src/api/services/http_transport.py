@@ -0,0 +1,259 @@
+"""
+Capa de transporte HTTP compartida por todas las etapas del análisis.
+
+- Descarga de imágenes por URL: un requests.Session (y un httpx.AsyncClient
+  para el motor asíncrono) con pool keep-alive por host.
+- Gemini: el genai.Client se crea al primer uso, no al importar, sobre
+  clientes httpx propios con pool acotado; el motor síncrono y el asíncrono
+  reutilizan sus conexiones TLS.
+- Cloudinary: su SDK ya mantiene un PoolManager keep-alive (urllib3); aquí se
+  le fija el timeout de su etapa y se leen sus métricas.
+
+Cada etapa tiene su timeout (STAGE_TIMEOUTS: conexión y lectura, en
+segundos); ninguna llamada queda colgada sin límite. Gemini recibe un solo
+valor por llamada (el de lectura): su SDK no separa conexión y lectura.
+
+warm_up_connections() resuelve DNS y abre la conexión TLS a cada host en un
+hilo al arrancar el worker, así el primer análisis no paga el handshake.
+get_transport_stats() reporta, por etapa, requests, errores, timeouts y
+latencia, y por pool las conexiones abiertas frente a los requests servidos.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+# Hosts distintos con pool propio, y conexiones keep-alive por host
+HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', 8))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 16))
+HTTP_WARMUP_ENABLED = os.getenv('HTTP_WARMUP_ENABLED', 'true').lower() == 'true'
+
+# Etapa -> (timeout de conexión, timeout de lectura)
+STAGE_TIMEOUTS = {
+    'download': (HTTP_CONNECT_TIMEOUT, float(os.getenv('DOWNLOAD_READ_TIMEOUT', 30))),
+    'cloudinary': (HTTP_CONNECT_TIMEOUT, float(os.getenv('CLOUDINARY_READ_TIMEOUT', 60))),
+    'gemini_text': (HTTP_CONNECT_TIMEOUT, float(os.getenv('GEMINI_TEXT_TIMEOUT', 60))),
+    'gemini_image': (HTTP_CONNECT_TIMEOUT, float(os.getenv('GEMINI_IMAGE_TIMEOUT', 120))),
+    'gemini_files': (HTTP_CONNECT_TIMEOUT, float(os.getenv('GEMINI_FILES_TIMEOUT', 30))),
+}
+
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/"
+CLOUDINARY_API_URL = "https://api.cloudinary.com/"
+CLOUDINARY_CDN_URL = "https://res.cloudinary.com/"
+
+_lock = threading.Lock()
+_session = None
+_async_client = None
+_gemini_http = None
+_gemini_async_http = None
+_genai_client = None
+_stage_stats = {}
+
+
+def stage_timeout(stage):
+    """(conexión, lectura) en segundos para una etapa"""
+    return STAGE_TIMEOUTS[stage]
+
+
+def _httpx_limits():
+    return httpx.Limits(max_connections=HTTP_POOL_MAXSIZE * HTTP_POOL_HOSTS,
+                        max_keepalive_connections=HTTP_POOL_MAXSIZE)
+
+
+def get_http_session():
+    """requests.Session compartido (descargas por URL), con pool keep-alive por host"""
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def get_async_http_client():
+    """httpx.AsyncClient compartido para descargas desde el motor asíncrono"""
+    global _async_client
+    with _lock:
+        if _async_client is None:
+            connect, read = stage_timeout('download')
+            _async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=_httpx_limits()
+            )
+        return _async_client
+
+
+def get_genai_client():
+    """
+    Cliente de Gemini (se crea una vez, al primer uso) sobre los pools httpx
+    de este módulo. Requiere GOOGLE_API_KEY.
+    """
+    global _genai_client, _gemini_http, _gemini_async_http
+    with _lock:
+        if _genai_client is None:
+            from google import genai
+            from google.genai import types
+
+            connect, read = stage_timeout('gemini_image')
+            timeout = httpx.Timeout(read, connect=connect)
+            _gemini_http = httpx.Client(timeout=timeout, limits=_httpx_limits())
+            _gemini_async_http = httpx.AsyncClient(timeout=timeout, limits=_httpx_limits())
+            _genai_client = genai.Client(
+                api_key=os.getenv('GOOGLE_API_KEY'),
+                http_options=types.HttpOptions(
+                    httpx_client=_gemini_http,
+                    httpx_async_client=_gemini_async_http
+                )
+            )
+        return _genai_client
+
+
+def set_genai_client(client):
+    """Reemplaza el cliente de Gemini en uso"""
+    global _genai_client
+    with _lock:
+        _genai_client = client
+
+
+def _is_timeout(error):
+    if isinstance(error, (requests.exceptions.Timeout, httpx.TimeoutException,
+                          urllib3.exceptions.TimeoutError, TimeoutError)):
+        return True
+    # Los SDK suelen envolver el error original en uno propio
+    return 'timed out' in str(error).lower() or 'timeout' in type(error).__name__.lower()
+
+
+@contextmanager
+def track(stage):
+    """Cuenta un request de la etapa (duración, error y timeout)"""
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with _lock:
+            stats = _stage_stats.setdefault(stage, {
+                "requests": 0, "errors": 0, "timeouts": 0, "total_ms": 0.0, "max_ms": 0.0
+            })
+            stats["requests"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            if isinstance(error, Exception):
+                stats["errors"] += 1
+                if _is_timeout(error):
+                    stats["timeouts"] += 1
+
+
+def _urllib3_pool_stats(pool_manager):
+    """Conexiones abiertas y requests servidos por host de un PoolManager"""
+    pools = {}
+    for key in list(pool_manager.pools.keys()):
+        pool = pool_manager.pools.get(key)
+        if pool is None:
+            continue
+        pools[f"{pool.scheme}://{pool.host}"] = {
+            "connections_opened": pool.num_connections,
+            "requests": pool.num_requests,
+            "idle": pool.pool.qsize() if pool.pool is not None else 0
+        }
+    return pools
+
+
+def _httpx_pool_stats(client):
+    pool = getattr(getattr(client, '_transport', None), '_pool', None)
+    connections = getattr(pool, 'connections', None)
+    if connections is None:
+        return None
+    return {
+        "open": len(connections),
+        "idle": sum(1 for connection in connections if connection.is_idle())
+    }
+
+
+def _cloudinary_http():
+    try:
+        import cloudinary.uploader
+        return getattr(cloudinary.uploader, '_http', None)
+    except ImportError:
+        return None
+
+
+def get_transport_stats():
+    """
+    Returns:
+        dict: {"stages": métricas por etapa, "pools": uso de cada pool}
+    """
+    with _lock:
+        stages = {}
+        for stage, stats in _stage_stats.items():
+            stages[stage] = {
+                **stats,
+                "total_ms": round(stats["total_ms"], 1),
+                "max_ms": round(stats["max_ms"], 1),
+                "avg_ms": round(stats["total_ms"] / stats["requests"], 1) if stats["requests"] else 0,
+                "timeout": stage_timeout(stage) if stage in STAGE_TIMEOUTS else None
+            }
+        session, gemini_http, gemini_async_http = _session, _gemini_http, _gemini_async_http
+
+    pools = {}
+    if session is not None:
+        pools["download"] = _urllib3_pool_stats(session.get_adapter('https://').poolmanager)
+    cloudinary_http = _cloudinary_http()
+    if cloudinary_http is not None and hasattr(cloudinary_http, 'pools'):
+        pools["cloudinary"] = _urllib3_pool_stats(cloudinary_http)
+    if gemini_http is not None:
+        pools["gemini"] = _httpx_pool_stats(gemini_http)
+    if gemini_async_http is not None:
+        pools["gemini_async"] = _httpx_pool_stats(gemini_async_http)
+    return {"stages": stages, "pools": pools}
+
+
+def _warm(name, request):
+    start = time.perf_counter()
+    try:
+        request()
+        print(f"[HTTP] Conexión con {name} lista en {(time.perf_counter() - start) * 1000:.0f}ms")
+    except Exception as e:
+        print(f"[HTTP] No se pudo precalentar {name}: {e}")
+
+
+def warm_up_connections(background=True):
+    """
+    Abre (DNS + TLS) una conexión keep-alive a Gemini y Cloudinary en cada
+    pool, para que el primer análisis no pague el handshake. Se desactiva con
+    HTTP_WARMUP_ENABLED=false.
+    """
+    if not HTTP_WARMUP_ENABLED:
+        return
+
+    def run():
+        connect, _ = STAGE_TIMEOUTS['download']
+        if os.getenv('GOOGLE_API_KEY'):
+            get_genai_client()
+            if _gemini_http is not None:
+                _warm("Gemini", lambda: _gemini_http.head(GEMINI_BASE_URL, timeout=connect))
+        cloudinary_http = _cloudinary_http()
+        if cloudinary_http is not None and hasattr(cloudinary_http, 'pools'):
+            _warm("Cloudinary", lambda: cloudinary_http.request(
+                'HEAD', CLOUDINARY_API_URL, timeout=urllib3.Timeout(connect=connect, read=connect), retries=False
+            ))
+        session = get_http_session()
+        _warm("Cloudinary CDN", lambda: session.head(CLOUDINARY_CDN_URL, timeout=(connect, connect)))
+
+    if background:
+        threading.Thread(target=run, name="http-warmup", daemon=True).start()
+    else:
+        run()
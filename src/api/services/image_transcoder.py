@@ -0,0 +1,109 @@
+"""
+Etapa de post-procesamiento de las imágenes generadas.
+
+Gemini devuelve PNG a resolución completa. Por cada imagen se generan dos
+variantes livianas con Pillow:
+
+- preview: lado mayor PREVIEW_MAX_EDGE, calidad baja; se envía primero para
+  que el cliente vea algo cuanto antes.
+- full: resolución original re-codificada (WebP o JPEG progresivo).
+
+La codificación corre en un pool de hilos propio (Pillow libera el GIL al
+codificar), así no ocupa los workers que esperan a Gemini ni bloquea el stream.
+Las variantes se guardan en el almacén de blobs como cualquier otra imagen.
+"""
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, features
+
+from .blob_store import open_blob, store_image
+
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', 2))
+PREVIEW_MAX_EDGE = int(os.getenv('PREVIEW_MAX_EDGE', 512))
+PREVIEW_QUALITY = int(os.getenv('PREVIEW_QUALITY', 60))
+FULL_QUALITY = int(os.getenv('FULL_QUALITY', 85))
+# Formato de las variantes: webp | jpeg (JPEG progresivo)
+IMAGE_VARIANT_FORMAT = os.getenv('IMAGE_VARIANT_FORMAT', 'webp').lower()
+if IMAGE_VARIANT_FORMAT == 'webp' and not features.check('webp'):
+    print("[TRANSCODE] Pillow sin soporte WebP, usando JPEG progresivo")
+    IMAGE_VARIANT_FORMAT = 'jpeg'
+
+_pool = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix="transcode")
+
+
+def _encode(img, quality):
+    """Codifica en el formato configurado. Returns: (bytes, mime_type)"""
+    buffer = io.BytesIO()
+    if IMAGE_VARIANT_FORMAT == 'jpeg':
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.save(buffer, 'JPEG', quality=quality, progressive=True, optimize=True)
+        return buffer.getvalue(), 'image/jpeg'
+    img.save(buffer, 'WEBP', quality=quality, method=4)
+    return buffer.getvalue(), 'image/webp'
+
+
+def _make_variant(digest, max_edge, quality):
+    """
+    Genera una variante de la imagen guardada en `digest`.
+
+    Returns:
+        dict: {"url", "blob", "mime_type", "width", "height", "bytes"}
+    """
+    with open_blob(digest) as mapped:
+        original_size = len(mapped)
+        with Image.open(io.BytesIO(mapped)) as img:
+            img.load()
+            if max_edge and max(img.size) > max_edge:
+                img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            data, mime_type = _encode(img, quality)
+            width, height = img.size
+
+    if max_edge is None and len(data) >= original_size:
+        # La re-codificación no ahorra nada: se usa el original
+        return None
+    return store_image(data, mime_type, width=width, height=height, bytes=len(data))
+
+
+def submit_preview(image_result):
+    """
+    Lanza en el pool la generación del preview de una imagen.
+
+    Args:
+        image_result: Registro de imagen (con "blob") de extract_image_result
+
+    Returns:
+        Future que resuelve al registro de la variante, o None si falla
+    """
+    return _pool.submit(_safe_variant, image_result['blob'], PREVIEW_MAX_EDGE, PREVIEW_QUALITY)
+
+
+def submit_full(image_result, on_done=None):
+    """
+    Lanza en el pool la re-codificación a resolución completa.
+
+    Args:
+        image_result: Registro de imagen (con "blob")
+        on_done: Callback opcional que recibe la variante (o None) y corre
+                 dentro de la misma tarea: cuando el future termina, el
+                 callback ya se ejecutó
+
+    Returns:
+        Future que resuelve al registro de la variante, o None
+    """
+    def task():
+        variant = _safe_variant(image_result['blob'], None, FULL_QUALITY)
+        if on_done:
+            on_done(variant)
+        return variant
+    return _pool.submit(task)
+
+
+def _safe_variant(digest, max_edge, quality):
+    try:
+        return _make_variant(digest, max_edge, quality)
+    except Exception as e:
+        print(f"[TRANSCODE] Error generando variante de {digest[:12]}: {e}")
+        return None
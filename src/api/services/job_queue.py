@@ -0,0 +1,467 @@
+"""
+Cola persistente de análisis.
+
+POST /api/analyze-face encola un trabajo y responde en seguida con su id
+(con JOB_QUEUE_ENABLED=false transmite el análisis directamente, en el motor
+asíncrono de api/asgi_routes.py). Un pool de workers lo consume: hilos del mismo proceso web (JOB_WORKERS) o un
+proceso aparte (src/worker.py, con JOB_WORKERS=0 en la web). Cada trabajo
+agrega sus eventos a un log (job_events) y /api/analyze-progress/<job_id>
+transmite ese log desde la capa ASGI, así el análisis no depende de la
+conexión del cliente ni ocupa un hilo de Flask mientras se sigue.
+
+La cola es un archivo SQLite en modo WAL compartido por todos los procesos
+del host. Los workers marcan un heartbeat mientras procesan; si un worker se
+reinicia, su trabajo vuelve a la cola (hasta JOB_MAX_ATTEMPTS intentos) y los
+checkpoints evitan repetir las llamadas a Gemini ya hechas.
+
+Un trabajo puede llevar una flight_key (selfie + datos del usuario): si ya
+hay uno en cola o en curso con la misma clave, enqueue retorna ese id en vez
+de crear otro, y el segundo cliente sigue el mismo log de eventos.
+
+Mientras un trabajo corre, el worker mantiene un ProgressTracker con su id:
+cada evento agregado lo notifica, así los streams se despiertan al instante
+(los de otro proceso, vía el store compartido de trackers) en vez de sondear
+el log.
+"""
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from .event_buffer import SSE_HEARTBEAT_SECONDS
+from .progress_tracker import cleanup_tracker, create_tracker, get_tracker
+
+# Con 'false' no se encola: el análisis se transmite directo y se pierde si el cliente se va
+JOB_QUEUE_ENABLED = os.getenv('JOB_QUEUE_ENABLED', 'true').lower() == 'true'
+JOB_QUEUE_DB = os.getenv(
+    'JOB_QUEUE_DB',
+    os.path.join(tempfile.gettempdir(), 'visagista_jobs.sqlite3')
+)
+# Hilos worker dentro del proceso web (0 = solo workers externos)
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+# Espera entre consultas cuando la cola está vacía (y la de los streams de
+# trabajos sin tracker visible, p. ej. con TRACKER_BACKEND=memory y el
+# trabajo en otro proceso)
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', 0.5))
+JOB_HEARTBEAT_SECONDS = float(os.getenv('JOB_HEARTBEAT_SECONDS', 10))
+# Un trabajo "running" sin heartbeat por más de esto vuelve a la cola
+JOB_STALE_SECONDS = float(os.getenv('JOB_STALE_SECONDS', 60))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 2))
+# Trabajos terminados (y su log) se borran pasado este tiempo
+JOB_TTL_HOURS = float(os.getenv('JOB_TTL_HOURS', 24))
+
+FINISHED_STATUSES = ('done', 'failed')
+
+
+class JobQueue:
+    """Trabajos y su log de eventos en SQLite"""
+
+    def __init__(self, path=JOB_QUEUE_DB):
+        self.path = path
+        self._local = threading.local()
+        # Despierta a los workers de este proceso al encolar
+        self._work_cond = threading.Condition()
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, payload TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, error TEXT, "
+            "created_at REAL, started_at REAL, heartbeat_at REAL, finished_at REAL)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if 'flight_key' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN flight_key TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_flight ON jobs (flight_key, status)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_events ("
+            "job_id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL, "
+            "PRIMARY KEY (job_id, seq)) WITHOUT ROWID"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, payload, flight_key=None):
+        """
+        Agrega un trabajo a la cola.
+
+        Args:
+            payload: Datos del trabajo (JSON)
+            flight_key: Clave de trabajos equivalentes; si uno con la misma
+                        clave está en cola o en curso, no se crea otro
+
+        Returns:
+            str: id del trabajo (el existente si se reutilizó)
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = None
+            if flight_key is not None:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE flight_key = ? AND status IN ('queued', 'running') "
+                    "ORDER BY created_at LIMIT 1",
+                    (flight_key,)
+                ).fetchone()
+            if row is None:
+                job_id = uuid.uuid4().hex
+                conn.execute(
+                    "INSERT INTO jobs (id, status, payload, flight_key, created_at) VALUES (?, 'queued', ?, ?, ?)",
+                    (job_id, json.dumps(payload), flight_key, time.time())
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is not None:
+            print(f"[JOBS] Análisis idéntico en curso, se reutiliza el trabajo {row[0]}")
+            return row[0]
+        with self._work_cond:
+            self._work_cond.notify()
+        return job_id
+
+    def wait_for_work(self, timeout):
+        """Espera un enqueue de este proceso (los de otros se ven al vencer el timeout)"""
+        with self._work_cond:
+            self._work_cond.wait(timeout)
+
+    def claim(self, worker_id):
+        """
+        Toma el trabajo en cola más antiguo.
+
+        Returns:
+            tuple: (job_id, payload, attempts) o None si la cola está vacía
+        """
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, payload, attempts FROM jobs WHERE status = 'queued' "
+                "ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, "
+                    "started_at = ?, heartbeat_at = ? WHERE id = ?",
+                    (worker_id, now, now, row[0])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        _, tracker = create_tracker(row[0])
+        tracker.start()
+        return row[0], json.loads(row[1]), row[2] + 1
+
+    def heartbeat(self, job_ids):
+        if not job_ids:
+            return
+        now = time.time()
+        self._connection().executemany(
+            "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'",
+            [(now, job_id) for job_id in job_ids]
+        )
+
+    def append_event(self, job_id, event):
+        """
+        Agrega un evento al log del trabajo.
+
+        Returns:
+            int: número de secuencia del evento (1, 2, ...)
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) + 1 FROM job_events WHERE job_id = ?", (job_id,)
+            ).fetchone()[0]
+            conn.execute(
+                "INSERT INTO job_events (job_id, seq, event) VALUES (?, ?, ?)",
+                (job_id, seq, json.dumps(event))
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        tracker = get_tracker(job_id)
+        if tracker is not None:
+            if event.get("type") == "progress":
+                tracker.update(event.get("progress", 0), event.get("status", ""))
+            else:
+                tracker.notify()
+        return seq
+
+    def finish(self, job_id, status, error=None):
+        self._connection().execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, error, time.time(), job_id)
+        )
+        tracker = get_tracker(job_id)
+        if tracker is not None:
+            tracker.complete()
+            cleanup_tracker(job_id)
+
+    def get_job(self, job_id):
+        row = self._connection().execute(
+            "SELECT status, attempts, error, created_at, started_at, finished_at "
+            "FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": job_id,
+            "status": row[0],
+            "attempts": row[1],
+            "error": row[2],
+            "created_at": row[3],
+            "started_at": row[4],
+            "finished_at": row[5]
+        }
+
+    def events_after(self, job_id, after_seq=0, limit=100):
+        """
+        Returns:
+            list: [(seq, evento)] con seq > after_seq, en orden
+        """
+        rows = self._connection().execute(
+            "SELECT seq, event FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (job_id, after_seq, limit)
+        ).fetchall()
+        return [(seq, json.loads(event)) for seq, event in rows]
+
+    def requeue_stale(self):
+        """
+        Devuelve a la cola los trabajos cuyo worker dejó de dar señales; los
+        que ya agotaron sus intentos se marcan como fallidos.
+
+        Returns:
+            list: [(job_id, requeued)] de los trabajos afectados
+        """
+        conn = self._connection()
+        cutoff = time.time() - JOB_STALE_SECONDS
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, attempts FROM jobs WHERE status = 'running' AND heartbeat_at < ?",
+                (cutoff,)
+            ).fetchall()
+            affected = []
+            for job_id, attempts in rows:
+                if attempts < JOB_MAX_ATTEMPTS:
+                    conn.execute("UPDATE jobs SET status = 'queued', worker = NULL WHERE id = ?", (job_id,))
+                    affected.append((job_id, True))
+                else:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                        ("El worker dejó de responder", time.time(), job_id)
+                    )
+                    affected.append((job_id, False))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return affected
+
+    def purge_finished(self, limit=None):
+        """
+        Borra los trabajos terminados hace más de JOB_TTL_HOURS y sus eventos.
+
+        Returns:
+            int: trabajos borrados
+        """
+        conn = self._connection()
+        cutoff = time.time() - JOB_TTL_HOURS * 3600
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            job_ids = [row[0] for row in conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ? LIMIT ?",
+                (cutoff, limit if limit is not None else -1)
+            )]
+            for job_id in job_ids:
+                conn.execute("DELETE FROM job_events WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(job_ids)
+
+    def stats(self):
+        counts = dict(self._connection().execute(
+            "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+        ).fetchall())
+        return {status: counts.get(status, 0) for status in ('queued', 'running', 'done', 'failed')}
+
+
+def stream_job_events(queue, job_id, after_seq=0, heartbeat=SSE_HEARTBEAT_SECONDS):
+    """
+    Genera los eventos del log de un trabajo desde after_seq y sigue los
+    nuevos hasta que el trabajo termina.
+
+    Espera en el tracker del trabajo; si no hay tracker visible (aún no
+    empezó, o corre en otro proceso con el store en memoria) consulta el log
+    cada JOB_POLL_SECONDS.
+
+    Yields:
+        tuple: (seq, evento), o None tras `heartbeat` segundos sin eventos
+    """
+    tracker = get_tracker(job_id)
+    last_sent = time.time()
+    while True:
+        version = tracker.version if tracker is not None else None
+        events = queue.events_after(job_id, after_seq)
+        for seq, event in events:
+            yield seq, event
+            after_seq = seq
+        if events:
+            last_sent = time.time()
+            continue
+
+        job = queue.get_job(job_id)
+        if job is None:
+            return
+        if job["status"] in FINISHED_STATUSES:
+            # Eventos escritos entre la última lectura y el cambio de estado
+            for seq, event in queue.events_after(job_id, after_seq):
+                yield seq, event
+            return
+
+        if tracker is not None:
+            tracker.wait_for_change(version, heartbeat)
+        else:
+            time.sleep(JOB_POLL_SECONDS)
+        # El trabajo pudo empezar (o reintentarse) mientras tanto
+        tracker = get_tracker(job_id)
+        if time.time() - last_sent >= heartbeat:
+            yield None
+            last_sent = time.time()
+
+
+class JobWorkerPool:
+    """
+    Hilos que toman trabajos de la cola y los ejecutan con `handler`.
+
+    handler(queue, job_id, payload, attempt) procesa el trabajo, agrega sus
+    eventos al log y retorna el estado final ('done' o 'failed').
+    """
+
+    def __init__(self, queue, handler, workers=JOB_WORKERS):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _work_loop(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self.queue.claim(self.worker_id)
+            except sqlite3.Error as e:
+                print(f"[JOBS] Error tomando trabajo: {e}")
+                claimed = None
+            if claimed is None:
+                self.queue.wait_for_work(JOB_POLL_SECONDS)
+                continue
+
+            job_id, payload, attempt = claimed
+            print(f"[JOBS] Procesando trabajo {job_id} (intento {attempt})")
+            with self._running_lock:
+                self._running.add(job_id)
+            try:
+                status = self.handler(self.queue, job_id, payload, attempt)
+                self.queue.finish(job_id, status or 'done')
+            except Exception as e:
+                print(f"[JOBS] Error en trabajo {job_id}: {e}")
+                self.queue.append_event(job_id, {"type": "error", "error": str(e)})
+                self.queue.finish(job_id, 'failed', str(e))
+            finally:
+                with self._running_lock:
+                    self._running.discard(job_id)
+
+    def _heartbeat_loop(self):
+        """Heartbeat de los trabajos en curso y recuperación de los abandonados"""
+        while not self._stop.wait(JOB_HEARTBEAT_SECONDS):
+            try:
+                with self._running_lock:
+                    running = list(self._running)
+                self.queue.heartbeat(running)
+                for job_id, requeued in self.queue.requeue_stale():
+                    if requeued:
+                        print(f"[JOBS] Trabajo {job_id} abandonado, vuelve a la cola")
+                    else:
+                        print(f"[JOBS] Trabajo {job_id} abandonado sin más intentos")
+                        self.queue.append_event(job_id, {"type": "error", "error": "El análisis se interrumpió"})
+            except sqlite3.Error as e:
+                print(f"[JOBS] Error en heartbeat: {e}")
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._work_loop, name=f"job-worker-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        self._threads.append(threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        print(f"[JOBS] {self.workers} workers consumiendo {self.queue.path}")
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Cola compartida del proceso (se crea en el primer uso)"""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue()
+    return _queue
+
+
+def start_job_workers(handler, workers=JOB_WORKERS):
+    """
+    Arranca el pool de workers del proceso.
+
+    Returns:
+        JobWorkerPool, o None si la cola está desactivada o workers == 0
+    """
+    if not JOB_QUEUE_ENABLED or workers <= 0:
+        return None
+    pool = JobWorkerPool(get_job_queue(), handler, workers)
+    pool.start()
+    return pool
+
+
+def purge_finished_jobs(limit=None):
+    """Borra trabajos terminados y vencidos (lo llama el barrido de caché)"""
+    if not JOB_QUEUE_ENABLED:
+        return 0
+    return get_job_queue().purge_finished(limit)
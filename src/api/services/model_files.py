@@ -0,0 +1,307 @@
+"""
+Selfie subida una sola vez al modelo y referenciada en cada etapa.
+
+Sin esto, cada llamada a Gemini del análisis (texto, selección de estilos,
+planificación, diseño de cada montura, cada imagen en rostro) reenvía los
+mismos bytes de la selfie dentro del request. Cada análisis abre una sesión
+de la selfie (selfie_session / selfie_session_async) alrededor de sus dos
+etapas: la selfie se sube a la Files API de Gemini y, antes de la primera
+llamada al modelo, se espera la subida como máximo
+SELFIE_FILE_UPLOAD_WAIT_SECONDS. Desde ahí todas las etapas envían solo su
+referencia (Part.from_uri); si la subida falla o tarda más, las llamadas
+usan los bytes inline hasta que esté lista.
+
+La sesión es por selfie (su SHA-256) con conteo de referencias: dos análisis
+simultáneos de la misma foto comparten el archivo, y al cerrarse el último
+el archivo se borra del lado del modelo. SELFIE_UPLOAD_BACKEND=inline es el
+stand-in local y de pruebas (sin API key de Gemini): no sube nada y la misma
+interfaz entrega la Part inline, igual que con una selfie menor que
+SELFIE_FILE_MIN_BYTES.
+"""
+import asyncio
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, contextmanager
+
+from google.genai import types
+
+from .http_transport import get_genai_client, stage_timeout, track
+
+# 'files' (Files API de Gemini) o 'inline' (bytes en cada request; local/pruebas)
+SELFIE_UPLOAD_BACKEND = os.getenv('SELFIE_UPLOAD_BACKEND', 'files').lower()
+# Por debajo de este tamaño la subida extra no compensa
+SELFIE_FILE_MIN_BYTES = int(os.getenv('SELFIE_FILE_MIN_BYTES', 64 * 1024))
+# La Files API conserva los archivos 48h; una referencia más vieja no se usa
+SELFIE_FILE_TTL_SECONDS = float(os.getenv('SELFIE_FILE_TTL_SECONDS', 47 * 3600))
+# Espera máxima a que un archivo recién subido quede ACTIVE
+SELFIE_FILE_ACTIVE_WAIT_SECONDS = float(os.getenv('SELFIE_FILE_ACTIVE_WAIT_SECONDS', 10))
+# Espera máxima a la subida antes de la primera llamada al modelo de un análisis
+SELFIE_FILE_UPLOAD_WAIT_SECONDS = float(os.getenv('SELFIE_FILE_UPLOAD_WAIT_SECONDS', 5))
+
+
+def inline_part(data, mime_type):
+    """Part con los bytes de la imagen dentro del request"""
+    return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+
+class InlineFileStore:
+    """Stand-in local: no sube nada, la referencia es la propia Part inline"""
+    name = 'inline'
+
+    def upload(self, data, mime_type, display_name):
+        return inline_part(data, mime_type), None
+
+    def delete(self, handle):
+        pass
+
+
+class GeminiFileStore:
+    """Files API de Gemini (solo cliente con API key, no Vertex)"""
+    name = 'files'
+
+    def _http_options(self):
+        _, read = stage_timeout('gemini_files')
+        return types.HttpOptions(timeout=int(read * 1000))
+
+    def upload(self, data, mime_type, display_name):
+        client = get_genai_client()
+        with track('gemini_files'):
+            file = client.files.upload(
+                file=io.BytesIO(data),
+                config=types.UploadFileConfig(
+                    mime_type=mime_type,
+                    display_name=display_name,
+                    http_options=self._http_options()
+                )
+            )
+            deadline = time.monotonic() + SELFIE_FILE_ACTIVE_WAIT_SECONDS
+            while file.state == types.FileState.PROCESSING and time.monotonic() < deadline:
+                time.sleep(0.5)
+                file = client.files.get(name=file.name)
+        if file.state not in (None, types.FileState.ACTIVE):
+            raise RuntimeError(f"archivo {file.name} en estado {file.state}")
+        return types.Part.from_uri(file_uri=file.uri, mime_type=file.mime_type or mime_type), file.name
+
+    def delete(self, handle):
+        with track('gemini_files'):
+            get_genai_client().files.delete(
+                name=handle, config=types.DeleteFileConfig(http_options=self._http_options())
+            )
+
+
+class _Reference:
+    __slots__ = ('refs', 'part', 'handle', 'uploaded_at', 'failed', 'upload')
+
+    def __init__(self):
+        self.upload = None  # Future de la subida en curso
+        self.refs = 0
+        self.part = None
+        self.handle = None
+        self.uploaded_at = None
+        self.failed = False
+
+
+class SelfieReferences:
+    """Sesiones por selfie: subida en segundo plano, Part para cada etapa y borrado al cerrar"""
+
+    def __init__(self, store, min_bytes=SELFIE_FILE_MIN_BYTES, ttl_seconds=SELFIE_FILE_TTL_SECONDS):
+        self.store = store
+        self.min_bytes = min_bytes
+        self.ttl_seconds = ttl_seconds
+        self._references = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="model-files")
+        self.metrics = {
+            "uploads": 0,
+            "upload_failures": 0,
+            "deletes": 0,
+            "delete_failures": 0,
+            "referenced": 0,
+            "inline": 0
+        }
+
+    def _count(self, metric):
+        with self._lock:
+            self.metrics[metric] += 1
+
+    def open_session(self, selfie):
+        """
+        Retiene la selfie para un análisis y, si es la primera sesión que la
+        usa, lanza su subida en segundo plano. No bloquea.
+        """
+        if selfie.size < self.min_bytes:
+            return
+        with self._lock:
+            reference = self._references.get(selfie.digest)
+            created = reference is None
+            if created:
+                reference = self._references[selfie.digest] = _Reference()
+            reference.refs += 1
+        if created:
+            reference.upload = self._executor.submit(self._upload, selfie.digest, selfie.data, selfie.mime_type)
+
+    def upload_future(self, selfie):
+        """Future de la subida de una selfie con sesión abierta (None si no hay)"""
+        if selfie.size < self.min_bytes:
+            return None
+        with self._lock:
+            reference = self._references.get(selfie.digest)
+            return reference.upload if reference is not None else None
+
+    def wait_for_upload(self, selfie, timeout=SELFIE_FILE_UPLOAD_WAIT_SECONDS):
+        """
+        Espera (como máximo `timeout`) a que termine la subida de la selfie.
+
+        Returns:
+            bool: True si la referencia quedó lista
+        """
+        future = self.upload_future(selfie)
+        if future is not None:
+            wait([future], timeout)
+        return self.is_ready(selfie)
+
+    async def wait_for_upload_async(self, selfie, timeout=SELFIE_FILE_UPLOAD_WAIT_SECONDS):
+        """Versión asíncrona de wait_for_upload (no ocupa un hilo mientras espera)"""
+        future = self.upload_future(selfie)
+        if future is not None:
+            await asyncio.wait([asyncio.wrap_future(future)], timeout=timeout)
+        return self.is_ready(selfie)
+
+    def is_ready(self, selfie):
+        with self._lock:
+            reference = self._references.get(selfie.digest)
+            return reference is not None and reference.part is not None
+
+    def _upload(self, digest, data, mime_type):
+        try:
+            part, handle = self.store.upload(data, mime_type, f"selfie-{digest[:16]}")
+        except Exception as e:
+            print(f"[FILES] No se pudo subir la selfie ({self.store.name}), se envía inline: {e}")
+            self._count("upload_failures")
+            with self._lock:
+                reference = self._references.get(digest)
+                if reference is not None:
+                    reference.failed = True
+            return
+        self._count("uploads")
+        with self._lock:
+            reference = self._references.get(digest)
+            if reference is not None:
+                reference.part, reference.handle = part, handle
+                reference.uploaded_at = time.monotonic()
+                return
+        # La sesión se cerró durante la subida
+        self._delete(handle)
+
+    def part(self, selfie):
+        """
+        Part de la selfie (SelfieBlob) para una llamada: la referencia subida
+        si ya está lista, los bytes inline si no. Usa el digest que el blob
+        ya calculó, sin volver a hashear la imagen.
+        """
+        if selfie.size >= self.min_bytes:
+            with self._lock:
+                reference = self._references.get(selfie.digest)
+                if reference is not None and reference.part is not None \
+                        and time.monotonic() - reference.uploaded_at < self.ttl_seconds:
+                    self.metrics["referenced"] += 1
+                    return reference.part
+        self._count("inline")
+        return inline_part(selfie.data, selfie.mime_type)
+
+    def close_session(self, selfie):
+        """Libera la selfie; la última sesión borra el archivo en segundo plano"""
+        if selfie.size < self.min_bytes:
+            return
+        with self._lock:
+            reference = self._references.get(selfie.digest)
+            if reference is None:
+                return
+            reference.refs -= 1
+            if reference.refs > 0:
+                return
+            del self._references[selfie.digest]
+        if reference.handle is not None:
+            self._executor.submit(self._delete, reference.handle)
+
+    def _delete(self, handle):
+        if handle is None:
+            return
+        try:
+            self.store.delete(handle)
+            self._count("deletes")
+        except Exception as e:
+            # La Files API lo borra sola a las 48h
+            print(f"[FILES] No se pudo borrar {handle}: {e}")
+            self._count("delete_failures")
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self.metrics,
+                "backend": self.store.name,
+                "sessions": len(self._references),
+                "ready": sum(1 for reference in self._references.values() if reference.part is not None),
+                "failed": sum(1 for reference in self._references.values() if reference.failed)
+            }
+
+
+_references = None
+_references_lock = threading.Lock()
+
+
+def get_selfie_references():
+    """Sesiones de selfie del proceso, con el backend de SELFIE_UPLOAD_BACKEND"""
+    global _references
+    with _references_lock:
+        if _references is None:
+            store = GeminiFileStore() if SELFIE_UPLOAD_BACKEND == 'files' else InlineFileStore()
+            _references = SelfieReferences(store)
+        return _references
+
+
+def set_selfie_references(references):
+    """Reemplaza las sesiones de selfie en uso (por ejemplo con InlineFileStore)"""
+    global _references
+    with _references_lock:
+        _references = references
+
+
+def selfie_part(selfie):
+    return get_selfie_references().part(selfie)
+
+
+@contextmanager
+def selfie_session(selfie):
+    """
+    Sesión de la selfie durante un análisis completo: la sube, espera la
+    subida (SELFIE_FILE_UPLOAD_WAIT_SECONDS) y la libera al salir.
+    """
+    references = get_selfie_references()
+    references.open_session(selfie)
+    try:
+        if not references.wait_for_upload(selfie) and selfie.size >= references.min_bytes:
+            print("[FILES] La selfie no se subió a tiempo, las primeras etapas la envían inline")
+        yield selfie
+    finally:
+        references.close_session(selfie)
+
+
+@asynccontextmanager
+async def selfie_session_async(selfie):
+    """Versión asíncrona de selfie_session"""
+    references = get_selfie_references()
+    references.open_session(selfie)
+    try:
+        if not await references.wait_for_upload_async(selfie) and selfie.size >= references.min_bytes:
+            print("[FILES] La selfie no se subió a tiempo, las primeras etapas la envían inline")
+        yield selfie
+    finally:
+        references.close_session(selfie)
+
+
+def get_file_stats():
+    return get_selfie_references().stats()
@@ -1,34 +1,100 @@
 """
 Utilidad para tracking de progreso en tiempo real
 Usa un sistema de eventos para reportar progreso al frontend
+
+Cada cambio se publica por una variable de condición: quien sigue el
+progreso se bloquea en wait_for_change hasta un cambio real (o hasta que
+pasa su intervalo de heartbeat), sin sondear.
+
+Los trackers viven en un store configurable (TRACKER_BACKEND):
+
+- memory: diccionario del proceso (un solo worker).
+- sqlite: una fila por tracker en un archivo SQLite (WAL) compartido por
+  todos los workers del host. Cada actualización es un UPDATE de una fila;
+  un suscriptor de otro proceso lee solo la versión, primero cada
+  TRACKER_POLL_SECONDS y, mientras no haya cambios, con un intervalo que se
+  duplica hasta TRACKER_POLL_MAX_SECONDS. Los del mismo proceso se
+  despiertan al instante.
+
+Las instancias de cada proceso están en un registro acotado: como máximo
+TRACKER_MAX_ENTRIES, y las que pasan TRACKER_IDLE_TTL_SECONDS sin cambios se
+expulsan (al crear o buscar trackers, y en el barrido periódico). Así un
+tracker cuyo cliente nunca llegó al 100% no queda en memoria para siempre.
 """
+import os
+import sqlite3
+import tempfile
 import time
-from threading import Lock
+from collections import OrderedDict
+from threading import Condition, Lock, local
 import uuid
 
+TRACKER_BACKEND = os.getenv('TRACKER_BACKEND', 'sqlite')
+TRACKER_DB = os.getenv(
+    'TRACKER_DB',
+    os.path.join(tempfile.gettempdir(), 'visagista_trackers.sqlite3')
+)
+# Cada cuánto un suscriptor revisa cambios hechos por otro proceso: empieza
+# en TRACKER_POLL_SECONDS y se duplica sin cambios hasta el máximo
+TRACKER_POLL_SECONDS = float(os.getenv('TRACKER_POLL_SECONDS', 0.2))
+TRACKER_POLL_MAX_SECONDS = float(os.getenv('TRACKER_POLL_MAX_SECONDS', 2.0))
+TRACKER_MAX_ENTRIES = int(os.getenv('TRACKER_MAX_ENTRIES', 1000))
+# Un tracker sin cambios durante este tiempo se considera abandonado
+TRACKER_IDLE_TTL_SECONDS = float(os.getenv('TRACKER_IDLE_TTL_SECONDS', 900))
+
 class ProgressTracker:
     """Rastrea el progreso de operaciones asíncronas"""
-    
+
+    # Sin __dict__ por instancia: puede haber miles de trackers vivos
+    __slots__ = ('progress', 'status', 'lock', 'start_time', 'version', 'touched_at')
+
+    estimated_total = 60  # segundos estimados
+
     def __init__(self):
         self.progress = 0
         self.status = "Iniciando..."
-        self.lock = Lock()
+        self.lock = Condition()
         self.start_time = None
-        self.estimated_total = 60  # segundos estimados
-    
+        self.version = 0  # Aumenta con cada cambio publicado
+        self.touched_at = time.monotonic()  # Último cambio (para expirar por inactividad)
+
+    def _publish(self):
+        """Registra un cambio y despierta a los suscriptores (con el lock tomado)"""
+        self.version += 1
+        self.touched_at = time.monotonic()
+        self.lock.notify_all()
+
     def start(self):
         """Inicia el tracking"""
         with self.lock:
             self.start_time = time.time()
             self.progress = 0
             self.status = "Iniciando análisis..."
-    
+            self._publish()
+
     def update(self, progress, status):
         """Actualiza el progreso (0-100)"""
         with self.lock:
             self.progress = min(100, max(0, progress))
             self.status = status
-    
+            self._publish()
+
+    def notify(self):
+        """Publica un cambio sin modificar el progreso (p. ej. un evento nuevo en el log)"""
+        with self.lock:
+            self._publish()
+
+    def wait_for_change(self, version, timeout=None):
+        """
+        Bloquea hasta que haya un cambio posterior a `version` o pase `timeout`.
+
+        Returns:
+            int: versión actual (igual a `version` si venció el timeout)
+        """
+        with self.lock:
+            self.lock.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
     def get_progress(self):
         """Obtiene el progreso actual"""
         with self.lock:
@@ -39,38 +105,363 @@ class ProgressTracker:
                 actual_progress = max(self.progress, time_based_progress)
             else:
                 actual_progress = self.progress
-            
+
             return {
                 "progress": int(actual_progress),
                 "status": self.status,
                 "elapsed": int(elapsed)
             }
-    
+
     def complete(self):
         """Marca como completado"""
         with self.lock:
             self.progress = 100
             self.status = "Completado"
+            self._publish()
+
+class SharedProgressTracker(ProgressTracker):
+    """
+    Tracker cuyo estado vive en SQLiteTrackerStore: lo que publica un proceso
+    lo ven los demás.
+    """
+
+    __slots__ = ('store', 'session_id', 'owned')
+
+    def __init__(self, store, session_id, owned=False):
+        super().__init__()
+        self.store = store
+        self.session_id = session_id
+        self.owned = owned  # Creado (y actualizado) por este proceso
+
+    def _publish(self):
+        self.version = self.store.save(self)
+        self.touched_at = time.monotonic()
+        self.lock.notify_all()
+
+    def refresh(self):
+        """Carga el estado guardado si otro proceso lo cambió"""
+        # Solo la versión; la fila completa únicamente si cambió
+        version = self.store.version(self.session_id)
+        if version is not None and version == self.version:
+            return
+        row = self.store.load(self.session_id)
+        with self.lock:
+            if row is None:
+                # Borrado: el trabajo terminó y su worker limpió el tracker
+                if self.progress < 100:
+                    self.progress = 100
+                    self.status = "Completado"
+                    self.version += 1
+                    self.lock.notify_all()
+                return
+            progress, status, start_time, version = row
+            if version != self.version:
+                self.progress, self.status, self.start_time, self.version = progress, status, start_time, version
+                self.touched_at = time.monotonic()
+                self.lock.notify_all()
+
+    def get_progress(self):
+        self.refresh()
+        return super().get_progress()
+
+    def wait_for_change(self, version, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        poll = TRACKER_POLL_SECONDS
+        while True:
+            remaining = poll
+            if deadline is not None:
+                remaining = min(remaining, deadline - time.time())
+            if remaining > 0:
+                # Un cambio de este proceso despierta al instante
+                current = super().wait_for_change(version, remaining)
+                if current != version:
+                    return current
+            self.refresh()
+            if self.version != version or (deadline is not None and time.time() >= deadline):
+                return self.version
+            poll = min(poll * 2, TRACKER_POLL_MAX_SECONDS)
+
+
+class TrackerRegistry:
+    """
+    Trackers del proceso por session_id, en orden de uso (LRU), acotados en
+    cantidad y con TTL de inactividad.
+
+    La expulsión perezosa (en add/get) solo mira el extremo menos usado, así
+    que cuesta O(1) amortizado; evict_idle() recorre todo el registro y la
+    llama el barrido periódico.
+    """
+
+    def __init__(self, max_entries=TRACKER_MAX_ENTRIES, idle_ttl=TRACKER_IDLE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self._trackers = OrderedDict()
+        self._lock = Lock()
+        self.evicted_idle = 0
+        self.evicted_overflow = 0
+
+    def add(self, session_id, tracker):
+        """Registra un tracker (si ya hay uno con ese id, se conserva el existente)"""
+        with self._lock:
+            tracker = self._trackers.setdefault(session_id, tracker)
+            self._trackers.move_to_end(session_id)
+            self._evict_lazy()
+            return tracker
+
+    def get(self, session_id):
+        with self._lock:
+            tracker = self._trackers.get(session_id)
+            if tracker is not None:
+                if self._is_idle(tracker, time.monotonic()):
+                    del self._trackers[session_id]
+                    self.evicted_idle += 1
+                    return None
+                self._trackers.move_to_end(session_id)
+            self._evict_lazy()
+            return tracker
+
+    def pop(self, session_id):
+        with self._lock:
+            return self._trackers.pop(session_id, None)
+
+    def evict_idle(self):
+        """
+        Expulsa todos los trackers inactivos.
+
+        Returns:
+            list: session_id expulsados
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [sid for sid, tracker in self._trackers.items() if self._is_idle(tracker, now)]
+            for session_id in expired:
+                del self._trackers[session_id]
+            self.evicted_idle += len(expired)
+        return expired
+
+    def _is_idle(self, tracker, now):
+        return now - tracker.touched_at > self.idle_ttl
+
+    def _evict_lazy(self):
+        """Con el lock tomado: inactivos al frente y, si sobra, los menos usados"""
+        now = time.monotonic()
+        while self._trackers:
+            session_id, tracker = next(iter(self._trackers.items()))
+            if self._is_idle(tracker, now):
+                self.evicted_idle += 1
+            elif len(self._trackers) > self.max_entries:
+                self.evicted_overflow += 1
+            else:
+                break
+            del self._trackers[session_id]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._trackers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._trackers),
+                "max_entries": self.max_entries,
+                "idle_ttl_seconds": self.idle_ttl,
+                "evicted_idle": self.evicted_idle,
+                "evicted_overflow": self.evicted_overflow
+            }
+
+
+class MemoryTrackerStore:
+    """Trackers en un diccionario del proceso"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._registry = TrackerRegistry()
+
+    def create(self, session_id):
+        tracker = ProgressTracker()
+        self._registry.pop(session_id)
+        return self._registry.add(session_id, tracker)
+
+    def get(self, session_id):
+        return self._registry.get(session_id)
+
+    def delete(self, session_id):
+        self._registry.pop(session_id)
+
+    def evict_idle(self):
+        """Returns: int: trackers expulsados"""
+        return len(self._registry.evict_idle())
+
+    def stats(self):
+        registry = self._registry.stats()
+        return {"backend": self.name, "trackers": registry["size"], "registry": registry}
+
+
+class SQLiteTrackerStore:
+    """Trackers en un archivo SQLite (WAL) compartido por los workers del host"""
+
+    name = 'sqlite'
+
+    def __init__(self, path=TRACKER_DB):
+        self.path = path
+        self._local = local()
+        # Instancias de este proceso: los suscriptores locales comparten la condición
+        self._registry = TrackerRegistry()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS trackers ("
+            "session_id TEXT PRIMARY KEY, progress INTEGER, status TEXT, "
+            "start_time REAL, version INTEGER, updated_at REAL)"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self, session_id):
+        tracker = SharedProgressTracker(self, session_id, owned=True)
+        self._connection().execute(
+            "INSERT OR REPLACE INTO trackers (session_id, progress, status, start_time, version, updated_at) "
+            "VALUES (?, ?, ?, ?, 0, ?)",
+            (session_id, tracker.progress, tracker.status, tracker.start_time, time.time())
+        )
+        self._registry.pop(session_id)
+        return self._registry.add(session_id, tracker)
+
+    def get(self, session_id):
+        tracker = self._registry.get(session_id)
+        if tracker is not None:
+            # Sin consultar la base: si otro proceso lo borra, el próximo
+            # refresh() de la instancia lo da por completado
+            return tracker
+        if self.version(session_id) is None:
+            return None
+        # Tracker creado por otro proceso
+        tracker = SharedProgressTracker(self, session_id)
+        tracker.refresh()
+        return self._registry.add(session_id, tracker)
+
+    def delete(self, session_id):
+        self._connection().execute("DELETE FROM trackers WHERE session_id = ?", (session_id,))
+        self._registry.pop(session_id)
+
+    def evict_idle(self):
+        """
+        Expulsa las instancias inactivas del proceso y borra las filas sin
+        cambios hace más del TTL (de cualquier worker).
+
+        Returns:
+            int: trackers expulsados
+        """
+        evicted = len(self._registry.evict_idle())
+        cutoff = time.time() - self._registry.idle_ttl
+        evicted += self._connection().execute(
+            "DELETE FROM trackers WHERE updated_at < ?", (cutoff,)
+        ).rowcount
+        return evicted
+
+    def save(self, tracker):
+        """
+        Guarda el estado de un tracker (una fila, un UPDATE).
+        La versión nueva se lee en la misma transacción: UPDATE ... RETURNING
+        necesitaría SQLite 3.35 o posterior.
+
+        Returns:
+            int: nueva versión
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE trackers SET progress = ?, status = ?, start_time = ?, "
+                "version = version + 1, updated_at = ? WHERE session_id = ?",
+                (tracker.progress, tracker.status, tracker.start_time, time.time(), tracker.session_id)
+            )
+            row = conn.execute(
+                "SELECT version FROM trackers WHERE session_id = ?", (tracker.session_id,)
+            ).fetchone()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row[0] if row else tracker.version + 1
+
+    def version(self, session_id):
+        """
+        Returns:
+            int: versión guardada del tracker, o None si no existe
+        """
+        row = self._connection().execute(
+            "SELECT version FROM trackers WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def load(self, session_id):
+        """
+        Returns:
+            tuple: (progress, status, start_time, version) o None
+        """
+        return self._connection().execute(
+            "SELECT progress, status, start_time, version FROM trackers WHERE session_id = ?",
+            (session_id,)
+        ).fetchone()
+
+    def stats(self):
+        count = self._connection().execute("SELECT COUNT(*) FROM trackers").fetchone()[0]
+        registry = self._registry.stats()
+        return {
+            "backend": self.name,
+            "trackers": count,
+            "local_trackers": registry["size"],
+            "registry": registry
+        }
+
+
+_store = None
+_store_lock = Lock()
+
+
+def get_tracker_store():
+    """
+    Store configurado en TRACKER_BACKEND (memory | sqlite).
+    Si no se puede abrir, se usa memoria.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            try:
+                _store = SQLiteTrackerStore() if TRACKER_BACKEND == 'sqlite' else MemoryTrackerStore()
+            except Exception as e:
+                print(f"[TRACKER] No se pudo abrir el store '{TRACKER_BACKEND}', usando memoria: {e}")
+                _store = MemoryTrackerStore()
+        return _store
+
+
+def set_tracker_store(store):
+    """Reemplaza el store en uso"""
+    global _store
+    with _store_lock:
+        _store = store
 
-# Diccionario global de trackers por session_id
-_trackers = {}
-_trackers_lock = Lock()
 
-def create_tracker():
-    """Crea un nuevo tracker con un ID único"""
-    session_id = str(uuid.uuid4())
-    with _trackers_lock:
-        _trackers[session_id] = ProgressTracker()
-    return session_id, _trackers[session_id]
+def create_tracker(session_id=None):
+    """Crea un nuevo tracker (con un ID único si no se indica uno)"""
+    session_id = session_id or str(uuid.uuid4())
+    return session_id, get_tracker_store().create(session_id)
 
 def get_tracker(session_id):
-    """Obtiene un tracker por su session_id"""
-    with _trackers_lock:
-        return _trackers.get(session_id)
+    """Obtiene un tracker por su session_id (también si lo creó otro worker)"""
+    return get_tracker_store().get(session_id)
 
 def cleanup_tracker(session_id):
     """Elimina un tracker cuando ya no se necesita"""
-    with _trackers_lock:
-        if session_id in _trackers:
-            del _trackers[session_id]
+    get_tracker_store().delete(session_id)
 
+def evict_idle_trackers():
+    """Expulsa los trackers abandonados (lo llama el barrido periódico)"""
+    return get_tracker_store().evict_idle()
@@ -0,0 +1,331 @@
+"""
+Limitador de tasa (token bucket) compartido para las llamadas a Gemini.
+
+Cada modelo tiene su propio bucket. El estado vive en SQLite para que todos
+los hilos y todos los workers de gunicorn de una misma máquina compartan la
+misma cuota. Cuando no hay tokens, cada llamada reserva su propio turno
+(los tokens pueden quedar en negativo), así que las ráfagas se escalonan en
+el tiempo en lugar de chocar todas contra un 429.
+"""
+import os
+import re
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'sqlite')
+RATE_LIMIT_DB = os.getenv(
+    'RATE_LIMIT_DB',
+    os.path.join(tempfile.gettempdir(), 'visagista_rate_limits.sqlite3')
+)
+
+# Backoff full-jitter: espera aleatoria en [0, min(cap, base * 2^intento)]
+RETRY_BASE_DELAY = float(os.getenv('GEMINI_RETRY_BASE_DELAY', 2))
+RETRY_MAX_DELAY = float(os.getenv('GEMINI_RETRY_MAX_DELAY', 20))
+
+
+class RateLimitTimeout(Exception):
+    """La espera necesaria para obtener un token supera el máximo permitido"""
+
+
+class MemoryBucketBackend:
+    """Buckets en memoria del proceso (compartidos solo entre hilos)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}
+
+    def reserve(self, bucket, rate, capacity, now, max_wait=None):
+        with self._lock:
+            tokens, updated, blocked_until = self._state.get(bucket, (capacity, now, 0.0))
+            wait, tokens = _reserve_token(tokens, updated, blocked_until, rate, capacity, now)
+            if max_wait is not None and wait > max_wait:
+                return wait, False
+            self._state[bucket] = (tokens, now, blocked_until)
+            return wait, True
+
+    def block(self, bucket, until, capacity, now):
+        with self._lock:
+            tokens, updated, blocked_until = self._state.get(bucket, (capacity, now, 0.0))
+            blocked_until = max(blocked_until, until)
+            # Vaciar el bucket: al terminar el bloqueo los turnos salen escalonados
+            self._state[bucket] = (min(tokens, 0.0), blocked_until, blocked_until)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._state)
+
+
+class SQLiteBucketBackend:
+    """Buckets en un archivo SQLite compartido por todos los workers del host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "name TEXT PRIMARY KEY, tokens REAL, updated REAL, blocked_until REAL)"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _load(self, conn, bucket, capacity, now):
+        row = conn.execute(
+            "SELECT tokens, updated, blocked_until FROM buckets WHERE name = ?",
+            (bucket,)
+        ).fetchone()
+        return row if row else (capacity, now, 0.0)
+
+    def reserve(self, bucket, rate, capacity, now, max_wait=None):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tokens, updated, blocked_until = self._load(conn, bucket, capacity, now)
+            wait, tokens = _reserve_token(tokens, updated, blocked_until, rate, capacity, now)
+            granted = max_wait is None or wait <= max_wait
+            if granted:
+                conn.execute(
+                    "INSERT OR REPLACE INTO buckets (name, tokens, updated, blocked_until) "
+                    "VALUES (?, ?, ?, ?)",
+                    (bucket, tokens, now, blocked_until)
+                )
+            conn.execute("COMMIT")
+            return wait, granted
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def block(self, bucket, until, capacity, now):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tokens, updated, blocked_until = self._load(conn, bucket, capacity, now)
+            blocked_until = max(blocked_until, until)
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (name, tokens, updated, blocked_until) "
+                "VALUES (?, ?, ?, ?)",
+                (bucket, min(tokens, 0.0), blocked_until, blocked_until)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def snapshot(self):
+        rows = self._connection().execute(
+            "SELECT name, tokens, updated, blocked_until FROM buckets"
+        ).fetchall()
+        return {name: (tokens, updated, blocked_until) for name, tokens, updated, blocked_until in rows}
+
+
+def _reserve_token(tokens, updated, blocked_until, rate, capacity, now):
+    """
+    Reserva un token y calcula cuánto hay que esperar para usarlo.
+
+    `updated` puede estar en el futuro (durante un bloqueo por 429), en cuyo
+    caso el nivel efectivo es negativo y la espera incluye el bloqueo.
+
+    Returns:
+        tuple: (segundos de espera, tokens restantes tras la reserva)
+    """
+    level = min(capacity, tokens + (now - updated) * rate)
+    wait = 0.0 if level >= 1 else (1 - level) / rate
+    wait = max(wait, blocked_until - now)
+    return wait, level - 1
+
+
+# Configuración por bucket: {nombre: (tokens por segundo, capacidad)}
+_buckets = {}
+_backend = None
+_fallback_backend = MemoryBucketBackend()
+_backend_lock = threading.Lock()
+
+
+def _get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if RATE_LIMIT_BACKEND == 'sqlite':
+                try:
+                    _backend = SQLiteBucketBackend(RATE_LIMIT_DB)
+                except Exception as e:
+                    print(f"[RATE] No se pudo abrir {RATE_LIMIT_DB}, usando memoria: {e}")
+                    _backend = _fallback_backend
+            else:
+                _backend = _fallback_backend
+        return _backend
+
+
+def configure_bucket(name, requests_per_minute, burst):
+    """
+    Define (o redefine) el bucket de un modelo.
+
+    Args:
+        name: Nombre del bucket (normalmente el nombre del modelo)
+        requests_per_minute: Tasa sostenida permitida
+        burst: Número de llamadas que pueden salir seguidas sin esperar
+    """
+    _buckets[name] = (requests_per_minute / 60.0, float(burst))
+
+
+def reserve(name, max_wait=None):
+    """
+    Reserva un turno en el bucket y retorna los segundos que hay que esperar.
+    Útil para código asíncrono, que espera por su cuenta.
+
+    Args:
+        name: Nombre del bucket
+        max_wait: Espera máxima en segundos (None = sin límite)
+
+    Raises:
+        RateLimitTimeout: si la espera supera max_wait; en ese caso el token
+                          no se descuenta del bucket
+    """
+    if name not in _buckets:
+        return 0.0
+    rate, capacity = _buckets[name]
+    now = time.time()
+    try:
+        wait, granted = _get_backend().reserve(name, rate, capacity, now, max_wait)
+    except sqlite3.Error as e:
+        print(f"[RATE] Error en backend compartido, usando memoria: {e}")
+        wait, granted = _fallback_backend.reserve(name, rate, capacity, now, max_wait)
+    if not granted:
+        raise RateLimitTimeout(f"Espera de {wait:.1f}s para {name} supera {max_wait}s")
+    return wait
+
+
+def acquire(name, max_wait=None):
+    """
+    Bloquea hasta que haya un token disponible para el bucket.
+
+    Args:
+        name: Nombre del bucket
+        max_wait: Espera máxima en segundos (None = sin límite)
+
+    Returns:
+        float: Segundos esperados
+
+    Raises:
+        RateLimitTimeout: si la espera supera max_wait (sin consumir cuota)
+    """
+    wait = reserve(name, max_wait)
+    if wait > 0:
+        print(f"[RATE] Esperando {wait:.2f}s por cuota de {name}")
+        time.sleep(wait)
+    return wait
+
+
+def try_reserve(name):
+    """
+    Toma un token solo si el bucket tiene uno libre ahora: no hace cola ni
+    duerme. Para llamadas opcionales, como los respaldos del hedging.
+
+    Returns:
+        bool: True si se tomó el token
+    """
+    try:
+        reserve(name, max_wait=0)
+    except RateLimitTimeout:
+        return False
+    return True
+
+
+def report_rate_limited(name, retry_after=None):
+    """
+    Registra un 429 del servidor: bloquea el bucket para todos los workers
+    durante el tiempo indicado por el servidor (o un backoff con jitter).
+    """
+    if name not in _buckets:
+        return
+    if retry_after is None:
+        retry_after = full_jitter_backoff(1)
+    _, capacity = _buckets[name]
+    now = time.time()
+    print(f"[RATE] 429 en {name}, pausando el bucket {retry_after:.1f}s")
+    try:
+        _get_backend().block(name, now + retry_after, capacity, now)
+    except sqlite3.Error as e:
+        print(f"[RATE] Error en backend compartido, usando memoria: {e}")
+        _fallback_backend.block(name, now + retry_after, capacity, now)
+
+
+def full_jitter_backoff(attempt, base=None, cap=None):
+    """
+    Espera de reintento con full jitter: uniforme en [0, min(cap, base * 2^attempt)].
+
+    Args:
+        attempt: Número de intento fallido (0 para el primero)
+    """
+    base = RETRY_BASE_DELAY if base is None else base
+    cap = RETRY_MAX_DELAY if cap is None else cap
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def is_rate_limit_error(error):
+    """Indica si una excepción corresponde a un 429 / RESOURCE_EXHAUSTED"""
+    if getattr(error, 'code', None) == 429:
+        return True
+    text = str(error)
+    return '429' in text or 'RESOURCE_EXHAUSTED' in text
+
+
+def parse_retry_after(error):
+    """
+    Extrae el tiempo de espera sugerido por el servidor en un error 429.
+    Busca RetryInfo.retryDelay en los detalles y, si no, "retry in Ns" en el mensaje.
+
+    Returns:
+        float o None
+    """
+    details = getattr(error, 'details', None)
+    if isinstance(details, dict):
+        body = details.get('error', details)
+        entries = body.get('details', []) if isinstance(body, dict) else []
+        for entry in entries if isinstance(entries, list) else []:
+            delay = entry.get('retryDelay') if isinstance(entry, dict) else None
+            if delay:
+                try:
+                    return float(str(delay).rstrip('s'))
+                except ValueError:
+                    pass
+
+    match = re.search(r'retry in ([\d.]+)\s*s', str(error), re.IGNORECASE)
+    if match:
+        return float(match.group(1))
+    return None
+
+
+def get_bucket_levels():
+    """
+    Estado actual de cada bucket configurado.
+
+    Returns:
+        dict: {bucket: {"tokens", "capacity", "rate_per_minute", "blocked_for_seconds"}}
+    """
+    now = time.time()
+    try:
+        snapshot = _get_backend().snapshot()
+    except sqlite3.Error:
+        snapshot = _fallback_backend.snapshot()
+
+    levels = {}
+    for name, (rate, capacity) in _buckets.items():
+        tokens, updated, blocked_until = snapshot.get(name, (capacity, now, 0.0))
+        levels[name] = {
+            "tokens": round(min(capacity, tokens + (now - updated) * rate), 2),
+            "capacity": capacity,
+            "rate_per_minute": round(rate * 60, 2),
+            "blocked_for_seconds": round(max(0.0, blocked_until - now), 2)
+        }
+    return levels
@@ -0,0 +1,223 @@
+"""
+Caché de resultados del análisis por CONTENIDO de la selfie.
+
+A diferencia de los checkpoints (que guardan el progreso de una generación
+para poder reanudarla), aquí se guarda el resultado final de cada etapa:
+análisis de texto, estilos elegidos, especificaciones e imágenes. La clave es
+el SHA-256 de los bytes decodificados de la selfie más una etiqueta de versión
+de prompts/modelos, así que volver a enviar la misma foto (p. ej. al recargar
+la página) responde sin llamar a Gemini aunque Cloudinary le asigne otra URL.
+
+Opcionalmente (RESULT_CACHE_PERCEPTUAL=true) también se reconocen
+re-subidas casi idénticas (recompresión, cambio de formato) mediante un hash
+perceptual dHash de 64 bits.
+"""
+import hashlib
+import io
+import json
+import os
+
+from PIL import Image
+
+from .blob_store import BlobMissing, pack_images, unpack_images
+from .cache_storage import get_storage
+
+# Prefijo de las claves de resultados en el backend de caché
+RESULT_PREFIX = 'result:'
+RESULT_CACHE_TTL_HOURS = float(os.getenv('RESULT_CACHE_TTL_HOURS', 24))
+# Reconocer re-subidas casi idénticas por hash perceptual
+RESULT_CACHE_PERCEPTUAL = os.getenv('RESULT_CACHE_PERCEPTUAL', 'false').lower() == 'true'
+# Distancia de Hamming máxima entre dHash para considerar dos selfies iguales.
+# El índice divide el hash en PHASH_BANDS bandas: con distancia < PHASH_BANDS
+# al menos una banda coincide exacta (por eso el máximo es PHASH_BANDS - 1)
+PHASH_BANDS = 4
+RESULT_CACHE_PHASH_MAX_DISTANCE = min(
+    int(os.getenv('RESULT_CACHE_PHASH_MAX_DISTANCE', 3)), PHASH_BANDS - 1
+)
+# Entradas por banda del índice perceptual (se conservan las más recientes)
+RESULT_CACHE_PHASH_BAND_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_PHASH_BAND_MAX_ENTRIES', 64))
+
+
+def result_version(*parts):
+    """
+    Etiqueta de versión para las entradas de la caché.
+
+    Se calcula a partir de los modelos y prompts usados: si cambia cualquiera,
+    la etiqueta cambia y los resultados anteriores dejan de usarse.
+
+    Returns:
+        str: Hash de 12 caracteres
+    """
+    hasher = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, str):
+            part = json.dumps(part, sort_keys=True, ensure_ascii=False)
+        hasher.update(part.encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()[:12]
+
+
+def perceptual_hash(image_bytes):
+    """
+    dHash de 64 bits: compara el brillo de píxeles vecinos en una miniatura
+    de 9x8 en escala de grises. Es estable ante recompresión y cambios de tamaño.
+
+    Returns:
+        int o None si la imagen no se puede decodificar
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            pixels = img.convert('L').resize((9, 8), Image.LANCZOS).tobytes()
+    except Exception as e:
+        print(f"[RESULT CACHE] No se pudo calcular hash perceptual: {e}")
+        return None
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def _bands(phash):
+    """Divide el hash perceptual en PHASH_BANDS bandas de 16 bits"""
+    width = 64 // PHASH_BANDS
+    mask = (1 << width) - 1
+    return [(phash >> (i * width)) & mask for i in range(PHASH_BANDS)]
+
+
+def _read(name):
+    try:
+        raw = get_storage().get(f"{RESULT_PREFIX}{name}")
+        return json.loads(raw) if raw is not None else None
+    except Exception as e:
+        print(f"[RESULT CACHE] Error leyendo {name}: {e}")
+        return None
+
+
+def _write(name, data):
+    get_storage().set(
+        f"{RESULT_PREFIX}{name}",
+        json.dumps(data, ensure_ascii=False).encode('utf-8'),
+        ttl=RESULT_CACHE_TTL_HOURS * 3600
+    )
+
+
+def _index_entry(name, phash, key):
+    """
+    Agrega (o mueve al final) la entrada de `key` en una banda del índice
+    perceptual. Es un update atómico del backend: workers concurrentes no
+    pierden entradas, y la banda no crece más que el máximo.
+    """
+    def add(raw):
+        entries = json.loads(raw) if raw is not None else []
+        entries = [e for e in entries if e[1] != key]
+        entries.append([f"{phash:016x}", key])
+        return json.dumps(entries[-RESULT_CACHE_PHASH_BAND_MAX_ENTRIES:]).encode('utf-8')
+
+    get_storage().update(f"{RESULT_PREFIX}{name}", add, ttl=RESULT_CACHE_TTL_HOURS * 3600)
+
+
+def _exists(name):
+    try:
+        return get_storage().has(f"{RESULT_PREFIX}{name}")
+    except Exception:
+        return False
+
+
+def _exact_key(selfie, version):
+    return f"{version}_{selfie.digest}"
+
+
+def _find_similar(phash, version):
+    """Busca en el índice perceptual una entrada de la misma versión a distancia aceptable"""
+    for band_idx, band in enumerate(_bands(phash)):
+        entries = _read(f"phash_{version}_{band_idx}_{band:04x}") or []
+        for other_hash, key in entries:
+            if bin(int(other_hash, 16) ^ phash).count('1') <= RESULT_CACHE_PHASH_MAX_DISTANCE:
+                if _exists(key):
+                    return key
+    return None
+
+
+def lookup_result_key(selfie, version):
+    """
+    Resuelve la clave de caché de una selfie para una versión dada.
+
+    Usa la clave exacta (SHA-256 del contenido) si existe; si no, y el modo
+    perceptual está activo, la de una selfie casi idéntica ya analizada.
+
+    Args:
+        selfie: SelfieBlob del análisis
+        version: Etiqueta de result_version()
+
+    Returns:
+        str: Clave para get_result/save_result
+    """
+    key = _exact_key(selfie, version)
+    if not RESULT_CACHE_PERCEPTUAL or _exists(key):
+        return key
+
+    phash = perceptual_hash(selfie.data)
+    if phash is None:
+        return key
+
+    similar_key = _find_similar(phash, version)
+    if similar_key:
+        print("[RESULT CACHE] Selfie casi idéntica a una ya analizada")
+        return similar_key
+    return key
+
+
+def get_result(key):
+    """
+    Recupera un resultado si existe y no ha expirado.
+
+    Returns:
+        El valor guardado o None
+    """
+    data = _read(key)
+    if data is None:
+        return None
+
+    try:
+        value = unpack_images(data.get('value'))
+    except BlobMissing:
+        print(f"[RESULT CACHE] Imagen del resultado ya no está en el almacén: {key[:24]}")
+        return None
+
+    print(f"[RESULT CACHE] ✓ Resultado recuperado: {key[:24]}")
+    return value
+
+
+def save_result(key, value, selfie=None):
+    """
+    Guarda un resultado final.
+
+    Args:
+        key: Clave de lookup_result_key()
+        value: Valor serializable a JSON
+        selfie: SelfieBlob de origen; si el modo perceptual está activo, se
+                registra su dHash para reconocer re-subidas casi idénticas
+
+    Returns:
+        bool: True si se guardó correctamente
+    """
+    try:
+        _write(key, {'value': pack_images(value)})
+
+        if RESULT_CACHE_PERCEPTUAL and selfie is not None:
+            phash = perceptual_hash(selfie.data)
+            if phash is not None:
+                version = key.split('_', 1)[0]
+                for band_idx, band in enumerate(_bands(phash)):
+                    _index_entry(f"phash_{version}_{band_idx}_{band:04x}", phash, key)
+
+        print(f"[RESULT CACHE] ✓ Resultado guardado: {key[:24]}")
+        return True
+
+    except Exception as e:
+        print(f"[RESULT CACHE] Error guardando resultado: {e}")
+        return False
@@ -0,0 +1,151 @@
+"""
+Manejo de la selfie en memoria durante un análisis.
+
+`upload_selfie` crea un SelfieBlob con los bytes ya decodificados y ese mismo
+objeto se pasa a todas las etapas de Gemini, así la imagen no se vuelve a
+descargar de Cloudinary. Para quien solo tenga la URL queda una caché LRU
+acotada por tamaño.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from .http_transport import get_async_http_client, get_http_session, stage_timeout, track
+from .selfie_normalizer import normalize_selfie
+
+# Tamaño máximo total de la caché de selfies descargadas por URL
+SELFIE_CACHE_MAX_BYTES = int(os.getenv('SELFIE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+
+class SelfieBlob:
+    """Bytes de la selfie de un análisis, compartidos por todas sus etapas"""
+
+    def __init__(self, data, mime_type="image/jpeg", url=None):
+        self.data = data
+        self.mime_type = mime_type
+        self.url = url
+        self._digest = None
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @property
+    def digest(self):
+        """SHA-256 del contenido (se calcula una sola vez)"""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+
+    def __repr__(self):
+        return f"<SelfieBlob {self.mime_type} {self.size} bytes url={self.url}>"
+
+
+def decode_image_data(image_data):
+    """
+    Decodifica la imagen recibida del frontend.
+
+    Args:
+        image_data: Data URI ("data:image/...;base64,...") o base64 sin prefijo
+
+    Returns:
+        tuple: (bytes, mime_type)
+    """
+    mime_type = "image/jpeg"  # Base64 sin prefijo: se asume JPEG
+    payload = image_data
+    if image_data.startswith('data:'):
+        header, _, payload = image_data.partition(',')
+        mime_type = header[5:].split(';')[0] or mime_type
+    return base64.b64decode(payload), mime_type
+
+
+class _SelfieLRU:
+    """Caché LRU de bytes por URL, acotada por el tamaño total en bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        with self._lock:
+            data = self._items.get(url)
+            if data is not None:
+                self._items.move_to_end(url)
+            return data
+
+    def put(self, url, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if url in self._items:
+                self.total_bytes -= len(self._items.pop(url))
+            self._items[url] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+
+_selfie_cache = _SelfieLRU(SELFIE_CACHE_MAX_BYTES)
+
+
+def remember_selfie(blob):
+    """Registra en la caché por URL una selfie recién subida"""
+    if blob.url:
+        _selfie_cache.put(blob.url, blob.data)
+
+
+def fetch_selfie_bytes(url):
+    """
+    Retorna los bytes de una imagen por URL, usando la caché LRU si es posible.
+    """
+    data = _selfie_cache.get(url)
+    if data is not None:
+        return data
+
+    with track('download'):
+        response = get_http_session().get(url, timeout=stage_timeout('download'))
+        response.raise_for_status()
+    data = response.content
+    _selfie_cache.put(url, data)
+    return data
+
+
+def resolve_selfie(selfie):
+    """
+    Normaliza la selfie que recibe una etapa: un SelfieBlob se usa tal cual,
+    una URL se resuelve (caché LRU o descarga) y se envuelve en un SelfieBlob
+    con la imagen canónica (ver selfie_normalizer).
+    """
+    if isinstance(selfie, SelfieBlob):
+        return selfie
+    data, mime_type = normalize_selfie(fetch_selfie_bytes(selfie))
+    return SelfieBlob(data, mime_type=mime_type, url=selfie)
+
+
+async def fetch_selfie_bytes_async(url):
+    """Versión asíncrona de fetch_selfie_bytes (misma caché LRU)"""
+    data = _selfie_cache.get(url)
+    if data is not None:
+        return data
+
+    with track('download'):
+        response = await get_async_http_client().get(url)
+        response.raise_for_status()
+    data = response.content
+    _selfie_cache.put(url, data)
+    return data
+
+
+async def resolve_selfie_async(selfie):
+    """Versión asíncrona de resolve_selfie"""
+    if isinstance(selfie, SelfieBlob):
+        return selfie
+    data = await fetch_selfie_bytes_async(selfie)
+    data, mime_type = await asyncio.to_thread(normalize_selfie, data)
+    return SelfieBlob(data, mime_type=mime_type, url=selfie)
@@ -0,0 +1,186 @@
+"""
+Recepción binaria de la selfie para /api/analyze-face.
+
+Además del JSON con la imagen en base64, el endpoint acepta:
+
+- multipart/form-data: archivo en el campo "image" y, opcional, el campo
+  "userData" con un JSON.
+- Cuerpo crudo image/*: la imagen tal cual; userData opcional en el header
+  X-User-Data (JSON).
+
+El cuerpo se lee por partes y la imagen se vuelca a un SpooledTemporaryFile
+(en memoria hasta SELFIE_SPOOL_MEMORY_BYTES, luego a disco), sin pasar por
+base64 ni por un str de Python. Ese archivo es lo que reciben la
+normalización y upload_selfie. El tamaño se limita mientras se lee.
+"""
+import json
+import os
+from tempfile import SpooledTemporaryFile
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+SELFIE_MAX_UPLOAD_BYTES = int(os.getenv('SELFIE_MAX_UPLOAD_BYTES', 15 * 1024 * 1024))
+SELFIE_SPOOL_MEMORY_BYTES = int(os.getenv('SELFIE_SPOOL_MEMORY_BYTES', 512 * 1024))
+# Campos de texto del formulario (userData)
+FORM_FIELD_MAX_BYTES = 64 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class UploadError(ValueError):
+    """Cuerpo de la subida inválido (status HTTP en `status`)"""
+    status = 400
+
+
+class UploadTooLarge(UploadError):
+    status = 413
+
+
+def is_binary_upload(content_type):
+    """True si el Content-Type corresponde a la subida binaria (no JSON)"""
+    mimetype, _ = parse_options_header(content_type or "")
+    return mimetype == 'multipart/form-data' or mimetype.startswith('image/')
+
+
+def parse_user_data(raw):
+    """userData enviado como texto JSON (vacío -> {})"""
+    if not raw:
+        return {}
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        raise UploadError("userData no es un JSON válido")
+    return value if isinstance(value, dict) else {}
+
+
+class SelfieUpload:
+    """
+    Parser incremental del cuerpo: se alimenta con feed(chunk) a medida que
+    llegan los bytes y finish() retorna la imagen y los datos del usuario.
+    """
+
+    def __init__(self, content_type, content_length=None, user_data_header=None,
+                 limit=SELFIE_MAX_UPLOAD_BYTES):
+        mimetype, options = parse_options_header(content_type or "")
+        if content_length is not None and content_length > limit + FORM_FIELD_MAX_BYTES:
+            raise UploadTooLarge(f"La imagen supera el máximo de {limit} bytes")
+
+        self.limit = limit
+        self.size = 0
+        self.spool = SpooledTemporaryFile(max_size=SELFIE_SPOOL_MEMORY_BYTES)
+        self.fields = {}
+        self._user_data_header = user_data_header
+        self._decoder = None
+        self._target = None
+        if mimetype == 'multipart/form-data':
+            boundary = options.get('boundary')
+            if not boundary:
+                raise UploadError("multipart/form-data sin boundary")
+            self._decoder = MultipartDecoder(
+                boundary.encode('latin-1'),
+                max_form_memory_size=FORM_FIELD_MAX_BYTES,
+                max_parts=16
+            )
+        else:
+            self._target = 'image'
+
+    def feed(self, chunk):
+        if self._decoder is None:
+            self._write(chunk)
+            return
+        try:
+            self._decoder.receive_data(chunk)
+            self._drain()
+        except RequestEntityTooLarge:
+            raise UploadTooLarge("Campo del formulario demasiado grande")
+        except ValueError as e:
+            raise UploadError(f"multipart inválido: {e}")
+
+    def finish(self):
+        """
+        Returns:
+            tuple: (archivo con la imagen, posicionado al inicio; dict userData)
+        """
+        if self._decoder is not None:
+            self.feed(None)
+        if self.size == 0:
+            self.close()
+            raise UploadError("No se recibió imagen")
+
+        raw_user_data = self.fields.get('userData')
+        if raw_user_data is not None:
+            raw_user_data = raw_user_data.decode('utf-8', 'replace')
+        else:
+            raw_user_data = self._user_data_header
+        try:
+            user_data = parse_user_data(raw_user_data)
+        except UploadError:
+            self.close()
+            raise
+
+        self.spool.seek(0)
+        print(f"[UPLOAD] Selfie recibida: {self.size} bytes")
+        return self.spool, user_data
+
+    def close(self):
+        self.spool.close()
+
+    def _drain(self):
+        event = self._decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, File):
+                # Solo se guarda el primer archivo del campo "image"
+                self._target = 'image' if event.name == 'image' and self.size == 0 else None
+            elif isinstance(event, Field):
+                self._target = event.name
+                self.fields[event.name] = b""
+            elif isinstance(event, Data) and self._target == 'image':
+                self._write(event.data)
+            elif isinstance(event, Data) and self._target is not None:
+                self.fields[self._target] += event.data
+            event = self._decoder.next_event()
+
+    def _write(self, data):
+        if not data:
+            return
+        self.size += len(data)
+        if self.size > self.limit:
+            self.close()
+            raise UploadTooLarge(f"La imagen supera el máximo de {self.limit} bytes")
+        self.spool.write(data)
+
+
+def read_selfie_upload(stream, content_type, content_length=None, user_data_header=None):
+    """
+    Lee una subida binaria desde un stream síncrono (request.stream de Flask).
+
+    Returns:
+        tuple: (archivo con la imagen, dict userData)
+
+    Raises:
+        UploadError / UploadTooLarge
+    """
+    upload = SelfieUpload(content_type, content_length, user_data_header)
+    try:
+        while True:
+            chunk = stream.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            upload.feed(chunk)
+    except BaseException:
+        upload.close()
+        raise
+    return upload.finish()
+
+
+async def read_selfie_upload_async(chunks, content_type, content_length=None, user_data_header=None):
+    """Versión asíncrona de read_selfie_upload (chunks: iterador asíncrono de bytes)"""
+    upload = SelfieUpload(content_type, content_length, user_data_header)
+    try:
+        async for chunk in chunks:
+            upload.feed(chunk)
+    except BaseException:
+        upload.close()
+        raise
+    return upload.finish()
@@ -0,0 +1,160 @@
+"""
+Normalización de la selfie antes de subirla y de enviarla a Gemini.
+
+La imagen que llega del frontend se convierte en UNA imagen canónica que se
+usa para Cloudinary y para todas las llamadas al modelo:
+
+1. Orientación EXIF aplicada (las fotos de celular suelen venir rotadas).
+2. Recorte centrado en el rostro (opcional, SELFIE_FACE_CROP=true; requiere
+   opencv-python, solo CPU).
+3. Lado mayor reducido a SELFIE_MAX_EDGE: menos tokens de imagen por prompt,
+   subidas más rápidas y menor latencia del modelo.
+4. Tipo MIME detectado del contenido real, no supuesto.
+
+Si no hace falta ningún cambio, se conservan los bytes originales para no
+re-comprimir.
+"""
+import io
+import os
+
+from PIL import Image, ImageOps
+
+SELFIE_MAX_EDGE = int(os.getenv('SELFIE_MAX_EDGE', 1024))
+SELFIE_JPEG_QUALITY = int(os.getenv('SELFIE_JPEG_QUALITY', 90))
+SELFIE_FACE_CROP = os.getenv('SELFIE_FACE_CROP', 'false').lower() == 'true'
+# Tamaño del recorte respecto al rostro detectado (incluye pelo, orejas y cuello)
+SELFIE_FACE_CROP_SCALE = float(os.getenv('SELFIE_FACE_CROP_SCALE', 2.2))
+# Lado de la copia reducida sobre la que corre el detector de rostros
+FACE_DETECTION_EDGE = 640
+
+# Formatos que Gemini acepta tal cual
+_PASSTHROUGH_FORMATS = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+
+_EXIF_ORIENTATION = 0x0112
+
+_face_detector = None
+
+
+def detect_mime_type(image_bytes, default="image/jpeg"):
+    """Tipo MIME según el contenido (solo lee la cabecera de la imagen)"""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            return Image.MIME.get(img.format, default)
+    except Exception:
+        return default
+
+
+def _get_face_detector():
+    """Clasificador Haar de OpenCV (se carga una vez; None si OpenCV no está instalado)"""
+    global _face_detector
+    if _face_detector is None:
+        try:
+            import cv2
+            _face_detector = cv2.CascadeClassifier(
+                os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+            )
+        except ImportError:
+            print("[SELFIE] SELFIE_FACE_CROP requiere opencv-python; se omite el recorte")
+            _face_detector = False
+    return _face_detector or None
+
+
+def _face_crop_box(img):
+    """
+    Caja de recorte centrada en el rostro más grande, o None si no se detecta.
+
+    Returns:
+        tuple: (left, top, right, bottom) en coordenadas de `img`
+    """
+    detector = _get_face_detector()
+    if detector is None:
+        return None
+
+    import numpy as np
+
+    small = img.convert('L')
+    small.thumbnail((FACE_DETECTION_EDGE, FACE_DETECTION_EDGE))
+    scale = img.width / small.width
+    faces = detector.detectMultiScale(np.asarray(small), scaleFactor=1.1, minNeighbors=5, minSize=(48, 48))
+    if len(faces) == 0:
+        return None
+
+    x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+    center_x = (x + w / 2) * scale
+    center_y = (y + h / 2) * scale
+    side = max(w, h) * scale * SELFIE_FACE_CROP_SCALE
+    if side >= min(img.size):
+        return None
+
+    left = min(max(0, center_x - side / 2), img.width - side)
+    top = min(max(0, center_y - side / 2), img.height - side)
+    return int(left), int(top), int(left + side), int(top + side)
+
+
+def _encode_jpeg(img):
+    if img.mode in ('RGBA', 'LA', 'P'):
+        # Fondo blanco para las transparencias
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=SELFIE_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+def _read_all(source):
+    """Bytes completos de la imagen (bytes o archivo abierto en modo binario)"""
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    source.seek(0)
+    return source.read()
+
+
+def normalize_selfie(source):
+    """
+    Produce la imagen canónica de la selfie.
+
+    Args:
+        source: Bytes de la imagen tal como llegaron, o un archivo binario
+                (p. ej. el SpooledTemporaryFile de una subida multipart)
+
+    Returns:
+        tuple: (bytes, mime_type). Si la imagen no se puede decodificar se
+               retornan los bytes originales con el tipo detectado.
+    """
+    stream = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+    try:
+        with Image.open(stream) as original:
+            original.load()
+            source_format = original.format
+            img = original
+            changed = False
+            if original.getexif().get(_EXIF_ORIENTATION, 1) != 1:
+                img = ImageOps.exif_transpose(original)
+                changed = True
+
+            if SELFIE_FACE_CROP:
+                box = _face_crop_box(img)
+                if box:
+                    img = img.crop(box)
+                    changed = True
+
+            if max(img.size) > SELFIE_MAX_EDGE:
+                img = img.copy() if img is original else img
+                img.thumbnail((SELFIE_MAX_EDGE, SELFIE_MAX_EDGE), Image.LANCZOS)
+                changed = True
+
+            if not changed and source_format in _PASSTHROUGH_FORMATS:
+                return _read_all(source), _PASSTHROUGH_FORMATS[source_format]
+
+            normalized = _encode_jpeg(img)
+            print(f"[SELFIE] Normalizada: {len(normalized)} bytes, {img.size[0]}x{img.size[1]}")
+            return normalized, "image/jpeg"
+
+    except Exception as e:
+        print(f"[SELFIE] No se pudo normalizar la selfie: {e}")
+        image_bytes = _read_all(source)
+        return image_bytes, detect_mime_type(image_bytes)
@@ -0,0 +1,99 @@
+"""
+Ejecutor de etapas con dependencias (DAG) sobre un pool de hilos acotado.
+Cada etapa se lanza en cuanto todas sus dependencias han terminado, de modo
+que el trabajo independiente corre en paralelo sin esperas fijas.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class StageGraph:
+    """Grafo de etapas que se ejecutan en paralelo respetando dependencias"""
+
+    def __init__(self, max_workers=4, name="pipeline"):
+        self.max_workers = max_workers
+        self.name = name
+        self._stages = {}
+        self._order = []
+
+    def add_stage(self, name, func, depends_on=()):
+        """
+        Registra una etapa del grafo.
+
+        Args:
+            name: Nombre único de la etapa
+            func: Función a ejecutar. Recibe como argumentos posicionales los
+                  resultados de sus dependencias, en el orden de `depends_on`.
+            depends_on: Nombres de las etapas que deben terminar antes
+        """
+        if name in self._stages:
+            raise ValueError(f"Etapa duplicada: {name}")
+        for dep in depends_on:
+            if dep not in self._stages:
+                raise ValueError(f"Dependencia desconocida para {name}: {dep}")
+
+        self._stages[name] = {"func": func, "depends_on": tuple(depends_on)}
+        self._order.append(name)
+
+    def run(self):
+        """
+        Ejecuta todas las etapas y espera a que terminen.
+
+        Si una etapa lanza una excepción, sus dependientes se omiten y el
+        error queda registrado; el resto del grafo continúa.
+
+        Returns:
+            dict: {"results": {etapa: resultado}, "errors": {etapa: excepción},
+                   "skipped": [etapas omitidas], "timings": {etapa: segundos}}
+        """
+        results = {}
+        errors = {}
+        skipped = []
+        timings = {}
+        pending = list(self._order)
+        running = {}
+
+        def timed(stage_name, func, args):
+            start = time.time()
+            try:
+                return func(*args)
+            finally:
+                timings[stage_name] = round(time.time() - start, 2)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix=self.name) as executor:
+            while pending or running:
+                # Lanzar (u omitir) las etapas cuyas dependencias ya terminaron
+                for stage_name in list(pending):
+                    deps = self._stages[stage_name]["depends_on"]
+                    if any(d in errors or d in skipped for d in deps):
+                        pending.remove(stage_name)
+                        skipped.append(stage_name)
+                        print(f"[DAG] Etapa omitida por dependencia fallida: {stage_name}")
+                        continue
+                    if all(d in results for d in deps):
+                        pending.remove(stage_name)
+                        args = [results[d] for d in deps]
+                        future = executor.submit(
+                            timed, stage_name, self._stages[stage_name]["func"], args
+                        )
+                        running[future] = stage_name
+
+                if not running:
+                    continue
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage_name = running.pop(future)
+                    try:
+                        results[stage_name] = future.result()
+                    except Exception as e:
+                        errors[stage_name] = e
+                        print(f"[DAG] Error en etapa {stage_name}: {str(e)}")
+
+        return {
+            "results": results,
+            "errors": errors,
+            "skipped": skipped,
+            "timings": timings
+        }
@@ -0,0 +1,37 @@
+"""
+Utilidades compartidas para respuestas Server-Sent Events (SSE)
+"""
+import json
+
+# Cabeceras para que proxies y navegadores no almacenen ni retengan el stream
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+    'Access-Control-Allow-Origin': '*'
+}
+
+
+# Comentario SSE que mantiene viva la conexión cuando no hay eventos
+SSE_KEEPALIVE = ": keepalive\n\n"
+
+
+def format_sse(data, event_id=None):
+    """
+    Serializa un evento como bloque SSE ("data: {...}\\n\\n"). Con event_id se
+    agrega el campo "id:", que el cliente reenvía como Last-Event-ID al reconectar.
+    """
+    if event_id is None:
+        return f"data: {json.dumps(data)}\n\n"
+    return f"id: {event_id}\ndata: {json.dumps(data)}\n\n"
+
+
+def new_usage_totals():
+    """Acumulador de uso de tokens de un análisis completo"""
+    return {
+        "prompt_tokens": 0,
+        "output_tokens": 0,
+        "total_tokens": 0,
+        "image_generations": 0,
+        "text_generations": 0,
+        "processing_time_seconds": 0
+    }
@@ -0,0 +1,39 @@
+"""
+Adaptador WSGI -> ASGI que atiende cada request de Flask en un pool de hilos.
+
+asgiref.wsgi.WsgiToAsgi corre la app con sync_to_async(thread_sensitive=True):
+todas las requests de Flask del proceso pasan por UN solo hilo, así que un
+stream SSE abierto (o cualquier request lenta) deja en cola al resto. Aquí
+cada request corre en un hilo de FLASK_THREADS, como en un servidor WSGI con
+hilos (Flask y Flask-SQLAlchemy ya aíslan su estado por hilo).
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+# Requests de Flask atendidas a la vez por proceso
+FLASK_THREADS = int(os.getenv('FLASK_THREADS', 32))
+
+_executor = ThreadPoolExecutor(max_workers=FLASK_THREADS, thread_name_prefix="flask")
+
+# Cuerpo síncrono original de WsgiToAsgiInstance.run_wsgi_app (sin su
+# sync_to_async). Es un detalle interno de asgiref: la versión está fijada en
+# el Pipfile y tests/test_wsgi_pool.py falla si el hook cambia de lugar
+_run_wsgi_app = WsgiToAsgiInstance.__dict__['run_wsgi_app'].func
+
+
+class _PooledWsgiInstance(WsgiToAsgiInstance):
+
+    async def run_wsgi_app(self, body):
+        await sync_to_async(_run_wsgi_app, thread_sensitive=False, executor=_executor)(self, body)
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi con un hilo del pool por request en vez de un hilo único"""
+
+    async def __call__(self, scope, receive, send):
+        await _PooledWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(
+            scope, receive, send
+        )
@@ -10,6 +10,10 @@ from api.models import db
 from api.routes import api
 from api.admin import setup_admin
 from api.commands import setup_commands
+from api.services.cache_sweeper import start_cache_sweeper
+from api.services.job_queue import start_job_workers
+from api.services.http_transport import warm_up_connections
+from api.analysis import run_analysis_job
 
 # from models import Person
 
@@ -40,6 +44,15 @@ setup_commands(app)
 # Add all endpoints form the API with a "api" prefix
 app.register_blueprint(api, url_prefix='/api')
 
+# expire cached checkpoints, results and image blobs in the background
+start_cache_sweeper()
+
+# consume queued analyses in this process (JOB_WORKERS=0 when src/worker.py runs them)
+start_job_workers(run_analysis_job)
+
+# open DNS/TLS connections to Gemini and Cloudinary before the first analysis
+warm_up_connections()
+
 # Handle/serialize errors like a JSON object
 
 
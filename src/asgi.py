@@ -0,0 +1,34 @@
+# Entrada ASGI: los endpoints de streaming del análisis y las imágenes corren
+# sobre asyncio (api/asgi_routes.py) y el resto de la app Flask se sirve en un pool de hilos
+# (api/wsgi_pool.py), no en el hilo único de WsgiToAsgi.
+# Producción: gunicorn asgi:application -k uvicorn.workers.UvicornWorker --chdir ./src/
+
+from app import app
+from api.asgi_routes import find_async_route
+from api.wsgi_pool import PooledWsgiToAsgi
+
+flask_application = PooledWsgiToAsgi(app)
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] == "http":
+        handler = find_async_route(scope["method"], scope["path"])
+        if handler and await handler(scope, receive, send) is not False:
+            return
+
+    await flask_application(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import os
+    import uvicorn
+    uvicorn.run(application, host="0.0.0.0", port=int(os.environ.get("PORT", 3001)))
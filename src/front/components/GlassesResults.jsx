@@ -276,7 +276,7 @@ const GlassesResults = ({
                         </div>
                     )}
                 </div>
-            ) : loading && analysis ? (
+            ) : loading && analysis && !imagesError ? (
                 <ImagesSkeleton />
             ) : !loading && (
                 <div className="images-error-section">
@@ -15,12 +15,8 @@ const SelfieUploader = ({ selfiePreview, onImageSelect, onAnalyze, disabled, loa
                 return;
             }
 
-            // Convertir a base64
-            const reader = new FileReader();
-            reader.onloadend = () => {
-                onImageSelect(reader.result);
-            };
-            reader.readAsDataURL(file);
+            // Se pasa el archivo tal cual: se sube como binario
+            onImageSelect(file);
         }
     };
 
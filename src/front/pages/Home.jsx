@@ -16,8 +16,11 @@ export const Home = () => {
 	const [timeRemaining, setTimeRemaining] = useState(300); // 5 minutos = 300 segundos
 
 	// === HANDLERS ===
-	const handleImageSelect = (imageData) => {
-		glassesActions.setSelfiePreview(dispatch, imageData);
+	const handleImageSelect = (file) => {
+		if (glassesAnalysis.selfiePreview) {
+			URL.revokeObjectURL(glassesAnalysis.selfiePreview);
+		}
+		glassesActions.setSelfieFile(dispatch, file);
 	};
 
 	const handleAnalyze = async () => {
@@ -25,7 +28,7 @@ export const Home = () => {
 			// Analizar directamente sin datos del usuario
 			await glassesActions.analyzeface(
 				dispatch,
-				glassesAnalysis.selfiePreview,
+				glassesAnalysis.selfieFile,
 				{} // Sin datos del usuario - Gemini analizará todo
 			);
 		} catch (error) {
@@ -16,6 +16,7 @@ export const initialStore = () => {
     // === ANÁLISIS DE MONTURAS ===
     glassesAnalysis: {
       selfiePreview: null,    // Preview local de la imagen
+      selfieFile: null,       // Archivo original (se sube como binario)
       selfieUrl: null,        // URL de Cloudinary
       userData: {
         genero: '',
@@ -34,6 +35,8 @@ export const initialStore = () => {
       },
       recommendations: [],    // Imágenes con monturas generadas
       analysis: '',           // Texto de análisis
+      degraded: null,         // Modo degradado anunciado por el servidor (evento "degraded")
+      imagesError: null,      // Motivo por el que no llegarán las imágenes
       loading: false,
       error: null,
       step: 1,                 // 1: Upload, 2: Formulario, 3: Resultados
@@ -69,6 +72,15 @@ export default function storeReducer(store, action = {}) {
         }
       };
 
+    case 'SET_SELFIE_FILE':
+      return {
+        ...store,
+        glassesAnalysis: {
+          ...store.glassesAnalysis,
+          selfieFile: action.payload
+        }
+      };
+
     case 'SET_USER_DATA':
       return {
         ...store,
@@ -94,6 +106,8 @@ export default function storeReducer(store, action = {}) {
           ...store.glassesAnalysis,
           loading: true,
           error: null,
+          degraded: null,
+          imagesError: null,
           progress: 0,
           progressStatus: 'Iniciando...'
         }
@@ -129,6 +143,18 @@ export default function storeReducer(store, action = {}) {
         }
       };
 
+    case 'SET_DEGRADED':
+      return {
+        ...store,
+        glassesAnalysis: {
+          ...store.glassesAnalysis,
+          degraded: action.payload,
+          imagesError: action.payload.mode === 'images_only'
+            ? store.glassesAnalysis.imagesError
+            : action.payload.message
+        }
+      };
+
     case 'ADD_IMAGE':
       return {
         ...store,
@@ -138,6 +164,33 @@ export default function storeReducer(store, action = {}) {
         }
       };
 
+    case 'UPDATE_IMAGE':
+      // Reemplaza el preview de una imagen por su versión completa
+      return {
+        ...store,
+        glassesAnalysis: {
+          ...store.glassesAnalysis,
+          recommendations: store.glassesAnalysis.recommendations.map(img =>
+            img.style === action.payload.style && img.type === action.payload.type
+              ? { ...img, data: action.payload.data }
+              : img
+          )
+        }
+      };
+
+    case 'CLEAR_RESULTS':
+      return {
+        ...store,
+        glassesAnalysis: {
+          ...store.glassesAnalysis,
+          recommendations: [],
+          analysis: '',
+          degraded: null,
+          imagesError: null,
+          usage: null
+        }
+      };
+
     case 'SET_USAGE':
       return {
         ...store,
@@ -172,6 +225,7 @@ export default function storeReducer(store, action = {}) {
         ...store,
         glassesAnalysis: {
           selfiePreview: null,
+          selfieFile: null,
           selfieUrl: null,
           userData: {
             genero: '',
@@ -190,6 +244,8 @@ export default function storeReducer(store, action = {}) {
           },
           recommendations: [],
           analysis: '',
+          degraded: null,
+          imagesError: null,
           loading: false,
           error: null,
           step: 1
@@ -201,12 +257,82 @@ export default function storeReducer(store, action = {}) {
   }
 }
 
+// Reintentos de reconexión del stream de eventos
+const MAX_SSE_RECONNECTS = 5;
+
+// Procesa un evento SSE del análisis
+const handleAnalysisEvent = (dispatch, backendUrl, data) => {
+  switch (data.type) {
+    case 'progress':
+      dispatch({ 
+        type: 'UPDATE_PROGRESS', 
+        payload: { progress: data.progress, status: data.status } 
+      });
+      break;
+      
+    case 'reset':
+      // El servidor reintentó el análisis: se descartan los resultados parciales
+      dispatch({ type: 'CLEAR_RESULTS' });
+      break;
+      
+    case 'selfie':
+      dispatch({ type: 'SET_SELFIE_URL', payload: data.selfie_url });
+      break;
+      
+    case 'analysis':
+      dispatch({ type: 'SET_ANALYSIS', payload: data.analysis });
+      break;
+      
+    case 'image':
+      // La imagen llega por referencia: el navegador la descarga (y cachea) por HTTP.
+      // Primero se muestra el preview liviano
+      dispatch({
+        type: 'ADD_IMAGE',
+        payload: { ...data.image, data: `${backendUrl}${data.image.preview_url || data.image.url}` }
+      });
+      break;
+
+    case 'image_full':
+      dispatch({
+        type: 'UPDATE_IMAGE',
+        payload: { ...data.image, data: `${backendUrl}${data.image.url}` }
+      });
+      break;
+      
+    case 'degraded':
+      // Un modelo está caído: el análisis sigue sin esa parte
+      console.warn('[SSE] Modo degradado:', data.mode, data.models);
+      dispatch({ type: 'SET_DEGRADED', payload: data });
+      break;
+
+    case 'usage':
+      dispatch({ type: 'SET_USAGE', payload: data.usage });
+      break;
+      
+    case 'complete':
+      dispatch({ type: 'ANALYZE_SUCCESS', payload: {} });
+      break;
+      
+    case 'error':
+    case 'analysis_error':
+    case 'images_error':
+      console.warn('[SSE] Error parcial:', data.error);
+      break;
+  }
+};
+
 // === ACCIONES CENTRALIZADAS ===
 export const glassesActions = {
   setSelfiePreview: (dispatch, imageData) => {
     dispatch({ type: 'SET_SELFIE_PREVIEW', payload: imageData });
   },
 
+  // Guarda el archivo elegido y su preview local (object URL, sin base64)
+  setSelfieFile: (dispatch, file) => {
+    dispatch({ type: 'SET_SELFIE_FILE', payload: file });
+    dispatch({ type: 'SET_SELFIE_PREVIEW', payload: file ? URL.createObjectURL(file) : null });
+  },
+
   setUserData: (dispatch, data) => {
     dispatch({ type: 'SET_USER_DATA', payload: data });
   },
@@ -215,22 +341,20 @@ export const glassesActions = {
     dispatch({ type: 'SET_STEP', payload: step });
   },
 
-  analyzeface: async (dispatch, imageData, userData) => {
+  analyzeface: async (dispatch, imageFile, userData) => {
     dispatch({ type: 'ANALYZE_START' });
 
     try {
       const backendUrl = import.meta.env.VITE_BACKEND_URL;
 
-      // Usar streaming SSE para recibir datos progresivamente
-      const response = await fetch(`${backendUrl}/api/analyze-face`, {
+      // La selfie viaja como binario (multipart): sin base64 en el navegador ni en el servidor
+      const formData = new FormData();
+      formData.append('image', imageFile);
+      formData.append('userData', JSON.stringify(userData || {}));
+
+      let response = await fetch(`${backendUrl}/api/analyze-face`, {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({
-          image: imageData,
-          userData: userData
-        })
+        body: formData
       });
 
       if (!response.ok) {
@@ -238,67 +362,80 @@ export const glassesActions = {
         throw new Error(errorData.error || 'Error en el análisis');
       }
 
+      // Endpoint donde reconectar si el stream se corta (job de la cola o sesión del stream directo)
+      let progressUrl = null;
+      let lastEventId = null;
+      let finished = false;
+
+      // 202: el análisis quedó en la cola; sus eventos llegan por el endpoint de progreso
+      if (response.status === 202) {
+        const { progress_url } = await response.json();
+        progressUrl = progress_url;
+        response = await fetch(`${backendUrl}${progressUrl}`);
+        if (!response.ok) {
+          throw new Error('No se pudo seguir el progreso del análisis');
+        }
+      }
+
       // Leer el stream SSE
-      const reader = response.body.getReader();
-      const decoder = new TextDecoder();
-      let buffer = '';
+      const readStream = async (response) => {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
 
-      while (true) {
-        const { done, value } = await reader.read();
-        
-        if (done) break;
-        
-        buffer += decoder.decode(value, { stream: true });
-        
-        // Procesar líneas SSE completas
-        const lines = buffer.split('\n');
-        buffer = lines.pop() || ''; // Guardar línea incompleta
-        
-        for (const line of lines) {
-          if (line.startsWith('data: ')) {
-            try {
-              const data = JSON.parse(line.slice(6));
-              
-              // Procesar cada tipo de mensaje
-              switch (data.type) {
-                case 'progress':
-                  dispatch({ 
-                    type: 'UPDATE_PROGRESS', 
-                    payload: { progress: data.progress, status: data.status } 
-                  });
-                  break;
-                  
-                case 'selfie':
-                  dispatch({ type: 'SET_SELFIE_URL', payload: data.selfie_url });
-                  break;
-                  
-                case 'analysis':
-                  dispatch({ type: 'SET_ANALYSIS', payload: data.analysis });
-                  break;
-                  
-                case 'image':
-                  dispatch({ type: 'ADD_IMAGE', payload: data.image });
-                  break;
-                  
-                case 'usage':
-                  dispatch({ type: 'SET_USAGE', payload: data.usage });
-                  break;
-                  
-                case 'complete':
-                  dispatch({ type: 'ANALYZE_SUCCESS', payload: {} });
-                  break;
-                  
-                case 'error':
-                case 'analysis_error':
-                case 'images_error':
-                  console.warn('[SSE] Error parcial:', data.error);
-                  break;
+        while (true) {
+          const { done, value } = await reader.read();
+          
+          if (done) break;
+          
+          buffer += decoder.decode(value, { stream: true });
+          
+          // Procesar líneas SSE completas
+          const lines = buffer.split('\n');
+          buffer = lines.pop() || ''; // Guardar línea incompleta
+          
+          for (const line of lines) {
+            if (line.startsWith('id: ')) {
+              lastEventId = line.slice(4);
+            } else if (line.startsWith('data: ')) {
+              try {
+                const data = JSON.parse(line.slice(6));
+                if (data.type === 'session') {
+                  progressUrl = `/api/analyze-progress/${data.session_id}`;
+                } else if (data.type === 'complete' || data.type === 'error') {
+                  finished = true;
+                }
+                handleAnalysisEvent(dispatch, backendUrl, data);
+              } catch (e) {
+                console.warn('[SSE] Error parsing:', e);
               }
-            } catch (e) {
-              console.warn('[SSE] Error parsing:', e);
             }
           }
         }
+      };
+
+      // Si la conexión se corta, reconectar con Last-Event-ID: el servidor reenvía
+      // solo los eventos perdidos y el análisis no se repite
+      let reconnects = 0;
+      while (true) {
+        try {
+          await readStream(response);
+        } catch (e) {
+          if (!progressUrl) throw e;
+          console.warn('[SSE] Conexión interrumpida:', e);
+        }
+        if (finished || !progressUrl) break;
+
+        if (++reconnects > MAX_SSE_RECONNECTS) {
+          throw new Error('Se perdió la conexión con el servidor');
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000 * reconnects));
+        response = await fetch(`${backendUrl}${progressUrl}`, {
+          headers: lastEventId ? { 'Last-Event-ID': lastEventId } : {}
+        });
+        if (!response.ok) {
+          throw new Error('No se pudo reanudar el análisis');
+        }
       }
 
     } catch (error) {
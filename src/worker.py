@@ -0,0 +1,37 @@
+# Worker de la cola de análisis en un proceso aparte del servidor web.
+# Consume la misma cola SQLite (JOB_QUEUE_DB) que los procesos web del host;
+# en ese caso conviene arrancar la web con JOB_WORKERS=0.
+# Uso: JOB_WORKERS=4 python src/worker.py
+
+import os
+import signal
+import threading
+
+from api.analysis import run_analysis_job
+from api.services.cache_sweeper import start_cache_sweeper
+from api.services.http_transport import warm_up_connections
+from api.services.job_queue import JOB_QUEUE_ENABLED, JobWorkerPool, get_job_queue
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+
+
+def main():
+    if not JOB_QUEUE_ENABLED:
+        print("[JOBS] JOB_QUEUE_ENABLED=false, no hay nada que consumir")
+        return
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    start_cache_sweeper()
+    warm_up_connections()
+    pool = JobWorkerPool(get_job_queue(), run_analysis_job, max(1, JOB_WORKERS))
+    pool.start()
+    stop.wait()
+    print("[JOBS] Deteniendo workers...")
+    pool.stop(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Cliente Redis en memoria para las pruebas.
+
+Implementa solo los comandos que usa RedisStorage, con la misma forma que
+redis-py (valores en bytes, transaction() con WATCH/MULTI). Un solo hilo:
+las transacciones nunca se invalidan.
+"""
+import re
+import time
+
+
+def _bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+def _glob_to_regex(pattern):
+    """Patrón de SCAN (con escapes \\x) a expresión regular"""
+    out, i = [], 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern):
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        out.append({'*': '.*', '?': '.'}.get(c, re.escape(c)))
+        i += 1
+    return re.compile(''.join(out) + r'\Z', re.S)
+
+
+class FakeRedis:
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.data = {}  # key -> (valor, expires_at)
+
+    def _live(self, key):
+        item = self.data.get(key)
+        if item is not None and item[1] is not None and item[1] <= self.clock():
+            del self.data[key]
+            return None
+        return item
+
+    def _value(self, key, default):
+        item = self._live(key)
+        return item[0] if item is not None else default
+
+    def _store(self, key, value):
+        item = self._live(key)
+        self.data[key] = (value, item[1] if item else None)
+
+    # Cadenas
+
+    def get(self, key):
+        return self._value(key, None)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = (_bytes(value), self.clock() + ex if ex else None)
+        return True
+
+    def exists(self, *keys):
+        return sum(1 for key in keys if self._live(key) is not None)
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self._live(key) is not None and self.data.pop(key))
+
+    def incrby(self, key, amount=1):
+        value = int(self._value(key, b'0')) + amount
+        self._store(key, _bytes(value))
+        return value
+
+    def scan_iter(self, match='*'):
+        regex = _glob_to_regex(match)
+        return [key.encode() for key in list(self.data)
+                if self._live(key) is not None and regex.match(key)]
+
+    # Hashes
+
+    def hget(self, name, field):
+        return self._value(name, {}).get(field)
+
+    def hmget(self, name, fields):
+        values = self._value(name, {})
+        return [values.get(field) for field in fields]
+
+    def hset(self, name, field, value):
+        values = dict(self._value(name, {}))
+        created = field not in values
+        values[field] = _bytes(value)
+        self._store(name, values)
+        return int(created)
+
+    def hdel(self, name, *fields):
+        values = dict(self._value(name, {}))
+        removed = sum(1 for field in fields if values.pop(field, None) is not None)
+        self._store(name, values)
+        return removed
+
+    def hlen(self, name):
+        return len(self._value(name, {}))
+
+    # Conjuntos ordenados
+
+    def zadd(self, name, mapping):
+        scores = dict(self._value(name, {}))
+        added = sum(1 for member in mapping if member not in scores)
+        scores.update(mapping)
+        self._store(name, scores)
+        return added
+
+    def zrem(self, name, *members):
+        scores = dict(self._value(name, {}))
+        removed = sum(1 for member in members if scores.pop(member, None) is not None)
+        self._store(name, scores)
+        return removed
+
+    def zrangebyscore(self, name, min, max, start=None, num=None):
+        low = float(min)
+        high = float(max)
+        members = sorted(
+            (score, member) for member, score in self._value(name, {}).items()
+            if low <= score <= high
+        )
+        members = [member.encode() for _, member in members]
+        if start is not None:
+            members = members[start:start + num]
+        return members
+
+    # Transacciones
+
+    def transaction(self, func, *watches, value_from_callable=False):
+        pipe = FakePipeline(self)
+        value = func(pipe)
+        pipe.execute()
+        return value if value_from_callable else None
+
+
+class FakePipeline:
+    """Antes de multi() los comandos se ejecutan al momento; después se encolan"""
+
+    def __init__(self, client):
+        self.client = client
+        self.queued = None
+
+    def multi(self):
+        self.queued = []
+
+    def execute(self):
+        queued, self.queued = self.queued or [], None
+        return [command() for command in queued]
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if self.queued is None:
+            return method
+
+        def enqueue(*args, **kwargs):
+            self.queued.append(lambda: method(*args, **kwargs))
+        return enqueue
@@ -0,0 +1,62 @@
+"""Secuencia de eventos compartida por los dos motores (api.analysis.AnalysisEvents)"""
+import pytest
+
+from api import analysis
+from api.analysis import AnalysisEvents
+from api.services.gemini_service import ImageCollector
+
+
+@pytest.fixture(autouse=True)
+def sin_modo_degradado(monkeypatch):
+    monkeypatch.setattr(analysis, "degraded_mode_event", lambda previous=None: None)
+
+
+def types(events):
+    return [event["type"] for event in events]
+
+
+def test_subida_fallida_termina_con_error():
+    events = AnalysisEvents().uploaded({"success": False, "error": "sin red"})
+
+    assert types(events) == ["error"]
+    assert "sin red" in events[0]["error"]
+
+
+def test_secuencia_completa_y_uso_sumado():
+    sequence = AnalysisEvents()
+    assert types(sequence.uploaded({"success": True, "url": "https://x/selfie.jpg"})) == ["selfie", "progress"]
+
+    events = sequence.handle("image", {"style": "a"}, 0)
+    assert types(events) == ["image", "progress"]
+    assert events[1]["progress"] == 30
+    assert types(sequence.handle("image_full", {"style": "a"}, 0)) == ["image_full"]
+
+    sequence.handle("text_done", {"success": True, "analysis": "ok", "usage": {"total_tokens": 10}})
+    assert not sequence.finished
+    images_result = {"success": False, "error": "x", "usage": {"total_tokens": 5, "image_generations": 1}}
+    events = sequence.handle("images_done", images_result)
+    assert types(events) == ["images_error", "progress"]
+    assert sequence.finished
+
+    usage, complete = sequence.summary()
+    assert usage["usage"]["total_tokens"] == 15
+    assert usage["usage"]["image_generations"] == 1
+    assert complete["type"] == "complete"
+
+
+def test_collector_entrega_en_orden_y_suma_uso():
+    generated, upgraded = [], []
+    collector = ImageCollector(lambda image, index: generated.append(index),
+                               lambda event, index: upgraded.append((event["url"], index)))
+    frame = {"name": "Aviador"}
+
+    assert collector.deliver(None, frame, "on_face") is None
+    first = {"url": "a", "usage": {"total_tokens": 3}}
+    assert collector.deliver(first, frame, "on_face") == 0
+    assert collector.deliver({"url": "b"}, frame, "product") == 1
+    collector.upgrade(first, 0, {"url": "a-full"})
+
+    assert generated == [0, 1]
+    assert upgraded == [("a-full", 0)]
+    assert collector.usage["total_tokens"] == 3
+    assert collector.usage["image_generations"] == 2
@@ -0,0 +1,80 @@
+"""Imágenes servidas desde la capa ASGI (api.asgi_routes.get_image)"""
+import asyncio
+
+import pytest
+
+from api import asgi_routes
+from api.asgi_routes import find_async_route, get_image
+from api.services import blob_store
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 600
+
+
+@pytest.fixture
+def digest(monkeypatch, tmp_path):
+    monkeypatch.setattr(blob_store, "BLOB_STORE_DIR", str(tmp_path))
+    return blob_store.put_blob(PNG)
+
+
+def fetch(path, headers=(), method="GET"):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": method, "path": path,
+             "headers": [(name.encode(), value.encode()) for name, value in headers]}
+    asyncio.run(get_image(scope, receive, send))
+    start = messages[0]
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    return start["status"], dict(start["headers"]), body
+
+
+def test_rutas_de_imagenes_van_a_asgi():
+    assert find_async_route("GET", "/api/images/abc") is get_image
+    assert find_async_route("HEAD", "/api/images/abc/") is get_image
+    assert find_async_route("GET", "/api/images/") is None
+    assert find_async_route("GET", "/api/images/a/b") is None
+    assert find_async_route("POST", "/api/analyze-face/") is asgi_routes.analyze_face
+
+
+def test_imagen_completa_con_cache_inmutable(digest):
+    status, headers, body = fetch(f"/api/images/{digest}")
+
+    assert status == 200
+    assert body == PNG
+    assert headers[b"content-type"] == b"image/png"
+    assert headers[b"etag"] == f'"{digest}"'.encode()
+    assert b"immutable" in headers[b"cache-control"]
+
+
+def test_if_none_match_responde_304(digest):
+    status, _, body = fetch(f"/api/images/{digest}", [("if-none-match", f'W/"x", "{digest}"')])
+    assert (status, body) == (304, b"")
+
+
+def test_range(digest):
+    status, headers, body = fetch(f"/api/images/{digest}", [("range", "bytes=10-19")])
+    assert (status, body) == (206, PNG[10:20])
+    assert headers[b"content-range"] == f"bytes 10-19/{len(PNG)}".encode()
+
+    status, _, body = fetch(f"/api/images/{digest}", [("range", "bytes=-5")])
+    assert (status, body) == (206, PNG[-5:])
+
+    status, headers, _ = fetch(f"/api/images/{digest}", [("range", f"bytes={len(PNG)}-")])
+    assert status == 416
+    assert headers[b"content-range"] == f"bytes */{len(PNG)}".encode()
+
+
+def test_head_sin_cuerpo(digest):
+    status, headers, body = fetch(f"/api/images/{digest}", method="HEAD")
+    assert (status, body) == (200, b"")
+    assert headers[b"content-length"] == str(len(PNG)).encode()
+
+
+def test_imagen_inexistente(digest):
+    assert fetch("/api/images/" + "0" * 64)[0] == 404
+    assert fetch("/api/images/no-es-un-digest")[0] == 404
@@ -0,0 +1,46 @@
+"""Almacén de blobs y su límite de tamaño (api.services.blob_store)"""
+import os
+
+import pytest
+
+from api.services import blob_store
+from api.services.blob_store import blob_path, evict_blobs, has_blob, put_blob
+
+
+@pytest.fixture(autouse=True)
+def store_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(blob_store, "BLOB_STORE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def put_with_mtime(data, mtime):
+    digest = put_blob(data)
+    os.utime(blob_path(digest), (mtime, mtime))
+    return digest
+
+
+def test_bajo_el_limite_no_borra_nada():
+    put_blob(b"a" * 100)
+    assert evict_blobs(max_bytes=100) == (0, 0)
+
+
+def test_expulsa_los_usados_hace_mas_tiempo(store_dir):
+    oldest = put_with_mtime(b"1" * 100, 1000)
+    middle = put_with_mtime(b"2" * 100, 2000)
+    newest = put_with_mtime(b"3" * 100, 3000)
+    (store_dir / "upload.1.1.tmp").write_bytes(b"x" * 500)  # escritura en curso
+
+    assert evict_blobs(max_bytes=200) == (1, 100)
+    assert not has_blob(oldest)
+    assert has_blob(middle) and has_blob(newest)
+    assert (store_dir / "upload.1.1.tmp").exists()
+
+
+def test_una_lectura_renueva_el_blob():
+    first = put_with_mtime(b"1" * 100, 1000)
+    second = put_with_mtime(b"2" * 100, 2000)
+    with blob_store.open_blob(first):
+        pass
+
+    evict_blobs(max_bytes=100)
+    assert has_blob(first) and not has_blob(second)
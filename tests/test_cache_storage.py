@@ -0,0 +1,113 @@
+"""Backends de la caché (api.services.cache_storage)"""
+from types import SimpleNamespace
+
+import pytest
+
+from api.services import cache_storage
+from api.services.cache_storage import MemoryLRUStorage, RedisStorage, SQLiteStorage
+from fake_redis import FakeRedis
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_storage, "time", SimpleNamespace(time=clock))
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def storage(request, tmp_path, clock):
+    if request.param == "memory":
+        return MemoryLRUStorage(max_bytes=1024)
+    if request.param == "sqlite":
+        return SQLiteStorage(str(tmp_path / "cache.sqlite3"), max_bytes=1024)
+    return RedisStorage(client=FakeRedis(clock=clock))
+
+
+def test_set_get_y_borrado(storage):
+    storage.set("a:1", b"uno")
+    storage.set("a:2", b"dos")
+    storage.set("b:1", b"tres")
+
+    assert storage.get("a:1") == b"uno"
+    assert storage.has("a:2")
+    assert sorted(storage.keys("a:")) == ["a:1", "a:2"]
+
+    storage.delete("a:1")
+    assert storage.get("a:1") is None
+    assert storage.delete_prefix("a:") == 1
+    assert storage.keys() == ["b:1"]
+
+
+def test_stats_sigue_escrituras_y_borrados(storage):
+    storage.set("x", b"12345")
+    storage.set("y", b"123")
+    storage.set("x", b"12")  # reescritura: cuenta el tamaño nuevo
+
+    stats = storage.stats()
+    assert (stats["entries"], stats["bytes"]) == (2, 5)
+
+    storage.delete_many(["x", "y", "no-existe"])
+    stats = storage.stats()
+    assert (stats["entries"], stats["bytes"]) == (0, 0)
+
+
+def test_expiradas_no_se_leen_y_se_descuentan(storage, clock):
+    storage.set("efimera", b"1234", ttl=10)
+    storage.set("fija", b"12")
+
+    clock.now += 11
+    assert storage.get("efimera") is None
+    assert storage.keys() == ["fija"]
+
+    storage.purge_expired()
+    stats = storage.stats()
+    assert (stats["entries"], stats["bytes"]) == (1, 2)
+
+
+def test_redis_stats_no_recorre_las_claves(clock):
+    client = FakeRedis(clock=clock)
+    storage = RedisStorage(client=client)
+    storage.set("a", b"123")
+    client.scan_iter = None  # stats() no debe usar SCAN
+
+    assert storage.stats()["entries"] == 1
+
+
+def test_redis_purge_no_descuenta_claves_reescritas(clock):
+    client = FakeRedis(clock=clock)
+    storage = RedisStorage(client=client)
+    storage.set("k", b"1234", ttl=10)
+    clock.now += 11
+    storage.set("k", b"12")  # reescrita sin TTL antes de la purga
+
+    assert storage.purge_expired() == 0
+    assert storage.get("k") == b"12"
+    assert storage.stats()["bytes"] == 2
+
+
+def test_update_lee_modifica_y_borra(storage):
+    assert storage.update("n", lambda old: b"1") is None
+    assert storage.update("n", lambda old: old + b"2") == b"1"
+    assert storage.get("n") == b"12"
+
+    assert storage.update("n", lambda old: None) == b"12"
+    assert storage.get("n") is None
+    assert storage.stats()["entries"] == 0
+
+
+def test_valor_mayor_que_el_limite_no_deja_el_anterior(storage):
+    storage.set("k", b"viejo")
+    storage.set("k", b"x" * 2048)
+
+    assert storage.get("k") != b"viejo"
+    stats = storage.stats()
+    assert stats["bytes"] == (2048 if stats["entries"] else 0)
@@ -0,0 +1,69 @@
+"""Checkpoints por sesión y su manifiesto (api.services.checkpoint_cache)"""
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from api.services import cache_storage, checkpoint_cache
+from api.services.cache_storage import SQLiteStorage
+
+
+@pytest.fixture
+def storage(monkeypatch, tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(cache_storage, "_storage", storage)
+    return storage
+
+
+def test_guardar_recuperar_y_limpiar_sesion(storage):
+    session_id = checkpoint_cache.get_session_id("selfie")
+    assert checkpoint_cache.save_checkpoint(session_id, "analysis", {"forma": "ovalada"})
+    assert checkpoint_cache.save_checkpoint(session_id, "styles", ["aviador"])
+
+    assert checkpoint_cache.get_checkpoint(session_id, "analysis") == {"forma": "ovalada"}
+    status = checkpoint_cache.get_session_status(session_id)
+    assert status["analysis"] and status["styles"] and not status["specs_0"]
+
+    checkpoint_cache.clear_session(session_id)
+    assert checkpoint_cache.get_checkpoint(session_id, "analysis") is None
+    assert storage.keys() == []
+
+
+def test_manifiesto_no_pierde_checkpoints_concurrentes(storage):
+    # SQLiteStorage abre una conexión por hilo, así que cada hilo actúa como
+    # otro worker: sin un update atómico las lecturas-escrituras intercaladas
+    # perderían claves del manifiesto
+    session_id = "concurrente"
+    barrier = threading.Barrier(4)
+
+    def save(index):
+        barrier.wait()
+        for n in range(15):
+            checkpoint_cache._add_to_manifest(session_id, f"k{index}_{n}", time.time() + 3600)
+
+    threads = [threading.Thread(target=save, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(checkpoint_cache._read_manifest(session_id)) == 4 * 15
+
+
+def test_estado_no_cuenta_checkpoints_expirados(storage, monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    fake_time = SimpleNamespace(time=lambda: clock.now)
+    monkeypatch.setattr(cache_storage, "time", fake_time)
+    monkeypatch.setattr(checkpoint_cache, "time", fake_time)
+    monkeypatch.setattr(checkpoint_cache, "CACHE_TTL_HOURS", 1)
+
+    checkpoint_cache.save_checkpoint("s", "analysis", {"forma": "ovalada"})
+    clock.now += 40 * 60
+    # El checkpoint nuevo renueva el manifiesto, no el de "analysis"
+    checkpoint_cache.save_checkpoint("s", "styles", ["aviador"])
+    clock.now += 30 * 60
+
+    status = checkpoint_cache.get_session_status("s")
+    assert not status["analysis"]
+    assert status["styles"]
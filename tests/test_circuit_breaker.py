@@ -0,0 +1,69 @@
+"""Circuit breaker por modelo (api.services.circuit_breaker)"""
+from types import SimpleNamespace
+
+import pytest
+
+from api.services import circuit_breaker, gemini_service
+from api.services.circuit_breaker import CircuitBreaker
+from api.services.gemini_errors import CircuitOpenError
+from api.services.rate_limiter import RateLimitTimeout
+
+
+def test_fallos_seguidos_abren_y_la_prueba_cierra(monkeypatch):
+    clock = SimpleNamespace(now=100.0)
+    monkeypatch.setattr(circuit_breaker, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    breaker = CircuitBreaker("modelo", failure_threshold=2, open_seconds=30)
+
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record('transient')
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+    clock.now += 30
+    assert breaker.allow()  # prueba de half-open
+    assert not breaker.allow()  # solo una a la vez
+    breaker.record(None)
+    assert breaker.state == 'closed'
+
+
+def test_429_y_bloqueos_no_cuentan_como_fallo():
+    breaker = CircuitBreaker("modelo", failure_threshold=1)
+    for kind in ('rate_limited', 'cancelled', 'blocked', 'invalid'):
+        assert breaker.allow()
+        breaker.record(kind)
+    assert breaker.state == 'closed'
+
+
+@pytest.fixture
+def breaker():
+    breaker = circuit_breaker.configure_breaker("modelo-prueba", failure_threshold=1, open_seconds=60)
+    yield breaker
+    with circuit_breaker._lock:
+        circuit_breaker._breakers.pop("modelo-prueba", None)
+
+
+def test_circuito_abierto_no_toma_cuota(breaker, monkeypatch):
+    acquired = []
+    monkeypatch.setattr(gemini_service, "rate_limiter", SimpleNamespace(acquire=acquired.append))
+    breaker.allow()
+    breaker.record('timeout')
+
+    with pytest.raises(CircuitOpenError):
+        gemini_service.generate_content("modelo-prueba", ["hola"])
+    assert acquired == []
+
+
+def test_sin_cuota_se_libera_la_prueba_de_half_open(breaker, monkeypatch):
+    def acquire(model):
+        raise RateLimitTimeout("sin cuota")
+
+    monkeypatch.setattr(gemini_service, "rate_limiter", SimpleNamespace(acquire=acquire))
+    breaker.allow()
+    breaker.record('timeout')
+    breaker._opened_at -= 60  # vence el enfriamiento
+
+    with pytest.raises(RateLimitTimeout):
+        gemini_service.admit_call("modelo-prueba")
+    # La prueba no quedó tomada: la siguiente llamada puede probar
+    assert breaker.allow()
@@ -0,0 +1,81 @@
+"""Buffer de reenvío de eventos SSE (api.services.event_buffer)"""
+from types import SimpleNamespace
+
+import pytest
+
+from api.services import event_buffer
+from api.services.event_buffer import EventBuffer, EventBufferRegistry, follow_events, parse_last_event_id
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(event_buffer, "time", SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def test_reenvio_desde_last_event_id():
+    buffer = EventBuffer("s")
+    for n in range(4):
+        buffer.append({"n": n})
+    buffer.close()
+
+    assert [seq for seq, _ in follow_events(buffer, after_seq=2)] == [3, 4]
+    assert buffer.subscribers == 0
+
+
+def test_eventos_que_salieron_del_buffer_se_avisan():
+    buffer = EventBuffer("s", max_events=2)
+    for n in range(5):
+        buffer.append({"n": n})
+
+    events, missed = buffer.events_after(1)
+    assert missed
+    assert [seq for seq, _ in events] == [4, 5]
+    assert buffer.events_after(3) == ([(4, {"n": 3}), (5, {"n": 4})], False)
+
+    buffer.close()
+    (seq, event), = follow_events(buffer, after_seq=1)
+    assert (seq, event["type"]) == (5, "error")
+
+
+def test_keepalive_sin_eventos():
+    buffer = EventBuffer("s")
+    stream = follow_events(buffer, heartbeat=0.01)
+    assert next(stream) is None
+    buffer.append({"n": 1})
+    assert next(stream) == (1, {"n": 1})
+
+
+def test_analisis_identico_se_une_al_buffer_abierto():
+    registry = EventBufferRegistry()
+    first, created = registry.join_or_create("selfie+datos")
+    assert created
+
+    second, created = registry.join_or_create("selfie+datos")
+    assert (second, created) == (first, False)
+    assert registry.stats()["coalesced"] == 1
+
+    first.close()
+    third, created = registry.join_or_create("selfie+datos")
+    assert created and third is not first
+
+
+def test_buffers_inactivos_expiran(clock):
+    registry = EventBufferRegistry(ttl=10)
+    buffer, _ = registry.join_or_create("selfie+datos")
+    buffer.append({"n": 1})
+    buffer.close()
+
+    clock.now += 5
+    assert registry.get(buffer.session_id) is buffer
+    clock.now += 6
+    assert registry.get(buffer.session_id) is None
+    assert registry.stats()["evictions"] == 1
+
+
+def test_parse_last_event_id():
+    assert parse_last_event_id("7") == 7
+    assert parse_last_event_id(None) == 0
+    assert parse_last_event_id("x") == 0
+    assert parse_last_event_id("-3") == 0
@@ -0,0 +1,131 @@
+"""Hedging de llamadas lentas (api.services.hedging)"""
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+from api.services.hedging import HedgePolicy
+
+
+def warmed_policy(**kwargs):
+    """Política activa con un percentil ya calculado (respaldo a los 0.05s)"""
+    policy = HedgePolicy("prueba", enabled=True, min_samples=1, min_delay=0.05, budget_burst=3, **kwargs)
+    policy.record(0.01)
+    return policy
+
+
+def test_respaldo_gana_si_la_primaria_tarda():
+    policy = warmed_policy()
+    release = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(len(calls))
+        if calls[-1] == 0:
+            release.wait(2)  # la primaria queda colgada
+            return "primaria"
+        return "respaldo"
+
+    try:
+        assert policy.run(call, reserve_quota=lambda: True) == "respaldo"
+    finally:
+        release.set()
+    assert policy.metrics["hedge_wins"] == 1
+
+
+def test_sin_cuota_no_hay_respaldo_y_se_devuelve_la_ficha():
+    policy = warmed_policy()
+    budget = policy._budget
+
+    def call():
+        time.sleep(0.1)
+        return "primaria"
+
+    assert policy.run(call, reserve_quota=lambda: False) == "primaria"
+    assert policy.metrics["quota_denied"] == 1
+    assert policy.metrics["hedged"] == 0
+    # +ratio por la llamada; la ficha del respaldo no lanzado se devolvió
+    assert policy._budget >= budget
+
+
+def test_async_perdedor_cancelado_no_rompe():
+    policy = warmed_policy()
+
+    async def scenario():
+        calls = []
+
+        async def call():
+            calls.append(len(calls))
+            if calls[-1] == 0:
+                await asyncio.sleep(1)
+                return "primaria"
+            return "respaldo"
+
+        async def reserve():
+            return True
+
+        result = await policy.run_async(call, reserve_quota=reserve)
+        await asyncio.sleep(0)  # deja que la cancelación del perdedor se procese
+        return result
+
+    assert asyncio.run(scenario()) == "respaldo"
+
+
+def test_async_intento_cancelado_no_impide_que_gane_el_otro():
+    policy = warmed_policy()
+
+    async def scenario():
+        calls = []
+
+        async def call():
+            calls.append(len(calls))
+            if calls[-1] == 0:
+                # La primaria termina cancelada cuando el respaldo ya corre
+                await asyncio.sleep(0.1)
+                raise asyncio.CancelledError()
+            await asyncio.sleep(0.2)
+            return "respaldo"
+
+        async def reserve():
+            return True
+
+        return await policy.run_async(call, reserve_quota=reserve)
+
+    # task.exception() sobre la primaria cancelada lanzaría CancelledError
+    assert asyncio.run(scenario()) == "respaldo"
+
+
+def image_response(data):
+    part = SimpleNamespace(inline_data=SimpleNamespace(data=data, mime_type="image/png"))
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+def test_solo_se_guarda_la_imagen_ganadora(monkeypatch):
+    from api.services import gemini_service
+
+    release = threading.Event()
+    calls, stored = [], []
+
+    def call_model(model, contents, config=None):
+        calls.append(threading.current_thread())
+        if len(calls) == 1:
+            release.wait(2)  # primaria lenta: pierde contra el respaldo
+            return image_response(b"primaria")
+        return image_response(b"respaldo")
+
+    monkeypatch.setattr(gemini_service, "_call_model", call_model)
+    monkeypatch.setattr(gemini_service, "image_hedge", warmed_policy())
+    monkeypatch.setattr(gemini_service, "rate_limiter",
+                        SimpleNamespace(acquire=lambda model: 0, try_reserve=lambda model: True))
+    monkeypatch.setattr(gemini_service, "store_image",
+                        lambda data, mime_type, **metadata: stored.append(data) or {"blob": data})
+
+    try:
+        result = gemini_service.generate_single_image(None, "prompt", "product", "aviador")
+    finally:
+        release.set()
+    for thread in calls:
+        thread.join(2)
+
+    assert result == {"blob": b"respaldo"}
+    assert stored == [b"respaldo"]
@@ -0,0 +1,108 @@
+"""Cola persistente de análisis (api.services.job_queue)"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from api import asgi_routes
+from api.services import job_queue, progress_tracker
+from api.services.job_queue import JobQueue
+from api.services.progress_tracker import MemoryTrackerStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(job_queue, "time", SimpleNamespace(time=clock.time))
+    return clock
+
+
+@pytest.fixture
+def queue(monkeypatch, tmp_path, clock):
+    monkeypatch.setattr(progress_tracker, "_store", MemoryTrackerStore())
+    monkeypatch.setattr(job_queue, "JOB_STALE_SECONDS", 60)
+    monkeypatch.setattr(job_queue, "JOB_MAX_ATTEMPTS", 2)
+    return JobQueue(str(tmp_path / "jobs.sqlite3"))
+
+
+def test_flight_key_reutiliza_el_trabajo_en_curso(queue):
+    first = queue.enqueue({"n": 1}, flight_key="selfie+datos")
+    assert queue.enqueue({"n": 2}, flight_key="selfie+datos") == first
+    assert queue.enqueue({"n": 3}, flight_key="otra") != first
+    assert queue.enqueue({"n": 4}) != first
+
+    # Terminado, un envío nuevo con la misma clave crea otro trabajo
+    queue.claim("w")
+    queue.finish(first, "done")
+    assert queue.enqueue({"n": 5}, flight_key="selfie+datos") != first
+
+
+def test_trabajo_abandonado_vuelve_a_la_cola_hasta_agotar_intentos(queue, clock):
+    job_id = queue.enqueue({"n": 1})
+
+    assert queue.claim("w1")[2] == 1
+    clock.now += 30
+    assert queue.requeue_stale() == []  # heartbeat reciente
+
+    clock.now += 31
+    assert queue.requeue_stale() == [(job_id, True)]
+    assert queue.get_job(job_id)["status"] == "queued"
+
+    assert queue.claim("w2")[2] == 2
+    clock.now += 61
+    assert queue.requeue_stale() == [(job_id, False)]
+    job = queue.get_job(job_id)
+    assert job["status"] == "failed"
+    assert queue.claim("w3") is None
+
+
+def test_heartbeat_evita_el_reencolado(queue, clock):
+    job_id = queue.enqueue({"n": 1})
+    queue.claim("w1")
+
+    clock.now += 50
+    queue.heartbeat([job_id])
+    clock.now += 50
+    assert queue.requeue_stale() == []
+    assert queue.get_job(job_id)["status"] == "running"
+
+
+def test_stream_asgi_del_log_desde_last_event_id(queue, monkeypatch):
+    monkeypatch.setattr(asgi_routes, "TRACKER_POLL_SECONDS", 0.01)
+    job_id = queue.enqueue({"n": 1})
+    queue.claim("w")
+    for n in range(3):
+        queue.append_event(job_id, {"type": "progress", "progress": n})
+    sent = []
+
+    async def send(message):
+        sent.append(message.get("body", b""))
+
+    async def scenario():
+        stream = asyncio.create_task(asgi_routes._send_job_events(queue, job_id, send, after_seq=1))
+        await asyncio.sleep(0.05)
+        await asyncio.to_thread(queue.append_event, job_id, {"type": "complete"})
+        await asyncio.to_thread(queue.finish, job_id, "done")
+        await asyncio.wait_for(stream, 5)
+
+    asyncio.run(scenario())
+    ids = [line for line in b"".join(sent).decode().splitlines() if line.startswith("id:")]
+    assert ids == ["id: 2", "id: 3", "id: 4"]
+
+
+def test_progreso_sin_trabajo_ni_buffer_pasa_a_flask(queue, monkeypatch):
+    monkeypatch.setattr(asgi_routes, "JOB_QUEUE_ENABLED", True)
+    monkeypatch.setattr(asgi_routes, "get_job_queue", lambda: queue)
+    path = "/api/analyze-progress/tracker-suelto"
+    scope = {"type": "http", "method": "GET", "path": path, "headers": []}
+
+    assert asgi_routes.find_async_route("GET", path) is asgi_routes.analyze_progress
+    assert asyncio.run(asgi_routes.analyze_progress(scope, None, None)) is False
@@ -0,0 +1,110 @@
+"""Selfie subida una vez y referenciada por las etapas (api.services.model_files)"""
+import asyncio
+import hashlib
+import threading
+from types import SimpleNamespace
+
+from api.services import model_files, selfie_blob
+from api.services.model_files import SelfieReferences, selfie_session
+from api.services.selfie_blob import SelfieBlob
+
+
+class RecordingStore:
+    name = 'prueba'
+
+    def __init__(self):
+        self.uploads = []
+        self.deleted = []
+
+    def upload(self, data, mime_type, display_name):
+        self.uploads.append(display_name)
+        return f"ref:{display_name}", f"files/{len(self.uploads)}"
+
+    def delete(self, handle):
+        self.deleted.append(handle)
+
+
+def make_references(store):
+    return SelfieReferences(store, min_bytes=10, ttl_seconds=3600)
+
+
+def test_sesion_sube_una_vez_referencia_y_borra_al_cerrar():
+    store = RecordingStore()
+    references = make_references(store)
+    selfie = SelfieBlob(b"x" * 100, "image/png")
+
+    references.open_session(selfie)
+    references.open_session(selfie)  # segundo análisis de la misma foto
+    references._executor.submit(lambda: None).result()  # espera la subida
+
+    assert references.part(selfie) == f"ref:selfie-{selfie.digest[:16]}"
+    assert len(store.uploads) == 1
+
+    references.close_session(selfie)
+    assert store.deleted == []
+    references.close_session(selfie)
+    references._executor.shutdown(wait=True)
+    assert store.deleted == ["files/1"]
+
+
+def test_selfie_chica_o_sin_sesion_va_inline():
+    references = make_references(RecordingStore())
+    part = references.part(SelfieBlob(b"x" * 100, "image/png"))
+
+    assert part.inline_data.data == b"x" * 100
+    assert references.metrics["inline"] == 1
+
+
+def test_part_no_vuelve_a_hashear_la_selfie(monkeypatch):
+    calls = []
+
+    def counting_sha256(data):
+        calls.append(len(data))
+        return hashlib.sha256(data)
+
+    monkeypatch.setattr(selfie_blob, "hashlib", SimpleNamespace(sha256=counting_sha256))
+    references = make_references(RecordingStore())
+    selfie = SelfieBlob(b"x" * 100, "image/png")
+
+    for _ in range(5):
+        references.part(selfie)
+
+    assert calls == [100]
+
+
+class SlowStore(RecordingStore):
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def upload(self, data, mime_type, display_name):
+        self.release.wait(5)
+        return super().upload(data, mime_type, display_name)
+
+
+def test_sesion_del_analisis_espera_la_subida_y_borra_al_salir(monkeypatch):
+    store = SlowStore()
+    references = make_references(store)
+    monkeypatch.setattr(model_files, "_references", references)
+    selfie = SelfieBlob(b"x" * 100, "image/png")
+    threading.Timer(0.05, store.release.set).start()
+
+    with selfie_session(selfie):
+        # La primera etapa ya recibe la referencia, no los bytes
+        assert references.part(selfie) == f"ref:selfie-{selfie.digest[:16]}"
+
+    references._executor.shutdown(wait=True)
+    assert store.deleted == ["files/1"]
+
+
+def test_espera_de_la_subida_acotada():
+    store = SlowStore()
+    references = make_references(store)
+    selfie = SelfieBlob(b"x" * 100, "image/png")
+    references.open_session(selfie)
+
+    assert references.wait_for_upload(selfie, timeout=0.05) is False
+    assert references.part(selfie).inline_data.data == selfie.data
+
+    store.release.set()
+    assert asyncio.run(references.wait_for_upload_async(selfie, timeout=5)) is True
@@ -0,0 +1,76 @@
+"""Trackers de progreso compartidos entre workers (api.services.progress_tracker)"""
+import threading
+import time
+
+import pytest
+
+from api.services import progress_tracker
+from api.services.progress_tracker import SQLiteTrackerStore
+
+
+@pytest.fixture
+def stores(tmp_path):
+    # Dos stores sobre el mismo archivo hacen de dos workers del host
+    path = str(tmp_path / "trackers.sqlite3")
+    return SQLiteTrackerStore(path), SQLiteTrackerStore(path)
+
+
+def test_otro_worker_ve_los_cambios(stores):
+    owner, other = stores
+    tracker = owner.create("sesion")
+    tracker.start()
+    tracker.update(40, "Analizando rostro")
+
+    remote = other.get("sesion")
+    assert remote.get_progress()["status"] == "Analizando rostro"
+    assert other.get("no-existe") is None
+
+
+def test_wait_for_change_despierta_con_cambios_remotos(stores):
+    owner, other = stores
+    tracker = owner.create("sesion")
+    remote = other.get("sesion")
+    version = remote.version
+
+    timer = threading.Timer(0.1, tracker.update, args=(50, "Generando"))
+    timer.start()
+    assert remote.wait_for_change(version, timeout=5) != version
+    timer.join()
+    assert remote.get_progress()["status"] == "Generando"
+
+
+def test_sondeo_con_backoff(stores, monkeypatch):
+    owner, other = stores
+    owner.create("sesion")
+    remote = other.get("sesion")
+    monkeypatch.setattr(progress_tracker, "TRACKER_POLL_SECONDS", 0.01)
+    monkeypatch.setattr(progress_tracker, "TRACKER_POLL_MAX_SECONDS", 0.08)
+    reads = []
+    original = other.version
+    monkeypatch.setattr(other, "version", lambda session_id: reads.append(time.time()) or original(session_id))
+
+    remote.wait_for_change(remote.version, timeout=0.5)
+
+    # 0.01 + 0.02 + 0.04 + 0.08... en lugar de 50 lecturas a intervalo fijo
+    assert 4 <= len(reads) <= 12
+
+
+def test_get_no_consulta_la_base_para_trackers_conocidos(stores, monkeypatch):
+    owner, other = stores
+    owner.create("sesion")
+    remote = other.get("sesion")
+    monkeypatch.setattr(other, "version", None)
+    monkeypatch.setattr(other, "load", None)
+
+    assert other.get("sesion") is remote
+
+
+def test_borrado_por_otro_worker_completa_el_tracker(stores):
+    owner, other = stores
+    tracker = owner.create("sesion")
+    tracker.update(70, "Casi")
+    remote = other.get("sesion")
+
+    owner.delete("sesion")
+
+    assert remote.get_progress()["progress"] == 100
@@ -0,0 +1,93 @@
+"""Token bucket compartido (api.services.rate_limiter)"""
+import pytest
+
+from api.services import rate_limiter
+from api.services.rate_limiter import MemoryBucketBackend, RateLimitTimeout, SQLiteBucketBackend
+
+
+class FakeClock:
+    """Reemplaza al módulo time del limitador: sleep avanza el reloj sin dormir"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def clock(request, monkeypatch, tmp_path):
+    backend = MemoryBucketBackend() if request.param == "memory" \
+        else SQLiteBucketBackend(str(tmp_path / "buckets.sqlite3"))
+    monkeypatch.setattr(rate_limiter, "_backend", backend)
+    monkeypatch.setattr(rate_limiter, "_buckets", {})
+    fake = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", fake)
+    # 1 token por segundo, ráfaga de 2
+    rate_limiter.configure_bucket("modelo", requests_per_minute=60, burst=2)
+    return fake
+
+
+def tokens():
+    return rate_limiter.get_bucket_levels()["modelo"]["tokens"]
+
+
+def test_rafaga_sin_espera_y_luego_turnos_escalonados(clock):
+    assert rate_limiter.acquire("modelo") == 0
+    assert rate_limiter.acquire("modelo") == 0
+    assert rate_limiter.acquire("modelo") == pytest.approx(1.0)
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+def test_acquire_con_timeout_no_consume_cuota(clock):
+    rate_limiter.acquire("modelo")
+    rate_limiter.acquire("modelo")
+    before = tokens()
+
+    for _ in range(3):
+        with pytest.raises(RateLimitTimeout):
+            rate_limiter.acquire("modelo", max_wait=0.5)
+
+    assert tokens() == before
+    assert clock.sleeps == []
+    # El siguiente turno sigue a un segundo, no a cuatro
+    assert rate_limiter.reserve("modelo") == pytest.approx(1.0)
+
+
+def test_acquire_con_espera_dentro_del_maximo(clock):
+    rate_limiter.acquire("modelo")
+    rate_limiter.acquire("modelo")
+
+    assert rate_limiter.acquire("modelo", max_wait=1.5) == pytest.approx(1.0)
+    assert tokens() == pytest.approx(0.0)
+
+
+def test_try_reserve_nunca_duerme(clock):
+    assert rate_limiter.try_reserve("modelo") is True
+    assert rate_limiter.try_reserve("modelo") is True
+    assert rate_limiter.try_reserve("modelo") is False
+    assert clock.sleeps == []
+    assert tokens() == pytest.approx(0.0)
+
+    clock.now += 1
+    assert rate_limiter.try_reserve("modelo") is True
+
+
+def test_429_pausa_el_bucket(clock):
+    rate_limiter.report_rate_limited("modelo", retry_after=10)
+
+    assert rate_limiter.get_bucket_levels()["modelo"]["blocked_for_seconds"] == pytest.approx(10)
+    assert rate_limiter.try_reserve("modelo") is False
+    with pytest.raises(RateLimitTimeout):
+        rate_limiter.acquire("modelo", max_wait=5)
+    assert rate_limiter.acquire("modelo") >= 10
+
+
+def test_bucket_sin_configurar_no_limita(clock):
+    assert rate_limiter.acquire("otro", max_wait=0) == 0
+    assert rate_limiter.try_reserve("otro") is True
@@ -0,0 +1,85 @@
+"""Caché de resultados por contenido de la selfie (api.services.result_cache)"""
+import io
+import os
+import threading
+
+import pytest
+from PIL import Image
+
+from api.services import blob_store, cache_storage, result_cache
+from api.services.cache_storage import MemoryLRUStorage, SQLiteStorage
+from api.services.result_cache import get_result, lookup_result_key, result_version, save_result
+from api.services.selfie_blob import SelfieBlob
+
+
+@pytest.fixture(autouse=True)
+def storage(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache_storage, "_storage", MemoryLRUStorage())
+    monkeypatch.setattr(blob_store, "BLOB_STORE_DIR", str(tmp_path / "blobs"))
+
+
+def jpeg(quality):
+    img = Image.new("RGB", (64, 64))
+    img.putdata([(x * 4, y * 4, (x + y) * 2) for y in range(64) for x in range(64)])
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+
+def test_misma_selfie_misma_clave_y_version_nueva_no_reutiliza():
+    v1, v2 = result_version("modelo-a", "prompt"), result_version("modelo-b", "prompt")
+    selfie = SelfieBlob(jpeg(90))
+
+    key = lookup_result_key(selfie, v1)
+    assert save_result(key, {"analysis": "ovalado"})
+    assert get_result(lookup_result_key(SelfieBlob(jpeg(90), url="otra-url"), v1)) == {"analysis": "ovalado"}
+    assert get_result(lookup_result_key(selfie, v2)) is None
+
+
+def test_imagenes_se_guardan_como_blobs():
+    data_uri = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR4nGNgYGD4DwABBAEAwS2OUAAAAABJRU5ErkJggg=="
+    key = lookup_result_key(SelfieBlob(jpeg(90)), "v")
+    save_result(key, {"images": [{"data": data_uri, "style": "aviador"}]})
+
+    raw = cache_storage.get_storage().get(f"{result_cache.RESULT_PREFIX}{key}")
+    assert b"base64" not in raw
+    image = get_result(key)["images"][0]
+    assert image["style"] == "aviador"
+
+    # Si el blob ya no está, el resultado no se usa
+    os.remove(blob_store.blob_path(image["blob"]))
+    assert get_result(key) is None
+
+
+def test_modo_perceptual_reconoce_una_recompresion(monkeypatch):
+    monkeypatch.setattr(result_cache, "RESULT_CACHE_PERCEPTUAL", True)
+    original = SelfieBlob(jpeg(95))
+    key = lookup_result_key(original, "v")
+    save_result(key, {"analysis": "ovalado"}, original)
+
+    assert lookup_result_key(SelfieBlob(jpeg(60)), "v") == key
+
+
+def test_indice_perceptual_concurrente_y_acotado(monkeypatch, tmp_path):
+    # Cada hilo abre su propia conexión SQLite, como otro worker
+    monkeypatch.setattr(cache_storage, "_storage", SQLiteStorage(str(tmp_path / "cache.sqlite3")))
+    monkeypatch.setattr(result_cache, "RESULT_CACHE_PHASH_BAND_MAX_ENTRIES", 40)
+    barrier = threading.Barrier(4)
+
+    def index(worker):
+        barrier.wait()
+        for n in range(8):
+            result_cache._index_entry("banda", 0xabc, f"clave-{worker}-{n}")
+
+    threads = [threading.Thread(target=index, args=(w,)) for w in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(result_cache._read("banda")) == 32
+
+    for n in range(20):
+        result_cache._index_entry("banda", 0xabc, f"otra-{n}")
+    entries = result_cache._read("banda")
+    assert len(entries) == 40
+    assert entries[-1][1] == "otra-19"
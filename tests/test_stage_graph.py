@@ -0,0 +1,74 @@
+"""Ejecutor de etapas con dependencias (api.services.stage_graph)"""
+import threading
+import time
+
+import pytest
+
+from api.services.stage_graph import StageGraph
+
+
+def test_dependencias_reciben_resultados_en_orden():
+    graph = StageGraph(max_workers=2)
+    graph.add_stage("a", lambda: 2)
+    graph.add_stage("b", lambda: 3)
+    graph.add_stage("suma", lambda a, b: a + b, depends_on=["a", "b"])
+    graph.add_stage("resta", lambda b, a: b - a, depends_on=["b", "a"])
+
+    run = graph.run()
+
+    assert run["results"] == {"a": 2, "b": 3, "suma": 5, "resta": 1}
+    assert run["errors"] == {}
+    assert run["skipped"] == []
+    assert set(run["timings"]) == {"a", "b", "suma", "resta"}
+
+
+def test_etapas_independientes_corren_en_paralelo():
+    barrier = threading.Barrier(2, timeout=2)
+    graph = StageGraph(max_workers=2)
+    # Con ejecución secuencial la barrera nunca se completaría
+    graph.add_stage("x", barrier.wait)
+    graph.add_stage("y", barrier.wait)
+
+    run = graph.run()
+
+    assert run["errors"] == {}
+
+
+def test_etapa_lanza_en_cuanto_terminan_sus_dependencias():
+    started = {}
+    graph = StageGraph(max_workers=3)
+    graph.add_stage("rapida", lambda: time.sleep(0.01))
+    graph.add_stage("lenta", lambda: time.sleep(0.3))
+    graph.add_stage("siguiente", lambda _: started.setdefault("t", time.monotonic()), depends_on=["rapida"])
+
+    start = time.monotonic()
+    graph.run()
+
+    # No espera a la etapa lenta, que no es dependencia
+    assert started["t"] - start < 0.2
+
+
+def test_fallo_omite_dependientes_y_el_resto_continua():
+    def boom():
+        raise RuntimeError("falló")
+
+    graph = StageGraph()
+    graph.add_stage("mala", boom)
+    graph.add_stage("hija", lambda _: "no", depends_on=["mala"])
+    graph.add_stage("nieta", lambda _: "no", depends_on=["hija"])
+    graph.add_stage("otra", lambda: "ok")
+
+    run = graph.run()
+
+    assert isinstance(run["errors"]["mala"], RuntimeError)
+    assert sorted(run["skipped"]) == ["hija", "nieta"]
+    assert run["results"] == {"otra": "ok"}
+
+
+def test_registro_valida_nombres():
+    graph = StageGraph()
+    graph.add_stage("a", lambda: None)
+    with pytest.raises(ValueError):
+        graph.add_stage("a", lambda: None)
+    with pytest.raises(ValueError):
+        graph.add_stage("b", lambda _: None, depends_on=["desconocida"])
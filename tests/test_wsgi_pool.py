@@ -0,0 +1,62 @@
+"""Flask detrás de la capa ASGI (api.wsgi_pool)"""
+import asyncio
+import inspect
+import threading
+
+from asgiref.sync import SyncToAsync
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from api.wsgi_pool import PooledWsgiToAsgi
+
+
+def blocking_app(barrier):
+    """App WSGI cuyas requests solo terminan si dos corren a la vez"""
+    def app(environ, start_response):
+        try:
+            barrier.wait()
+            status = "200 OK"
+        except threading.BrokenBarrierError:
+            status = "503 Service Unavailable"
+        start_response(status, [("Content-Type", "text/plain")])
+        return [b"ok"]
+    return app
+
+
+async def request(application):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/", "query_string": b"",
+             "http_version": "1.1", "headers": []}
+    await application(scope, receive, send)
+    return messages[0]["status"]
+
+
+def run_concurrently(application):
+    async def scenario():
+        return await asyncio.gather(request(application), request(application))
+    return asyncio.run(scenario())
+
+
+def test_requests_de_flask_corren_en_paralelo():
+    app = blocking_app(threading.Barrier(2, timeout=2))
+    assert run_concurrently(PooledWsgiToAsgi(app)) == [200, 200]
+
+
+def test_wsgi_to_asgi_original_las_serializa():
+    # Referencia del problema: con un solo hilo la barrera nunca se completa
+    app = blocking_app(threading.Barrier(2, timeout=0.2))
+    assert run_concurrently(WsgiToAsgi(app)) == [503, 503]
+
+
+def test_hook_interno_de_asgiref_sigue_en_su_lugar():
+    # PooledWsgiToAsgi reutiliza el cuerpo síncrono de run_wsgi_app: si una
+    # versión nueva de asgiref lo mueve, hay que revisar api/wsgi_pool.py
+    wrapper = WsgiToAsgiInstance.__dict__["run_wsgi_app"]
+    assert isinstance(wrapper, SyncToAsync)
+    assert list(inspect.signature(wrapper.func).parameters) == ["self", "body"]